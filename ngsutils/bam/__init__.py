@@ -103,14 +103,19 @@ def bam_iter(bam, quiet=False, show_ref_pos=False, ref=None, start=None, end=Non
         eta.done()
 
 
-def bam_batch_reads(bam, quiet=False):
+def bam_batch_reads(bam, quiet=False, reads=None):
     '''
     Batch mapping for the same reads (qname) together, this way
     they can all be compared/converted together.
+
+    If {reads} is given (such as a name-sorted stream from
+    ngsutils.bam.namesort), those reads are batched instead of the reads
+    in {bam}.
     '''
+    source = reads if reads is not None else bam_iter(bam, quiet=quiet)
     reads = []
     last = None
-    for read in bam_iter(bam, quiet=quiet):
+    for read in source:
         if last and read.qname != last:
             yield reads
             reads = []
@@ -121,6 +126,43 @@ def bam_batch_reads(bam, quiet=False):
         yield reads
 
 
+def _bam_ref_worker(args):
+    func, fname, ref, func_args = args
+    return func(fname, ref, *func_args)
+
+
+def bam_map_refs(fname, func, procs=1, refs=None, *args):
+    '''
+    Calls func(fname, ref, *args) for each reference in an indexed BAM file,
+    using a pool of {procs} worker processes (each worker opens its own copy
+    of the BAM file). func must be a module-level function. Results are
+    yielded in reference order.
+    '''
+    if refs is None:
+        bam = bam_open(fname)
+        refs = list(bam.references)
+        bam.close()
+
+    jobs = [(func, fname, ref, args) for ref in refs]
+
+    if procs <= 1:
+        for job in jobs:
+            yield _bam_ref_worker(job)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(procs)
+    try:
+        for result in pool.imap(_bam_ref_worker, jobs):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 bam_cigar = ['M', 'I', 'D', 'N', 'S', 'H', 'P', '=', 'X']
 bam_cigar_op = {
     'M': 0,
@@ -498,6 +540,11 @@ def _read_calc_variations(start_pos, cigar, md, seq):
 
 
 def read_calc_mismatches_gen(ref, read, chrom):
+    '''
+    Yields the mismatches/indels for a read compared to the reference. ref
+    is a pysam.Fastafile or (for coordinate-sorted reads) a
+    ngsutils.support.refcache.RefCache.
+    '''
     start = read.pos
     ref_pos = 0
     read_pos = 0
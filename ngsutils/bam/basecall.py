@@ -58,8 +58,8 @@ import collections
 import datetime
 from ngsutils.bam import bam_iter, bam_open
 from ngsutils.bed import BedFile
+from ngsutils.support.refcache import RefCache
 from eta import ETA
-import pysam
 
 
 def usage():
@@ -408,7 +408,7 @@ def _calculate_heterozygosity(a, c, g, t):
 
 def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, showgaps=False, showstrand=False, minorpct=0.01, altfreq=False, variants=False, profiler=None, out=sys.stdout):
     if ref_fname:
-        ref = pysam.Fastafile(ref_fname)
+        ref = RefCache(ref_fname)
     else:
         ref = None
 
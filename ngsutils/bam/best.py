@@ -14,6 +14,7 @@ import os
 import sys
 import pysam
 import ngsutils.bam
+from ngsutils.bam.namesort import NameSorter
 
 
 def usage(msg=None):
@@ -32,18 +33,27 @@ Options
 
   -fail filename.bam    Write all failed mappings to this file.
 
+  -namesort             Sort the input by read name on the fly
+  -sortmem MB           Memory budget for -namesort (default: 512)
+  -sortprocs num        Number of processes for -namesort (default: 1)
+
 """
     sys.exit(1)
 
 
-def bam_best(infile, outfile, failfile=None, tags=['AS+', 'NM-'], quiet=False):
+def bam_best(infile, outfile, failfile=None, tags=['AS+', 'NM-'], quiet=False, namesort=None):
+    '''
+    If namesort (a NameSorter) is given, the input is sorted by name
+    as it is read.
+    '''
     inbam = pysam.Samfile(infile, "rb")
+    reads = namesort.reads(infile, quiet=quiet) if namesort else None
     outbam = pysam.Samfile('%s.tmp' % outfile, "wb", template=inbam)
 
     if failfile:
         failbam = pysam.Samfile('%s.tmp' % failfile, "wb", template=inbam)
 
-    for reads in ngsutils.bam.bam_batch_reads(inbam, quiet=quiet):
+    for reads in ngsutils.bam.bam_batch_reads(inbam, quiet=quiet, reads=reads):
         best_val = None
         best_reads = []
         failed = []
@@ -91,6 +101,9 @@ if __name__ == '__main__':
     failfile = None
     last = None
     tags = []
+    namesort = None
+    sortmem = 512
+    sortprocs = 1
 
     for arg in sys.argv[1:]:
         if arg == '-h':
@@ -101,8 +114,16 @@ if __name__ == '__main__':
         elif last == '-fail':
             failfile = arg
             last = None
-        elif arg in ['-tag', '-fail']:
+        elif last == '-sortmem':
+            sortmem = int(arg)
+            last = None
+        elif last == '-sortprocs':
+            sortprocs = int(arg)
+            last = None
+        elif arg in ['-tag', '-fail', '-sortmem', '-sortprocs']:
             last = arg
+        elif arg == '-namesort':
+            namesort = True
         elif not infile and os.path.exists(arg):
             infile = arg
         elif not outfile:
@@ -116,4 +137,6 @@ if __name__ == '__main__':
     if not infile or not outfile:
         usage()
     else:
-        bam_best(infile, outfile, failfile, tags)
+        if namesort:
+            namesort = NameSorter(sortmem, sortprocs)
+        bam_best(infile, outfile, failfile, tags, namesort=namesort)
@@ -101,6 +101,7 @@ import os
 
 import count
 from ngsutils.bam import bam_open
+from ngsutils.support.nameset import load_name_set
 
 
 def usage(msg=None):
@@ -142,6 +143,8 @@ Other options:
                        (only these read-names will be used in the calcs)
     -blacklist file    file containing a black-list of read names
                        (these read-names will not be used in the calcs)
+                       (White/black-lists can also be a name index file,
+                       see: bamutils nameindex)
 
 Possible values for [-norm]:
     (If -norm is not given, can't be calculated)
@@ -204,19 +207,15 @@ if __name__ == '__main__':
             multiple = arg
             last = None
         elif last == '-whitelist':
-            whitelist = []
             if not os.path.exists(arg):
                 usage('Whitelist file does not exist: %s' % arg)
-            with open(arg) as f:
-                for line in f:
-                    whitelist.append(line.strip())
+            whitelist = load_name_set(arg)
+            last = None
         elif last == '-blacklist':
-            blacklist = []
             if not os.path.exists(arg):
                 usage('Blacklist file does not exist: %s' % arg)
-            with open(arg) as f:
-                for line in f:
-                    blacklist.append(line.strip())
+            blacklist = load_name_set(arg)
+            last = None
         elif arg in ['-%s' % x for x in count.models]:
             model = arg[1:]
             last = arg
@@ -7,92 +7,252 @@ Outputs information about reads in a BAM file.
 This can be used to optionally extract various fields from a BAM file on a
 read-by-read basis. By default this will export the read-name, the mapped
 reference, the mapped position, and the CIGAR alignment string for a read.
+
+The fields can also be exported as binary columns (NumPy .npy/.npz files)
+for further analysis. String columns are dictionary-encoded (integer codes
+plus a list of the unique values). This requires NumPy.
 '''
 
 import sys
 import os
+import array
 from ngsutils.bam import bam_iter, cigar_tostr, bam_open
+from ngsutils.support.nameset import load_name_set
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def bam_export(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, out=sys.stdout, quiet=False, bufsize=10000):
+    extractors = compile_fields(bam, fields)
+    buf = []
+
+    try:
+        for read in _export_iter(bam, mapped, unmapped, whitelist, blacklist, quiet):
+            buf.append(format_read(extractors, read))
+            if len(buf) >= bufsize:
+                buf.append('')
+                out.write('\n'.join(buf))
+                buf = []
+
+        if buf:
+            buf.append('')
+            out.write('\n'.join(buf))
+    except IOError:
+        pass
 
 
-def bam_export(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, out=sys.stdout, quiet=False):
+def _export_iter(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, quiet=False):
     for read in bam_iter(bam, quiet=quiet):
         if whitelist and not read.qname in whitelist:
             continue
         if blacklist and read.qname in blacklist:
             continue
 
+        if read.is_unmapped:
+            if unmapped:
+                yield read
+        elif mapped:
+            yield read
+
+
+def _ref_name(bamfile, tid):
+    if tid == -1:
+        return '*'
+    elif bamfile:
+        return bamfile.getrname(tid)
+    return '?'
+
+
+def _tag_value(tag):
+    def func(read):
         try:
-            if mapped and not read.is_unmapped:
-                export_read(bam, read, fields, out)
-            elif unmapped and read.is_unmapped:
-                export_read(bam, read, fields, out)
-        except IOError:
-            break
+            return read.opt(tag)
+        except KeyError:
+            return ''
+    return func
 
 
-def export_read(bamfile, read, fields, out=sys.stdout):
+def _all_tags(read):
+    'All tags in SAM format (None if there are no tags)'
     cols = []
-    for field in fields:
-        if field == '-name':
-            cols.append(read.qname)
-        elif field == '-ref':
-            if read.tid == -1:
-                cols.append('*')
-            elif bamfile:
-                cols.append(bamfile.getrname(read.tid))
-            else:
-                cols.append('?')
-        elif field == '-pos':
-            cols.append(read.pos + 1)  # output 1-based
-        elif field == '-strand':
-            cols.append('-' if read.is_reverse else '+')
-        elif field == '-cigar':
-            if read.cigar:
-                cols.append(cigar_tostr(read.cigar))
-            else:
-                cols.append('*')
-        elif field == '-flags':
-            cols.append(read.flag)
-        elif field == '-seq':
-            cols.append(read.seq)
-        elif field == '-qual':
-            cols.append(read.qual)
-        elif field == '-mapq':
-            cols.append(read.mapq)
-        elif field == '-nextref':
-            if read.rnext == -1:
-                cols.append('*')
-            elif bamfile:
-                cols.append(bamfile.getrname(read.rnext))
-            else:
-                cols.append('?')
-        elif field == '-nextpos':
-            if read.rnext == -1:
-                cols.append(0)
+    for tag, val in read.tags:
+        if type(val) == int:
+            cols.append('%s:i:%s' % (tag, val))
+        elif type(val) == float:
+            cols.append('%s:f:%s' % (tag, val))
+        elif len(val) == 1:
+            cols.append('%s:A:%s' % (tag, val))
+        else:
+            cols.append('%s:Z:%s' % (tag, val))
+
+    if not cols:
+        return None
+    return '\t'.join(cols)
+
+
+def field_extractor(bamfile, field):
+    '''
+    Returns a function that extracts the value of a field (-name, -pos,
+    -tag:AS, etc) from a read. Raises ValueError for unknown fields.
+    '''
+    if field == '-name':
+        return lambda read: read.qname
+    elif field == '-ref':
+        return lambda read: _ref_name(bamfile, read.tid)
+    elif field == '-pos':
+        return lambda read: read.pos + 1  # output 1-based
+    elif field == '-strand':
+        return lambda read: '-' if read.is_reverse else '+'
+    elif field == '-cigar':
+        return lambda read: cigar_tostr(read.cigar) if read.cigar else '*'
+    elif field == '-flags':
+        return lambda read: read.flag
+    elif field == '-seq':
+        return lambda read: read.seq
+    elif field == '-qual':
+        return lambda read: read.qual
+    elif field == '-mapq':
+        return lambda read: read.mapq
+    elif field == '-nextref':
+        return lambda read: _ref_name(bamfile, read.rnext)
+    elif field == '-nextpos':
+        return lambda read: 0 if read.rnext == -1 else read.pnext + 1  # output 1-based
+    elif field == '-tlen':
+        return lambda read: read.tlen
+    elif field == '-isize':
+        return lambda read: read.isize
+    elif field == '-tag:*':
+        return _all_tags
+    elif field[:5] == '-tag:':
+        return _tag_value(field[5:])
+
+    raise ValueError('Unknown field: %s' % field)
+
+
+def compile_fields(bamfile, fields):
+    'Converts a list of fields into a tuple of extractor functions'
+    return tuple([field_extractor(bamfile, field) for field in fields])
+
+
+def format_read(extractors, read):
+    cols = []
+    for func in extractors:
+        val = func(read)
+        if val is None and func is _all_tags:
+            # no tags, so there is no column
+            continue
+        cols.append(str(val))
+    return '\t'.join(cols)
+
+
+def export_read(bamfile, read, fields, out=sys.stdout):
+    out.write('%s\n' % format_read(compile_fields(bamfile, fields), read))
+
+
+class _Column(object):
+    '''
+    Accumulates the values for one column. Numbers are stored in compact
+    arrays. Strings are dictionary-encoded as integer codes into a list of
+    unique values. If a column has mixed types (missing tags), it is stored
+    as strings.
+    '''
+    def __init__(self):
+        self.kind = None
+        self.values = None
+        self.codes = array.array('l')
+        self.lookup = {}
+        self.strings = []
+
+    def _encode(self, val):
+        try:
+            return self.lookup[val]
+        except KeyError:
+            code = len(self.strings)
+            self.lookup[val] = code
+            self.strings.append(val)
+            return code
+
+    def _to_str(self):
+        self.kind = 'str'
+        for val in self.values:
+            self.codes.append(self._encode(str(val)))
+        self.values = None
+
+    def add(self, val):
+        if self.kind is None:
+            if type(val) == int:
+                self.kind = 'int'
+                self.values = array.array('l')
+            elif type(val) == float:
+                self.kind = 'float'
+                self.values = array.array('d')
             else:
-                cols.append(read.pnext + 1)  # output 1-based
-        elif field == '-tlen':
-            cols.append(read.tlen)
-        elif field == '-isize':
-            cols.append(read.isize)
-        elif field[:5] == '-tag:':
-            if field[5:] == '*':
-                for tag, val in read.tags:
-                    if type(val) == int:
-                        cols.append('%s:i:%s' % (tag, val))
-                    elif type(val) == float:
-                        cols.append('%s:f:%s' % (tag, val))
-                    elif len(val) == 1:
-                        cols.append('%s:A:%s' % (tag, val))
-                    else:
-                        cols.append('%s:Z:%s' % (tag, val))
+                self.kind = 'str'
+        elif self.kind == 'int' and type(val) != int:
+            if type(val) == float:
+                self.kind = 'float'
+                self.values = array.array('d', self.values)
             else:
-                try:
-                    cols.append(read.opt(field[5:]))
-                except KeyError:
-                    cols.append('')
+                self._to_str()
+        elif self.kind == 'float' and type(val) not in (int, float):
+            self._to_str()
+
+        if self.kind == 'str':
+            self.codes.append(self._encode(str(val)))
+        else:
+            self.values.append(val)
+
+    def arrays(self, name):
+        if self.kind == 'str':
+            codes = numpy.frombuffer(self.codes, dtype='i%s' % self.codes.itemsize).astype(numpy.int32)
+            return [(name, codes), ('%s.values' % name, numpy.array(self.strings, dtype=str))]
+        elif self.kind is None:
+            return [(name, numpy.zeros(0, dtype=numpy.int64))]
+        elif self.kind == 'int':
+            return [(name, numpy.frombuffer(self.values, dtype='i%s' % self.values.itemsize))]
+        return [(name, numpy.frombuffer(self.values, dtype=numpy.float64))]
+
 
-    out.write('%s\n' % '\t'.join([str(x) for x in cols]))
+def column_name(field):
+    'Column name for a field: -pos => pos, -tag:AS => tag_AS'
+    return field.lstrip('-').replace(':', '_')
+
+
+def bam_export_columns(bam, outname, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, quiet=False):
+    '''
+    Exports fields as binary (NumPy) columns. If outname ends with .npz, all
+    of the columns are saved to one file, otherwise outname is a directory
+    with one {column}.npy file per column. String columns are
+    dictionary-encoded: {column} holds int32 codes and {column}.values holds
+    the unique strings.
+    '''
+    if numpy is None:
+        raise RuntimeError('Columnar output requires NumPy')
+    if '-tag:*' in fields:
+        raise ValueError('-tag:* can not be used with columnar output')
+
+    extractors = compile_fields(bam, fields)
+    columns = [_Column() for field in fields]
+    cols = zip(extractors, columns)
+
+    for read in _export_iter(bam, mapped, unmapped, whitelist, blacklist, quiet):
+        for func, col in cols:
+            col.add(func(read))
+
+    arrays = []
+    for field, col in zip(fields, columns):
+        arrays.extend(col.arrays(column_name(field)))
+
+    if outname.endswith('.npz'):
+        numpy.savez(outname, **dict(arrays))
+    else:
+        if not os.path.exists(outname):
+            os.makedirs(outname)
+        for name, arr in arrays:
+            numpy.save(os.path.join(outname, '%s.npy' % name), arr)
 
 
 def usage():
@@ -106,6 +266,12 @@ Options:
 
   -whitelist file.txt  Output only reads that are listed in a text file
   -blacklist file.txt  Output only reads that are not listed in a text file
+                       (or a name index, see: bamutils nameindex)
+
+  -columns out         Write binary columns instead of text (requires NumPy)
+                       If {out} ends with .npz, all columns are written to
+                       one file, otherwise {out} is a directory with one
+                       .npy file per column.
 
 Fields:
   -name          Read name
@@ -138,6 +304,7 @@ if __name__ == "__main__":
     wl = None
     bl = None
     last = None
+    columns = None
     fields = []
 
     for arg in sys.argv[1:]:
@@ -145,17 +312,18 @@ if __name__ == "__main__":
             if not os.path.exists(arg):
                 print "Error: %s missing!" % arg
                 usage()
-            with open(arg) as f:
-                wl = [x.strip() for x in f]
+            wl = load_name_set(arg)
             last = None
         elif last == '-blacklist':
             if not os.path.exists(arg):
                 print "Error: %s missing!" % arg
                 usage()
-            with open(arg) as f:
-                bl = [x.strip() for x in f]
+            bl = load_name_set(arg)
+            last = None
+        elif last == '-columns':
+            columns = arg
             last = None
-        elif arg in ['-blacklist', '-whitelist']:
+        elif arg in ['-blacklist', '-whitelist', '-columns']:
             last = arg
         elif arg == '-h':
             usage()
@@ -179,5 +347,18 @@ if __name__ == "__main__":
         mapped = True
 
     bamfile = bam_open(fname)
-    bam_export(bamfile, mapped, unmapped, wl, bl, fields)
+    try:
+        compile_fields(bamfile, fields)
+    except ValueError, e:
+        bamfile.close()
+        print "Error: %s\n" % e
+        usage()
+
+    if columns:
+        if numpy is None:
+            print "Error: -columns requires NumPy"
+            usage()
+        bam_export_columns(bamfile, columns, mapped, unmapped, wl, bl, fields)
+    else:
+        bam_export(bamfile, mapped, unmapped, wl, bl, fields)
     bamfile.close()
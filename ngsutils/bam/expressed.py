@@ -8,21 +8,19 @@ This will scan a BAM file, looking for regions of mapped reads. The found
 regions are output in BED format. These regions are found in a model-free
 manner, so they may represent novel or known transcripts. This is also helpful
 for peak-finding in ChIP-seq experiments.
+
+Regions are found from the aligned blocks of each read (deletions and
+skipped/intron regions aren't counted as covered).
 '''
 import sys
 import os
-from ngsutils.bam import bam_pileup_iter, bam_open
-
-import pysam
+import heapq
+from ngsutils.bam import bam_iter, bam_open, bam_map_refs
 
 
 class ExpressedRegion(object):
-    _count = 0
-
-    def __init__(self, chrom, only_uniq_starts=False):
-        ExpressedRegion._count += 1
-        self.name = 'region_%s' % ExpressedRegion._count
-
+    def __init__(self, chrom, only_uniq_starts=False, num=0):
+        self.num = num
         self.chrom = chrom
         self.start = None
         self.end = None
@@ -35,33 +33,45 @@ class ExpressedRegion(object):
         self.only_uniq_starts = only_uniq_starts
         self.uniq_starts = set()
 
-    def add_column(self, read, pos):
-        if not self.start:
-            self.start = pos
-        if not self.end or pos >= self.end:
-            self.end = pos + 1
-
-        if not read.alignment.qname in self.reads:
-            self.reads.add(read.alignment.qname)
+    @property
+    def name(self):
+        return 'region_%s' % self.num
+
+    def add_block(self, read, start, end):
+        '''
+        Adds an aligned block [start, end) of a read to the region. Blocks must
+        be added in order of their start positions.
+        '''
+        if self.start is None:
+            self.start = start
+        if self.end is None or end > self.end:
+            self.end = end
+
+        if not read.qname in self.reads:
+            self.reads.add(read.qname)
             self.read_count += 1
 
             if self.only_uniq_starts:
-                if not read.alignment.is_reverse:
-                    if not read.alignment.pos in self.uniq_starts:
-                        self.uniq_starts.add(read.alignment.pos)
+                if not read.is_reverse:
+                    if not read.pos in self.uniq_starts:
+                        self.uniq_starts.add(read.pos)
                         self.fwd_count += 1
                 else:
-                    if not read.alignment.aend in self.uniq_starts:
-                        self.uniq_starts.add(read.alignment.aend)
+                    if not read.aend in self.uniq_starts:
+                        self.uniq_starts.add(read.aend)
                         self.rev_count += 1
 
             else:
-                if read.alignment.is_reverse:
+                if read.is_reverse:
                     self.rev_count += 1
                 else:
                     self.fwd_count += 1
 
-    def write(self, fs):
+    def add_column(self, read, pos):
+        'Adds a pileup read at pos'
+        self.add_block(read.alignment, pos, pos + 1)
+
+    def cols(self):
         cols = []
         cols.append(self.chrom)
         cols.append(str(self.start))
@@ -77,40 +87,129 @@ class ExpressedRegion(object):
         else:
             cols.append('-')
 
-        fs.write('\t'.join(cols))
-        fs.write('\n')
+        return cols
 
+    def write(self, fs):
+        fs.write('\t'.join(self.cols()))
+        fs.write('\n')
 
-def bam_find_regions(bam_name, merge_distance=10, min_read_count=2, only_uniq_starts=False, nostrand=False, out=sys.stdout):
-    bamfile = bam_open(bam_name)
-    region_plus = None
-    region_minus = None
-
-    for pileup in bam_pileup_iter(bamfile, mask=1540):
-        chrom = bamfile.getrname(pileup.tid)
-
-        for read in pileup.pileups:
-            if read.is_del:
-                continue
-            if nostrand or not read.alignment.is_reverse:
-                if not region_plus or region_plus.chrom != chrom or (region_plus.end + merge_distance) < pileup.pos:
-                    if region_plus and region_plus.read_count >= min_read_count:
-                        region_plus.write(out)
-
-                    region_plus = ExpressedRegion(chrom, only_uniq_starts)
-                region_plus.add_column(read, pileup.pos)
-            else:
-                if not region_minus or region_minus.chrom != chrom or (region_minus.end + merge_distance) < pileup.pos:
-                    if region_minus and region_minus.read_count >= min_read_count:
-                        region_minus.write(out)
 
-                    region_minus = ExpressedRegion(chrom, only_uniq_starts)
-                region_minus.add_column(read, pileup.pos)
+def read_blocks(read):
+    '''
+    Yields the (start, end) of each aligned block in a read (M, =, X). Deletions
+    and skipped regions (N) aren't included.
+    '''
+    pos = read.pos
+    for op, size in read.cigar:
+        if op in [0, 7, 8]:
+            yield pos, pos + size
+            pos += size
+        elif op in [2, 3]:
+            pos += size
+
+
+def find_regions(reads, references, merge_distance=10, min_read_count=2, only_uniq_starts=False, nostrand=False, counter=None):
+    '''
+    Finds expressed regions from (coordinate sorted) reads. Regions are built
+    directly from the aligned blocks of each read, without a pileup. Blocks are
+    kept in a heap until the reads have passed their start position, so they
+    are added to regions in order.
+
+    Yields ExpressedRegion objects (numbered in the order they were started)
+    with at least min_read_count reads. If counter (a list) is given,
+    counter[0] is the number of regions started so far.
+    '''
+    regions = {True: None, False: None}  # keyed by is_plus
+    blocks = []
+    if counter is None:
+        counter = [0]
+
+    def _add_block(start, end, idx, read):
+        is_plus = nostrand or not read.is_reverse
+        region = regions[is_plus]
+        chrom = references[read.tid]
+        if not region or region.chrom != chrom or (region.end + merge_distance) < start:
+            if region and region.read_count >= min_read_count:
+                done.append(region)
+
+            counter[0] += 1
+            region = ExpressedRegion(chrom, only_uniq_starts, counter[0])
+            regions[is_plus] = region
+
+        region.add_block(read, start, end)
+
+    done = []
+    idx = 0
+    last_tid = None
+
+    for read in reads:
+        if read.is_unmapped or read.flag & 1540 or not read.cigar:
+            continue
+
+        if read.tid != last_tid:
+            while blocks:
+                _add_block(*heapq.heappop(blocks))
+
+            # regions can't continue on the next reference
+            for is_plus in [True, False]:
+                if regions[is_plus] and regions[is_plus].read_count >= min_read_count:
+                    done.append(regions[is_plus])
+                regions[is_plus] = None
+            last_tid = read.tid
+
+        while blocks and blocks[0][0] <= read.pos:
+            _add_block(*heapq.heappop(blocks))
+
+        for start, end in read_blocks(read):
+            heapq.heappush(blocks, (start, end, idx, read))
+            idx += 1
+
+        for region in done:
+            yield region
+        done = []
+
+    while blocks:
+        _add_block(*heapq.heappop(blocks))
+
+    for region in done:
+        yield region
+
+    for is_plus in [True, False]:
+        if regions[is_plus] and regions[is_plus].read_count >= min_read_count:
+            yield regions[is_plus]
+
+
+def _find_regions_ref(fname, ref, merge_distance, min_read_count, only_uniq_starts, nostrand):
+    '''
+    Finds the regions for one reference (for parallel processing). Returns the
+    number of regions started and the regions as (num, cols), numbered from 1
+    for this reference.
+    '''
+    bamfile = bam_open(fname)
+    counter = [0]
+    regions = [(region.num, region.cols()) for region in find_regions(bam_iter(bamfile, ref=ref, quiet=True), bamfile.references, merge_distance, min_read_count, only_uniq_starts, nostrand, counter)]
+    bamfile.close()
+    return counter[0], regions
+
+
+def bam_find_regions(bam_name, merge_distance=10, min_read_count=2, only_uniq_starts=False, nostrand=False, out=sys.stdout, procs=1):
+    '''
+    If procs > 1, each reference is processed in parallel (requires an indexed
+    BAM file).
+    '''
+    if procs > 1:
+        offset = 0
+        for count, regions in bam_map_refs(bam_name, _find_regions_ref, procs, None, merge_distance, min_read_count, only_uniq_starts, nostrand):
+            for num, cols in regions:
+                cols[3] = 'region_%s' % (num + offset)
+                out.write('\t'.join(cols))
+                out.write('\n')
+            offset += count
+        return
 
-    if region_plus and region_plus.read_count >= min_read_count:
-        region_plus.write(out)
-    if region_minus and region_minus.read_count >= min_read_count:
-        region_minus.write(out)
+    bamfile = bam_open(bam_name)
+    for region in find_regions(bam_iter(bamfile), bamfile.references, merge_distance, min_read_count, only_uniq_starts, nostrand):
+        region.write(out)
 
     bamfile.close()
 
@@ -133,6 +232,9 @@ Options:
 
 -mincount N     The minimum number of reads required in a region
                 (default: 2)
+
+-p N            Process each reference in parallel using N processes
+                (requires an indexed BAM file)
 """
     sys.exit(1)
 
@@ -143,9 +245,13 @@ if __name__ == "__main__":
     fname = None
     last = None
     nostrand = False
+    procs = 1
 
     for arg in sys.argv[1:]:
-        if last == '-dist':
+        if last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-dist':
             dist = int(arg)
             last = None
         elif last == '-mincount':
@@ -157,7 +263,7 @@ if __name__ == "__main__":
             uniq = True
         elif arg == '-ns':
             nostrand = True
-        elif arg in ['-dist', '-mincount']:
+        elif arg in ['-dist', '-mincount', '-p']:
             last = arg
         elif not fname and os.path.exists(arg):
             fname = arg
@@ -167,4 +273,8 @@ if __name__ == "__main__":
     if not fname:
         usage()
 
-    bam_find_regions(fname, dist, mincount, uniq, nostrand)
+    if procs > 1 and not os.path.exists('%s.bai' % fname):
+        print '-p requires an indexed BAM file'
+        usage()
+
+    bam_find_regions(fname, dist, mincount, uniq, nostrand, procs=procs)
@@ -16,10 +16,15 @@ This tends to be faster than running 'bamutils filter' because this extracts
 reads from a region, without iterating over all of the reads in the BAM file.
 But, if you are already filtering the BAM file for other criteria, it is
 probably worth it to just to the filtering with your other criteria.
+
+Overlapping and nearby BED regions are merged into windows before reading the
+BAM file, so each read is only read (and written) once. Reads are written in
+coordinate order.
 """
 
 import os
 import sys
+import tempfile
 from eta import ETA
 import pysam
 
@@ -33,33 +38,91 @@ def usage():
 Usage: bamutils extract {opts} in.bam out.bam regions.bed
 
 Options:
-  -ns    Ignore strandedness of reads and regions
+  -ns        Ignore strandedness of reads and regions
+  -p num     Extract reads using {num} processes
+  -T dir     Temporary directory for -p (default: same as out.bam)
 """
     sys.exit(1)
 
 
+def extract_windows(bed, merge_distance=0):
+    '''
+    Merges the BED regions into the minimal set of windows to fetch from
+    the BAM file. Regions that overlap or are within merge_distance of each
+    other are fetched together.
+
+    Returns a list of (chrom, start, end), sorted by chrom and start.
+    '''
+    regions = sorted([(region.chrom, region.start, region.end) for region in bed])
+    windows = []
+    for chrom, start, end in regions:
+        if windows and windows[-1][0] == chrom and start <= windows[-1][2] + merge_distance:
+            if end > windows[-1][2]:
+                windows[-1][2] = end
+        else:
+            windows.append([chrom, start, end])
+
+    return [tuple(x) for x in windows]
+
+
+def read_matches_bed(read, chrom, bed, nostrand=False):
+    '''
+    Does any fragment of the read touch a BED region (on the same strand)?
+    '''
+    if nostrand:
+        strand = None
+    else:
+        strand = '-' if read.is_reverse else '+'
+
+    for frag_start, frag_end in read_alignment_fragments_gen(read):
+        for region in bed.fetch(chrom, frag_start, frag_end):
+            if strand is None or region.strand is None or region.strand == strand:
+                return True
+    return False
+
+
+def window_reads(inbam, bed, chrom, start, end, prev_end=None, nostrand=False):
+    '''
+    Yields the reads in a window that match a BED region. Reads that were
+    also in the previous window (on the same chrom) aren't returned, so each
+    read is only returned once, in coordinate order.
+    '''
+    for read in inbam.fetch(chrom, start, end):
+        if prev_end is not None and read.pos < prev_end:
+            continue
+        if read_matches_bed(read, chrom, bed, nostrand):
+            yield read
+
+
+def _window_prev_ends(windows):
+    prev_ends = []
+    last = None
+    for chrom, start, end in windows:
+        if last and last[0] == chrom:
+            prev_ends.append(last[2])
+        else:
+            prev_ends.append(None)
+        last = (chrom, start, end)
+    return prev_ends
+
+
 def bam_extract(inbam, outbam, bedfile, nostrand=False, quiet=False):
     bed = BedFile(bedfile)
+    windows = [x for x in extract_windows(bed) if x[0] in inbam.references]
+    prev_ends = _window_prev_ends(windows)
+
     if not quiet:
-        eta = ETA(os.stat(bedfile).st_size, fileobj=bed)
+        eta = ETA(len(windows))
     else:
         eta = None
 
     passed = 0
 
-    for region in bed:
+    for i, (chrom, start, end) in enumerate(windows):
         if eta:
-            eta.print_status(extra="extracted:%s" % (passed))
+            eta.print_status(i, extra="extracted:%s" % (passed))
 
-        if not region.chrom in inbam.references:
-            continue
-
-        if not nostrand:
-            strand = region.strand
-        else:
-            strand = None
-
-        for read in bam_extract_reads(inbam, region.chrom, region.start, region.end, strand):
+        for read in window_reads(inbam, bed, chrom, start, end, prev_ends[i], nostrand):
             outbam.write(read)
             passed += 1
 
@@ -68,6 +131,83 @@ def bam_extract(inbam, outbam, bedfile, nostrand=False, quiet=False):
         sys.stderr.write("%s extracted\n" % (passed,))
 
 
+_worker_state = None
+
+
+def _extract_worker_init(infile, bedfile, nostrand, tmpdir):
+    global _worker_state
+    _worker_state = (pysam.Samfile(infile, "rb"), BedFile(bedfile), nostrand, tmpdir)
+
+
+def _extract_worker(jobs):
+    inbam, bed, nostrand, tmpdir = _worker_state
+    tmp = tempfile.NamedTemporaryFile(prefix='.tmp.extract', suffix='.bam', dir=tmpdir, delete=False)
+    tmp.close()
+
+    count = 0
+    outbam = pysam.Samfile(tmp.name, "wb", template=inbam)
+    for chrom, start, end, prev_end in jobs:
+        for read in window_reads(inbam, bed, chrom, start, end, prev_end, nostrand):
+            outbam.write(read)
+            count += 1
+    outbam.close()
+    return tmp.name, count
+
+
+def bam_extract_parallel(infile, outfile, bedfile, nostrand=False, procs=2, tmpdir=None, batch_size=1000, quiet=False):
+    '''
+    Extracts reads using a pool of worker processes. Windows are split into
+    batches; each batch is written to a temporary BAM file and the batches are
+    concatenated in order.
+    '''
+    import multiprocessing
+
+    if not tmpdir:
+        tmpdir = os.path.dirname(os.path.abspath(outfile))
+
+    inbam = pysam.Samfile(infile, "rb")
+    references = set(inbam.references)
+    inbam.close()
+
+    windows = [x for x in extract_windows(BedFile(bedfile)) if x[0] in references]
+    prev_ends = _window_prev_ends(windows)
+    jobs = [(chrom, start, end, prev_ends[i]) for i, (chrom, start, end) in enumerate(windows)]
+    batches = [jobs[i:i + batch_size] for i in xrange(0, len(jobs), batch_size)]
+
+    parts = []
+    passed = 0
+    eta = ETA(len(batches)) if not quiet else None
+
+    pool = multiprocessing.Pool(procs, _extract_worker_init, (infile, bedfile, nostrand, tmpdir))
+    try:
+        for i, (partname, count) in enumerate(pool.imap(_extract_worker, batches)):
+            parts.append(partname)
+            passed += count
+            if eta:
+                eta.print_status(i + 1, extra="extracted:%s" % (passed))
+        pool.close()
+
+        if parts:
+            pysam.cat('-o', outfile, *parts)
+        else:
+            inbam = pysam.Samfile(infile, "rb")
+            pysam.Samfile(outfile, "wb", template=inbam).close()
+            inbam.close()
+
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for partname in parts:
+            if os.path.exists(partname):
+                os.unlink(partname)
+
+    if eta:
+        eta.done()
+        sys.stderr.write("%s extracted\n" % (passed,))
+
+
 def bam_extract_reads(bamfile, chrom, start, end, strand=None):
     for read in bamfile.fetch(chrom, start, end):
         if strand is None or (read.is_reverse and strand == '-') or (not read.is_reverse and strand == '+'):
@@ -86,10 +226,21 @@ if __name__ == '__main__':
     outfile = None
     bedfile = None
     nostrand = False
+    procs = 1
+    tmpdir = None
+    last = None
 
     for arg in sys.argv[1:]:
         if arg == '-h':
             usage()
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif arg in ['-p', '-T']:
+            last = arg
         elif arg == '-ns':
             nostrand = True
         elif not infile and os.path.exists(arg):
@@ -104,6 +255,8 @@ if __name__ == '__main__':
 
     if not infile or not outfile or not bedfile:
         usage()
+    elif procs > 1:
+        bam_extract_parallel(infile, outfile, bedfile, nostrand, procs, tmpdir)
     else:
         inbam = pysam.Samfile(infile, "rb")
         outbam = pysam.Samfile(outfile, "wb", template=inbam)
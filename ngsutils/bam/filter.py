@@ -84,7 +84,8 @@ Currently, the available filters are:
     -whitelist fname           Remove reads that aren't on this list (by name)
     -blacklist fname           Remove reads that are on this list (by name)
                                  These lists can be whitespace-delimited with
-                                 the read name as the first column.
+                                 the read name as the first column, or a
+                                 name index (see: bamutils nameindex).
     -maximum_mismatch_ratio val
                                Filter by maximum mismatch ratio (fraction of length)
 
@@ -110,11 +111,14 @@ Common tags to filter by:
 
 import os
 import sys
+import time
 import pysam
 from ngsutils.bam import bam_iter
 from ngsutils.support.dbsnp import DBSNP
 from ngsutils.bam import read_calc_mismatches, read_calc_mismatches_ref, read_calc_mismatches_gen, read_calc_variations
 from ngsutils.bed import BedFile
+from ngsutils.support.nameset import load_name_set
+from ngsutils.support.refcache import RefCache
 
 
 def usage():
@@ -125,6 +129,8 @@ Usage: bamutils filter in.bam out.bam {-failed out.txt} criteria...
 Options:
   -failed fname    A text file containing the read names of all reads
                    that were removed with filtering
+  -timing          Report the time spent (and reads removed) by each
+                   criterion
 
 Example:
 bamutils filter filename.bam output.bam -mapped -gte AS:i 1000
@@ -136,6 +142,8 @@ value less than 1000.
 
 
 class Unique(object):
+    stateful = True
+
     def __init__(self, length=None):
         if length:
             self.length = int(length)
@@ -172,6 +180,8 @@ class Unique(object):
 
 
 class UniqueStart(object):
+    stateful = True
+
     def __init__(self):
         self.last_tid = None
         self.last_fwd_pos = -1
@@ -229,10 +239,7 @@ class UniqueStart(object):
 class Blacklist(object):
     def __init__(self, fname):
         self.fname = fname
-        self.notallowed = set()
-        with open(fname) as f:
-            for line in f:
-                self.notallowed.add(line.strip().split()[0])
+        self.notallowed = load_name_set(fname)
 
     def filter(self, bam, read):
         return read.qname not in self.notallowed
@@ -247,10 +254,7 @@ class Blacklist(object):
 class Whitelist(object):
     def __init__(self, fname):
         self.fname = fname
-        self.allowed = set()
-        with open(fname) as f:
-            for line in f:
-                self.allowed.add(line.strip().split()[0])
+        self.allowed = load_name_set(fname)
 
     def filter(self, bam, read):
         return read.qname in self.allowed
@@ -263,6 +267,7 @@ class Whitelist(object):
 
 
 class IncludeRegion(object):
+    stateful = True
     _excludes = []
     _last = None
 
@@ -454,6 +459,30 @@ class Mismatch(object):
         pass
 
 
+def _is_sorted(bam):
+    'Are the reads in bam sorted by position (according to the header)?'
+    try:
+        return bam.header.get('HD', {}).get('SO') == 'coordinate'
+    except AttributeError:
+        return False
+
+
+def _ref_cache(bam, refname):
+    '''
+    Reference lookups for the reads in bam. Reading ahead only helps if the
+    reads are sorted by position, otherwise each read is fetched on its own.
+    '''
+    return RefCache(refname, window=1000000 if _is_sorted(bam) else 0)
+
+
+def _dbsnp(bam, fname):
+    '''
+    dbSNP lookups for the reads in bam. SNPs are only loaded in blocks if the
+    reads are sorted by position, otherwise each position is queried.
+    '''
+    return DBSNP(fname, window=1000000 if _is_sorted(bam) else 0)
+
+
 class MismatchRef(object):
     def __init__(self, num, refname):
         self.num = int(num)
@@ -462,12 +491,15 @@ class MismatchRef(object):
         if not os.path.exists('%s.fai' % refname):
             pysam.faidx(refname)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = None
 
     def filter(self, bam, read):
         if read.is_unmapped:
             return False
 
+        if self.ref is None:
+            self.ref = _ref_cache(bam, self.refname)
+
         chrom = bam.getrname(read.tid)
         if read_calc_mismatches_ref(self.ref, read, chrom) > self.num:
             return False
@@ -478,16 +510,19 @@ class MismatchRef(object):
         return '>%s mismatch%s in %s' % (self.num, '' if self.num == 1 else 'es', os.path.basename(self.refname))
 
     def close(self):
-        self.ref.close()
+        if self.ref:
+            self.ref.close()
 
 
 class MismatchDbSNP(object):
+    modifies_read = True
+
     def __init__(self, num, fname, verbose=None):
         sys.stderr.write('Note: MismatchDbSNP is considered *experimental*\n')
 
         self.num = int(num)
         self.fname = fname
-        self.dbsnp = DBSNP(fname)
+        self.dbsnp = None
         if verbose == 'verbose':
             self.verbose = True
         else:
@@ -500,6 +535,9 @@ class MismatchDbSNP(object):
         if read_calc_mismatches(read) <= self.num:
             return True
 
+        if self.dbsnp is None:
+            self.dbsnp = _dbsnp(bam, self.fname)
+
         chrom = bam.getrname(read.tid)
 
         mm = 0
@@ -523,25 +561,33 @@ class MismatchDbSNP(object):
         return '>%s mismatch%s using %s' % (self.num, '' if self.num == 1 else 'es', os.path.basename(self.fname))
 
     def close(self):
-        self.dbsnp.close()
+        if self.dbsnp:
+            self.dbsnp.close()
 
 
 class MismatchRefDbSNP(object):
+    modifies_read = True
+
     def __init__(self, num, refname, dbsnpname):
         sys.stderr.write('Note: MismatchRefDbSNP is considered *experimental*\n')
         self.num = int(num)
         self.refname = refname
-        self.dbsnp = DBSNP(dbsnpname)
+        self.dbsnpname = dbsnpname
+        self.dbsnp = None
 
         if not os.path.exists('%s.fai' % refname):
             pysam.faidx(refname)
 
-        self.ref = pysam.Fastafile(refname)
+        self.ref = None
 
     def filter(self, bam, read):
         if read.is_unmapped:
             return False
 
+        if self.ref is None:
+            self.ref = _ref_cache(bam, self.refname)
+            self.dbsnp = _dbsnp(bam, self.dbsnpname)
+
         chrom = bam.getrname(read.tid)
 
         mm = 0
@@ -565,8 +611,10 @@ class MismatchRefDbSNP(object):
         return '>%s mismatch%s using %s/%s' % (self.num, '' if self.num == 1 else 'es', os.path.basename(self.dbsnpname), os.path.basename(self.refname))
 
     def close(self):
-        self.ref.close()
-        self.dbsnp.close()
+        if self.ref:
+            self.ref.close()
+        if self.dbsnp:
+            self.dbsnp.close()
 
 
 class Mapped(object):
@@ -574,9 +622,12 @@ class Mapped(object):
         pass
 
     def filter(self, bam, read):
-        if read.is_paired and (read.is_unmapped or read.mate_is_unmapped):
+        return self.flag_filter(read.flag)
+
+    def flag_filter(self, flag):
+        if flag & 0x1 and flag & 0xC:
             return False
-        elif read.is_unmapped:
+        elif flag & 0x4:
             return False
         return True
 
@@ -592,9 +643,12 @@ class Unmapped(object):
         pass
 
     def filter(self, bam, read):
-        if read.is_paired and (read.is_unmapped or read.mate_is_unmapped):
+        return self.flag_filter(read.flag)
+
+    def flag_filter(self, flag):
+        if flag & 0x1 and flag & 0xC:
             return True
-        elif read.is_unmapped:
+        elif flag & 0x4:
             return True
         return False
 
@@ -610,16 +664,19 @@ class ProperPair(object):
         pass
 
     def filter(self, bam, read):
-        if not read.is_paired:
+        return self.flag_filter(read.flag)
+
+    def flag_filter(self, flag):
+        if not flag & 0x1:
             return False
 
-        if read.is_unmapped or read.mate_is_unmapped:
+        if flag & 0xC:
             return False
 
-        if read.is_reverse == read.mate_is_reverse:
+        if bool(flag & 0x10) == bool(flag & 0x20):
             return False
 
-        return read.is_proper_pair
+        return bool(flag & 0x2)
 
     def __repr__(self):
         return 'proper pair'
@@ -636,6 +693,9 @@ class NoProperPair(object):
     def filter(self, bam, read):
         return not self.proper.filter(bam, read)
 
+    def flag_filter(self, flag):
+        return not self.proper.flag_filter(flag)
+
     def __repr__(self):
         return 'not proper pairs'
 
@@ -657,7 +717,10 @@ class MaskFlag(object):
         return "Doesn't match flag: %s" % self.flag
 
     def filter(self, bam, read):
-        return (read.flag & self.flag) == 0
+        return self.flag_filter(read.flag)
+
+    def flag_filter(self, flag):
+        return (flag & self.flag) == 0
 
     def close(self):
         pass
@@ -670,6 +733,9 @@ class SecondaryFlag(object):
     def filter(self, bam, read):
         return not read.is_secondary
 
+    def flag_filter(self, flag):
+        return not flag & 0x100
+
     def close(self):
         pass
 
@@ -682,7 +748,10 @@ class ReadMinLength(object):
         return "read length min: %s" % self.minval
 
     def filter(self, bam, read):
-        return len(read.seq) >= self.minval
+        return self.length_filter(len(read.seq))
+
+    def length_filter(self, length):
+        return length >= self.minval
 
     def close(self):
         pass
@@ -696,7 +765,10 @@ class ReadMaxLength(object):
         return "read length max: %s" % self.val
 
     def filter(self, bam, read):
-        return len(read.seq) <= self.val
+        return self.length_filter(len(read.seq))
+
+    def length_filter(self, length):
+        return length <= self.val
 
     def close(self):
         pass
@@ -723,6 +795,9 @@ class QCFailFlag(object):
     def filter(self, bam, read):
         return not read.is_qcfail
 
+    def flag_filter(self, flag):
+        return not flag & 0x200
+
     def close(self):
         pass
 
@@ -734,6 +809,9 @@ class PCRDupFlag(object):
     def filter(self, bam, read):
         return not read.is_duplicate
 
+    def flag_filter(self, flag):
+        return not flag & 0x400
+
     def close(self):
         pass
 
@@ -775,6 +853,9 @@ class _TagCompare(object):
 
         return None
 
+    def filter(self, bam, read):
+        return self.check(self.get_value(read))
+
     def __repr__(self):
         return "%s %s %s" % (self.tag, self.__class__.op, self.value)
 
@@ -785,8 +866,8 @@ class _TagCompare(object):
 class TagLessThan(_TagCompare):
     op = '<'
 
-    def filter(self, bam, read):
-        if self.get_value(read) < self.value:
+    def check(self, value):
+        if value < self.value:
             return True
         return False
 
@@ -794,8 +875,8 @@ class TagLessThan(_TagCompare):
 class TagLessThanEqual(_TagCompare):
     op = '<='
 
-    def filter(self, bam, read):
-        if self.get_value(read) <= self.value:
+    def check(self, value):
+        if value <= self.value:
             return True
         return False
 
@@ -803,8 +884,8 @@ class TagLessThanEqual(_TagCompare):
 class TagGreaterThan(_TagCompare):
     op = '>'
 
-    def filter(self, bam, read):
-        if self.get_value(read) > self.value:
+    def check(self, value):
+        if value > self.value:
             return True
         return False
 
@@ -812,8 +893,8 @@ class TagGreaterThan(_TagCompare):
 class TagGreaterThanEqual(_TagCompare):
     op = '>='
 
-    def filter(self, bam, read):
-        if self.get_value(read) >= self.value:
+    def check(self, value):
+        if value >= self.value:
             return True
         return False
 
@@ -821,11 +902,221 @@ class TagGreaterThanEqual(_TagCompare):
 class TagEqual(_TagCompare):
     op = '='
 
-    def filter(self, bam, read):
-        if self.get_value(read) == self.value:
+    def check(self, value):
+        if value == self.value:
             return True
         return False
 
+class _Stage(object):
+    '''
+    One step in a compiled criteria chain. A stage holds one or more criteria
+    (as (index, criterion) tuples, where index is the command-line order).
+
+    check() returns None if the read passes all of the criteria in this stage,
+    otherwise it returns the index of the first failing criterion.
+    '''
+    def __init__(self, members):
+        self.members = members
+        self.calls = 0
+        self.rejects = 0
+        self.sampled = 0
+        self.elapsed = 0.0
+
+    @property
+    def cost(self):
+        if not self.sampled:
+            return 0.0
+        return self.elapsed / self.sampled
+
+    @property
+    def rank(self):
+        # Expected cost per rejected read (lower is better). Rejection rates
+        # are smoothed so that new stages aren't penalized.
+        return self.cost / (float(self.rejects + 1) / (self.calls + 2))
+
+    def __repr__(self):
+        return ', '.join([str(c) for i, c in self.members])
+
+
+class _FlagStage(_Stage):
+    '''
+    All flag-only criteria fused into one lookup. The result for each distinct
+    flag value is computed once and cached.
+    '''
+    def __init__(self, members):
+        _Stage.__init__(self, members)
+        self._cache = {}
+
+    def check(self, bam, read):
+        flag = read.flag
+        try:
+            return self._cache[flag]
+        except KeyError:
+            result = None
+            for idx, criterion in self.members:
+                if not criterion.flag_filter(flag):
+                    result = idx
+                    break
+            self._cache[flag] = result
+            return result
+
+
+class _LengthStage(_Stage):
+    '''
+    All read-length criteria fused into one min/max range check.
+    '''
+    def __init__(self, members):
+        _Stage.__init__(self, members)
+        self.minval = max([c.minval for i, c in members if isinstance(c, ReadMinLength)] or [0])
+        maxvals = [c.val for i, c in members if isinstance(c, ReadMaxLength)]
+        self.maxval = min(maxvals) if maxvals else None
+
+    def check(self, bam, read):
+        length = len(read.seq)
+        if length >= self.minval and (self.maxval is None or length <= self.maxval):
+            return None
+
+        for idx, criterion in self.members:
+            if not criterion.length_filter(length):
+                return idx
+
+
+class _TagStage(_Stage):
+    '''
+    All tag comparisons fused so that the read tags are only scanned once.
+    '''
+    def check(self, bam, read):
+        # reversed, so that the first occurrence of a tag wins (like get_value)
+        values = dict(reversed(read.tags))
+        for idx, criterion in self.members:
+            if criterion.tag == 'MAPQ':
+                value = read.mapq
+            else:
+                value = values.get(criterion.tag)
+            if not criterion.check(value):
+                return idx
+        return None
+
+
+class _SingleStage(_Stage):
+    def check(self, bam, read):
+        idx, criterion = self.members[0]
+        if criterion.filter(bam, read):
+            return None
+        return idx
+
+
+class CompiledCriteria(object):
+    '''
+    Compiles a list of criteria into a single predicate.
+
+    Flag, length, and tag criteria are fused into one stage each. The stages
+    are then re-ordered as reads are processed, using the measured cost and
+    rejection rate of each stage, so that cheap criteria that remove many
+    reads are checked first.
+
+    Stateful criteria (uniq, uniq_start, include) depend on which reads they
+    see, and criteria that modify the read (adding tags) change what later
+    criteria see, so neither is ever moved or fused -- stages are only fused
+    and re-ordered between them.
+
+    If exact is True, the criterion returned for a failed read is the first
+    failing criterion in the original (command-line) order, so the failed
+    reads log is the same as checking each criterion in order.
+    '''
+    def __init__(self, criteria, exact=True, reorder_interval=10000, sample_rate=16):
+        self.criteria = criteria
+        self.exact = exact
+        self.reorder_interval = reorder_interval
+        self.sample_rate = sample_rate
+        self._count = 0
+
+        self.segments = []
+        segment = []
+        for idx, criterion in enumerate(criteria):
+            if getattr(criterion, 'stateful', False) or getattr(criterion, 'modifies_read', False):
+                if segment:
+                    self.segments.append(self._compile(segment))
+                self.segments.append([_SingleStage([(idx, criterion)])])
+                segment = []
+            else:
+                segment.append((idx, criterion))
+
+        if segment:
+            self.segments.append(self._compile(segment))
+
+    def _compile(self, members):
+        flags = []
+        lengths = []
+        tags = []
+        stages = []
+
+        for idx, criterion in members:
+            if hasattr(criterion, 'flag_filter'):
+                flags.append((idx, criterion))
+            elif hasattr(criterion, 'length_filter'):
+                lengths.append((idx, criterion))
+            elif isinstance(criterion, _TagCompare):
+                tags.append((idx, criterion))
+            else:
+                stages.append(_SingleStage([(idx, criterion)]))
+
+        fused = []
+        if flags:
+            fused.append(_FlagStage(flags))
+        if lengths:
+            fused.append(_LengthStage(lengths))
+        if tags:
+            fused.append(_TagStage(tags))
+
+        return fused + stages
+
+    def _reorder(self):
+        for segment in self.segments:
+            if len(segment) > 1:
+                segment.sort(key=lambda stage: stage.rank)
+
+    def filter(self, bam, read):
+        '''
+        Returns None if the read passes all criteria, otherwise the criterion
+        that removed the read.
+        '''
+        self._count += 1
+        if self._count % self.reorder_interval == 0:
+            self._reorder()
+
+        timed = self._count % self.sample_rate == 0
+
+        for segment in self.segments:
+            for i, stage in enumerate(segment):
+                stage.calls += 1
+                if timed:
+                    start = time.time()
+                    idx = stage.check(bam, read)
+                    stage.elapsed += time.time() - start
+                    stage.sampled += 1
+                else:
+                    idx = stage.check(bam, read)
+
+                if idx is not None:
+                    stage.rejects += 1
+                    if self.exact:
+                        # any criterion that would have been checked before
+                        # this one (in the original order) takes precedence
+                        for j, criterion in sorted([m for later in segment[i + 1:] for m in later.members if m[0] < idx]):
+                            if not criterion.filter(bam, read):
+                                idx = j
+                                break
+                    return self.criteria[idx]
+        return None
+
+    def report(self, out=sys.stderr):
+        out.write('Criteria timing:\n')
+        for segment in self.segments:
+            for stage in sorted(segment, key=lambda stage: stage.members[0][0]):
+                out.write('    %s\t%s checked\t%s removed\t%.3f sec (est)\n' % (stage, stage.calls, stage.rejects, stage.cost * stage.calls))
+
+
 _criteria = {
     'mapped': Mapped,
     'unmapped': Unmapped,
@@ -860,7 +1151,7 @@ _criteria = {
 }
 
 
-def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
+def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False, timing=False):
     if verbose:
         sys.stderr.write('Input file  : %s\n' % infile)
         sys.stderr.write('Output file : %s\n' % outfile)
@@ -886,18 +1177,16 @@ def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
     def _callback(read):
         return "%s | %s kept,%s failed" % ('%s:%s' % (bamfile.getrname(read.tid), read.pos) if read.tid > -1 else 'unk', passed, failed)
 
-    for read in bam_iter(bamfile):
-        p = True
+    chain = CompiledCriteria(criteria, exact=failed_out is not None)
 
-        for criterion in criteria:
-            if not criterion.filter(bamfile, read):
-                p = False
-                failed += 1
-                if failed_out:
-                    failed_out.write('%s\t%s\n' % (read.qname, criterion))
-                #outfile.write(read_to_unmapped(read))
-                break
-        if p:
+    for read in bam_iter(bamfile):
+        criterion = chain.filter(bamfile, read)
+        if criterion is not None:
+            failed += 1
+            if failed_out:
+                failed_out.write('%s\t%s\n' % (read.qname, criterion))
+            #outfile.write(read_to_unmapped(read))
+        else:
             passed += 1
             outfile.write(read)
 
@@ -907,6 +1196,9 @@ def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
         failed_out.close()
     sys.stdout.write("%s kept\n%s failed\n" % (passed, failed))
 
+    if timing:
+        chain.report()
+
     for criterion in criteria:
         criterion.close()
 
@@ -939,6 +1231,7 @@ if __name__ == '__main__':
     crit_args = []
     last = None
     verbose = False
+    timing = False
     fail = False
 
     for arg in sys.argv[1:]:
@@ -951,6 +1244,8 @@ if __name__ == '__main__':
             last = arg
         elif arg == '-v':
             verbose = True
+        elif arg == '-timing':
+            timing = True
         elif not infile and os.path.exists(arg):
             infile = arg
         elif not outfile:
@@ -983,4 +1278,4 @@ if __name__ == '__main__':
             print "Missing: filtering criteria"
         usage()
     else:
-        bam_filter(infile, outfile, criteria, failed, verbose)
+        bam_filter(infile, outfile, criteria, failed, verbose, timing)
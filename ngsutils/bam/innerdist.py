@@ -33,19 +33,158 @@ or if they overlap:
                                         |----|
                                   inner mate-pair distance (negative)
 
+The insert size can be estimated quickly from the first pairs in the files
+(-sample). In this case, 95% confidence intervals for the mean and standard
+deviation are also reported.
 '''
 import sys
 import os
+import math
+import array
 from ngsutils.bam import bam_iter
-from ngsutils.support.stats import counts_mean_stdev
 import pysam
 
 
-def bam_innerdist(bam1, bam2, summaryout=None):
-    iter1 = bam_iter(bam1)
-    iter2 = bam_iter(bam2, quiet=True)
+class DistanceHistogram(object):
+    '''
+    Fixed-size histogram of distances. Distances from min_dist to max_dist
+    are counted in an array, with one overflow bin on each side. The exact
+    mean/stdev are tracked with running (integer) sums, so values in the
+    overflow bins are still included.
+    '''
+    def __init__(self, min_dist=-1000, max_dist=100000):
+        self.min_dist = min_dist
+        self.max_dist = max_dist
+        self.bins = array.array('L', [0] * (max_dist - min_dist + 1))
+        self.underflow = 0
+        self.overflow = 0
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+
+    def add(self, dist):
+        if dist < self.min_dist:
+            self.underflow += 1
+        elif dist > self.max_dist:
+            self.overflow += 1
+        else:
+            self.bins[dist - self.min_dist] += 1
+
+        self.count += 1
+        self.total += dist
+        self.total_sq += dist * dist
+
+    def counts(self):
+        'Returns {dist: count} for the distances in range'
+        return dict([(i + self.min_dist, count) for i, count in enumerate(self.bins) if count])
+
+    def mean_stdev(self):
+        'Mean and sample standard deviation (see: support.stats.counts_mean_stdev)'
+        if not self.count:
+            return 0.0, 0.0
+
+        mean = float(self.total) / self.count
+        if self.count > 2:
+            # exact, since the sums are integers
+            stdev = math.sqrt(float(self.count * self.total_sq - self.total * self.total) / (self.count * (self.count - 1)))
+        else:
+            stdev = 0.0
+
+        return mean, stdev
+
+    def confidence(self, z=1.96):
+        '''
+        Returns approximate confidence intervals for the mean and stdev:
+        ((mean_low, mean_high), (stdev_low, stdev_high)). The default is 95%
+        (z=1.96). These assume the distances are a random sample of
+        (roughly normally distributed) pairs.
+        '''
+        mean, stdev = self.mean_stdev()
+        if self.count < 3:
+            return (mean, mean), (stdev, stdev)
+
+        err = z * stdev / math.sqrt(self.count)
+        sd_err = z / math.sqrt(2 * (self.count - 1))
+        return (mean - err, mean + err), (stdev * max(0.0, 1 - sd_err), stdev * (1 + sd_err))
+
+
+def _pair_records(bam, quiet=False):
+    '''
+    Yields (qname, is_unmapped, tid, pos, aend, is_reverse) for the first
+    mapping of each read.
+    '''
+    last = None
+    for read in bam_iter(bam, quiet=quiet):
+        if read.qname == last:
+            continue
+        last = read.qname
+        yield (read.qname, read.is_unmapped, read.tid, read.pos, read.aend, read.is_reverse)
+
+
+def _pair_record_worker(fname, queue, batchsize):
+    'Decodes a BAM file in a separate process, sending batches of records'
+    try:
+        bam = pysam.Samfile(fname, 'rb')
+        batch = []
+        for record in _pair_records(bam, quiet=True):
+            batch.append(record)
+            if len(batch) >= batchsize:
+                queue.put(batch)
+                batch = []
+        if batch:
+            queue.put(batch)
+        bam.close()
+        queue.put(None)
+    except Exception, e:
+        queue.put(e)
+
+
+class _RecordReader(object):
+    'Iterates over the records for a BAM file decoded in a separate process'
+    def __init__(self, fname, batchsize=10000, maxbatches=16):
+        import multiprocessing
+        self.queue = multiprocessing.Queue(maxbatches)
+        self.proc = multiprocessing.Process(target=_pair_record_worker, args=(fname, self.queue, batchsize))
+        self.proc.daemon = True
+        self.proc.start()
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            for record in batch:
+                yield record
+        self.proc.join()
+
+    def close(self):
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.proc.join()
+
+
+def bam_innerdist(bam1, bam2, summaryout=None, sample=None, hist=None, quiet=False):
+    '''
+    Calculates the inner mate-pair distance. bam1 and bam2 can be either
+    open BAM files or iterables of records (see: _pair_records).
+
+    If sample is given, this stops after that many proper pairs. If hist
+    (a DistanceHistogram) is given, the distances are added to it.
+
+    Returns (total, proper, mean, stdev, orientation_count)
+    '''
+    if hist is None:
+        hist = DistanceHistogram()
+
+    if hasattr(bam1, 'fetch'):
+        bam1 = _pair_records(bam1, quiet)
+    if hasattr(bam2, 'fetch'):
+        bam2 = _pair_records(bam2, True)
+
+    iter2 = iter(bam2)
 
-    distances = {}
     total = 0
     proper = 0
 
@@ -56,55 +195,56 @@ def bam_innerdist(bam1, bam2, summaryout=None):
         '-/-': 0,
     }
 
-    read1_last = None
-    read2_last = None
-    read1 = None
-    read2 = None
-
-    while True:
+    for name1, unmapped1, tid1, pos1, aend1, rev1 in bam1:
         try:
-            while not read1 or read1_last == read1.qname:
-                read1 = iter1.next()
-            while not read2 or read2_last == read2.qname:
-                read2 = iter2.next()
+            name2, unmapped2, tid2, pos2, aend2, rev2 = iter2.next()
         except StopIteration:
             break
 
-        if read1.qname != read2.qname:
-            raise ValueError("Error: BAM files aren't properly paired! (%s, %s)\n" % (read1.qname, read2.qname))
-
-        read1_last = read1.qname
-        read2_last = read2.qname
+        if name1 != name2:
+            raise ValueError("Error: BAM files aren't properly paired! (%s, %s)\n" % (name1, name2))
 
         total += 1
 
-        if read1.is_unmapped or read2.is_unmapped or read1.tid != read2.tid:
+        if unmapped1 or unmapped2 or tid1 != tid2:
             continue
 
         proper += 1
 
-        if read1.pos < read2.pos:
-            dist = read2.pos - read1.aend
+        if pos1 < pos2:
+            dist = pos2 - aend1
         else:
-            dist = read1.pos - read2.aend
+            dist = pos1 - aend2
 
         if summaryout:
             summaryout.write('%s\n' % dist)
 
-        if not dist in distances:
-            distances[dist] = 1
-        else:
-            distances[dist] += 1
+        hist.add(dist)
 
-        orientation = '%s/%s' % ('-' if read1.is_reverse else '+', '-' if read2.is_reverse else '+')
+        orientation_count['%s/%s' % ('-' if rev1 else '+', '-' if rev2 else '+')] += 1
 
-        orientation_count[orientation] += 1
+        if sample and proper >= sample:
+            break
 
-    mean, stdev = counts_mean_stdev(distances)
+    mean, stdev = hist.mean_stdev()
 
     return total, proper, mean, stdev, orientation_count
 
 
+def bam_innerdist_parallel(fname1, fname2, summaryout=None, sample=None, hist=None):
+    '''
+    Same as bam_innerdist, but each BAM file is decoded in a separate
+    process.
+    '''
+    reader1 = _RecordReader(fname1)
+    reader2 = _RecordReader(fname2)
+    try:
+        return bam_innerdist(reader1, reader2, summaryout, sample, hist)
+    finally:
+        reader1.close()
+        reader2.close()
+
+
 def usage():  # pragma: no cover
     print __doc__
     print """\
@@ -112,6 +252,9 @@ Usage: bamutils innerdist filename1.bam filename2.bam
 
 Options:
   -summary filename       Write all distances out to a file
+  -sample num             Stop after {num} proper pairs and report confidence
+                          intervals for the mean/stdev
+  -parallel               Decode each BAM file in a separate process
 
 Note: BAM files must be paired and they must be mapped to the
       same reference and reads must be in the same order.
@@ -123,17 +266,24 @@ if __name__ == "__main__":  # pragma: no cover
     fname1 = None
     fname2 = None
     summary = None
+    sample = None
+    parallel = False
 
     last = None
     for arg in sys.argv[1:]:
         if last == '-summary' and not os.path.exists(arg):
             summary = arg
             last = None
+        elif last == '-sample':
+            sample = int(arg)
+            last = None
+        elif arg == '-parallel':
+            parallel = True
         elif not fname1 and os.path.exists(arg):
             fname1 = arg
         elif not fname2 and os.path.exists(arg):
             fname2 = arg
-        elif arg in ['-summary']:
+        elif arg in ['-summary', '-sample']:
             last = arg
         else:
             usage()
@@ -141,23 +291,28 @@ if __name__ == "__main__":  # pragma: no cover
     if not fname1 or not fname2:
         usage()
 
-    bam1 = pysam.Samfile(fname1, "rb")
-    bam2 = pysam.Samfile(fname2, "rb")
-
     if summary:
         fobj = open(summary, 'w')
     else:
         fobj = None
 
+    hist = DistanceHistogram()
+
     try:
-        total, proper, mean, stdev, o_count = bam_innerdist(bam1, bam2, fobj)
+        if parallel:
+            total, proper, mean, stdev, o_count = bam_innerdist_parallel(fname1, fname2, fobj, sample, hist)
+        else:
+            bam1 = pysam.Samfile(fname1, "rb")
+            bam2 = pysam.Samfile(fname2, "rb")
+            try:
+                total, proper, mean, stdev, o_count = bam_innerdist(bam1, bam2, fobj, sample, hist)
+            finally:
+                bam1.close()
+                bam2.close()
     except ValueError, e:
         print e
         sys.exit(1)
     finally:
-        bam1.close()
-        bam2.close()
-
         if fobj:
             fobj.close()
 
@@ -167,6 +322,11 @@ if __name__ == "__main__":  # pragma: no cover
     print "Mean:\t%s" % mean
     print "Stdev:\t%s" % stdev
 
+    if sample:
+        mean_ci, stdev_ci = hist.confidence()
+        print "Mean (95% CI):\t%s\t%s" % mean_ci
+        print "Stdev (95% CI):\t%s\t%s" % stdev_ci
+
     print "Read orientation:"
     for o in o_count:
         if o_count[o]:
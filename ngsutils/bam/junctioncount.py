@@ -5,54 +5,157 @@
 Counts the number of reads that span each junction found in the BAM file.
 
 You can specify a particular genome range to scan (like a gene region).
+
+Each N (skipped) operation in a read's CIGAR alignment is counted as a
+junction. Reads are counted once per junction by name, so both mates of a
+pair spanning the same junction are only counted once.
+
+The BAM file should be sorted by coordinates. Junctions are written out as
+soon as the reads have moved past their donor (start) position, so the
+output is sorted and memory use is limited to the junctions near the current
+position.
 '''
 
 import sys
 import os
-from ngsutils.bam import bam_iter, bam_open
-
-def bam_junction_count(bam, ref=None, start=None, end=None, out=sys.stdout, quiet=False):
-    last_tid = None
+from ngsutils.bam import bam_iter, bam_open, bam_map_refs
+
+_strand_codes = {None: 0, '+': 1, '-': 2}
+_strands = '.+-'
+
+
+def read_junctions(read):
+    '''
+    Yields (start, end, anchor) for each N operation in a read, where anchor
+    is the smaller of the number of aligned bases on either side of the gap
+    (up to the next gap or the end of the read).
+    '''
+    pos = read.pos
+    anchor = 0
+    junctions = []
+    anchors = []
+
+    for op, size in read.cigar:
+        if op in [0, 7, 8]:  # M, =, X
+            pos += size
+            anchor += size
+        elif op == 2:
+            pos += size
+        elif op == 3:
+            junctions.append((pos, pos + size))
+            anchors.append(anchor)
+            anchor = 0
+            pos += size
+
+    anchors.append(anchor)
+
+    for i, (start, end) in enumerate(junctions):
+        yield start, end, min(anchors[i], anchors[i + 1])
+
+
+def _read_strand(read):
+    try:
+        return read.opt('XS')
+    except KeyError:
+        return None
+
+
+def junction_counts(reads, stranded=False):
+    '''
+    Yields (tid, start, end, strand, count, max_anchor) for each junction.
+    Junctions are yielded in sorted order (per reference) as soon as the reads
+    have passed their start position.
+
+    Junctions are stored using a packed integer key and the supporting reads
+    as a set of name hashes.
+    '''
     junctions = {}
-    for read in bam_iter(bam, ref=ref, start=start, end=end, quiet=quiet):
+    last_tid = None
+    next_flush = None
+
+    def _flush(pos=None):
+        done = []
+        for key in junctions:
+            if pos is None or (key >> 34) < pos:
+                done.append(key)
+
+        done.sort()
+        for key in done:
+            names, anchor = junctions[key]
+            del junctions[key]
+            yield (last_tid, key >> 34, (key >> 2) & 0xFFFFFFFF, _strands[key & 0x3], len(names), anchor)
+
+    for read in reads:
         if read.is_unmapped:
             continue
 
-        if read.tid != last_tid and junctions:
-            for junction in junctions:
-                sys.stdout.write('%s\t%s\n' % (junction, len(junctions[junction])))
-            junctions = {}
+        if read.tid != last_tid:
+            for junction in _flush():
+                yield junction
             last_tid = read.tid
+            next_flush = None
 
-        hasgap = False
-        pos = read.pos
-        end = None
-        for op, size in read.cigar:
-            if op == 0:
-                pos += size
-            elif op == 1:
-                pass
-            elif op == 2:
-                pos += size
-            elif op == 3:
-                hasgap = True
-                end = pos + size
-                break
-            elif op == 4:
-                pos += size
-
-
-        if not hasgap:
+        elif next_flush is not None and read.pos > next_flush:
+            for junction in _flush(read.pos):
+                yield junction
+            next_flush = min([key >> 34 for key in junctions]) if junctions else None
+
+        if not read.cigar:
             continue
 
-        junction = '%s:%s-%s' % (bam.references[read.tid], pos, end)
-        if not junction in junctions:
-            junctions[junction] = set()
+        strand = _strand_codes.get(_read_strand(read), 0) if stranded else 0
+        name = hash(read.qname)
+
+        for start, end, anchor in read_junctions(read):
+            key = (start << 34) | (end << 2) | strand
+            if not key in junctions:
+                junctions[key] = [set([name]), anchor]
+            else:
+                val = junctions[key]
+                val[0].add(name)
+                if anchor > val[1]:
+                    val[1] = anchor
+
+            if next_flush is None or start < next_flush:
+                next_flush = start
+
+    for junction in _flush():
+        yield junction
+
+
+def _format_junction(chrom, start, end, strand, count, anchor, stranded=False, anchors=False):
+    cols = ['%s:%s-%s' % (chrom, start, end)]
+    if stranded:
+        cols.append(strand)
+    cols.append(count)
+    if anchors:
+        cols.append(anchor)
+    return '\t'.join([str(x) for x in cols])
+
+
+def _junction_count_ref(fname, ref, stranded, anchors):
+    'Counts junctions for one reference (for parallel processing)'
+    bam = bam_open(fname)
+    lines = []
+    for tid, start, end, strand, count, anchor in junction_counts(bam_iter(bam, ref=ref, quiet=True), stranded):
+        lines.append(_format_junction(ref, start, end, strand, count, anchor, stranded, anchors))
+    bam.close()
+    return lines
+
+
+def bam_junction_count(bam, ref=None, start=None, end=None, out=sys.stdout, quiet=False, stranded=False, anchors=False):
+    for tid, jstart, jend, strand, count, anchor in junction_counts(bam_iter(bam, ref=ref, start=start, end=end, quiet=quiet), stranded):
+        out.write('%s\n' % _format_junction(bam.references[tid], jstart, jend, strand, count, anchor, stranded, anchors))
 
-        junctions[junction].add(read.qname)
 
-    for junction in junctions:
-        sys.stdout.write('%s\t%s\n' % (junction, len(junctions[junction])))
+def bam_junction_count_parallel(fname, procs, out=sys.stdout, stranded=False, anchors=False):
+    '''
+    Counts junctions for each reference in a separate process (requires an
+    indexed BAM file). Output is in reference order.
+    '''
+    for lines in bam_map_refs(fname, _junction_count_ref, procs, None, stranded, anchors):
+        for line in lines:
+            out.write('%s\n' % line)
 
 
 def usage(msg=""):
@@ -65,6 +168,13 @@ Usage: bamutils junctioncount {opts} bamfile {region}
 
 Region should be: chr:start-end (start 1-based)
 
+Options:
+  -stranded    Count junctions separately for each strand (using the XS tag)
+               and add a strand column
+  -anchor      Add a column with the largest minimum anchor (overhang) of any
+               read spanning the junction
+  -p num       Count each reference in parallel using {num} processes
+               (requires an indexed BAM file, can't be used with a region)
 """
     sys.exit(1)
 
@@ -73,23 +183,43 @@ if __name__ == "__main__":
     ref = None
     start = None
     end = None
+    stranded = False
+    anchors = False
+    procs = 1
+    last = None
 
     for arg in sys.argv[1:]:
         if arg == '-h':
             usage()
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif arg == '-p':
+            last = arg
+        elif arg == '-stranded':
+            stranded = True
+        elif arg == '-anchor':
+            anchors = True
         elif not fname:
             if os.path.exists(arg):
                 fname = arg
             else:
-                usage("%s doesn't exist!")
+                usage("%s doesn't exist!" % arg)
         else:
-            chrom, se = arg.split(':')
+            ref, se = arg.split(':')
             start, end = [int(x) for x in se.split('-')]
             start = start - 1
 
     if not fname:
         usage()
 
-    bamfile = bam_open(fname)
-    bam_junction_count(bamfile, ref, start, end)
-    bamfile.close()
+    if procs > 1:
+        if ref:
+            usage('-p can not be used with a region')
+        if not os.path.exists('%s.bai' % fname):
+            usage('-p requires an indexed BAM file')
+        bam_junction_count_parallel(fname, procs, stranded=stranded, anchors=anchors)
+    else:
+        bamfile = bam_open(fname)
+        bam_junction_count(bamfile, ref, start, end, stranded=stranded, anchors=anchors)
+        bamfile.close()
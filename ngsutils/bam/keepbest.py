@@ -10,6 +10,7 @@ import sys
 import os
 
 import ngsutils.bam
+from ngsutils.bam.namesort import NameSorter
 
 
 def get_read_tag_value(read, tag):
@@ -37,12 +38,17 @@ def _output_best(lastreads, outfile):
             break
 
 
-def bam_keepbest(fname, outname, tag="AS"):
+def bam_keepbest(fname, outname, tag="AS", namesort=None):
     bamfile = ngsutils.bam.bam_open(fname)
     outfile = ngsutils.bam.bam_open(outname, "w", template=bamfile)
 
+    if namesort:
+        reads = namesort.reads(fname)
+    else:
+        reads = ngsutils.bam.bam_iter(bamfile)
+
     lastreads = []
-    for read in ngsutils.bam.bam_iter(bamfile):
+    for read in reads:
         if lastreads and read.qname == lastreads[0][1].qname:
             lastreads.append((get_read_tag_value(read, tag), read))
         else:
@@ -65,6 +71,10 @@ Options:
    -tag tag    Use {tag} to determine which mappings to keep. This can be any
                tag present in the BAM file or "MAPQ" (default: AS).
 
+   -namesort       Sort the input by read name on the fly
+   -sortmem MB     Memory budget for -namesort (default: 512)
+   -sortprocs num  Number of processes for -namesort (default: 1)
+
 """
     sys.exit(-1)
 
@@ -72,14 +82,25 @@ if __name__ == "__main__":
     fname = None
     outname = None
     tag = "AS"
+    namesort = None
+    sortmem = 512
+    sortprocs = 1
     last = None
 
     for arg in sys.argv[1:]:
         if last == '-tag':
             tag = arg
             last = None
-        elif arg in ['-tag']:
+        elif last == '-sortmem':
+            sortmem = int(arg)
+            last = None
+        elif last == '-sortprocs':
+            sortprocs = int(arg)
+            last = None
+        elif arg in ['-tag', '-sortmem', '-sortprocs']:
             last = arg
+        elif arg == '-namesort':
+            namesort = True
         elif arg == "-h":
             usage()
         elif not fname and os.path.exists(arg):
@@ -97,4 +118,7 @@ if __name__ == "__main__":
     if not fname:
         usage()
 
-    bam_keepbest(fname, outname, tag)
+    if namesort:
+        namesort = NameSorter(sortmem, sortprocs)
+
+    bam_keepbest(fname, outname, tag, namesort)
@@ -9,9 +9,14 @@ only the best matches.  There can be any number of files, but the BAM header
 will be taken from the first one.  The input files should be sorted by read
 name, or at least have reads in the same order.
 
-The first input file should have a record for every read in the other files.
-However, the secondary files *may* have missing lines, so long as they are in
-the same order as the first file.
+If all of the files are sorted by read name (-sorted, for files sorted with
+'samtools sort -n', or -namesort), reads may be present in any of the files.
+Each file is decoded in a separate thread and the files are merged by read
+name.
+
+Otherwise, the first input file should have a record for every read in the
+other files. However, the secondary files *may* have missing lines, so long
+as they are in the same order as the first file.
 
 The value of the attribute/tag given will be used to determine which reads
 should be kept and which should be discarded. The tag should be a numeric
@@ -26,9 +31,14 @@ will be kept.
 """
 
 import os
+import re
 import sys
+import heapq
+import threading
+import Queue
 import pysam
 import ngsutils.bam
+from ngsutils.bam.namesort import NameSorter
 
 
 def usage():
@@ -47,41 +57,185 @@ Options
 
   -keepall    Keep all mappings for each read, not just the best one.
               (Note: only one mapping to each ref/pos will be kept)
+
+  -sorted     The input files are all sorted by read name, in the order
+              used by 'samtools sort -n' (read9 before read10)
+
+  -namesort       Sort the input files by read name on the fly
+  -sortmem MB     Memory budget for -namesort, per file (default: 512)
+  -sortprocs num  Number of processes for -namesort, per file (default: 1)
 """
     sys.exit(1)
 
 
-def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False, quiet=False):
-    bams = []
-    last_reads = []
-    bamgens = []
+class _BamGroupReader(threading.Thread):
+    '''
+    Reads a BAM file in a separate thread, batching together all of the
+    mappings for each read. Each group is a tuple: (qname, [(tag_val, read), ...])
+    where tag_val is the tuple of values used to rank the mappings (None for
+    unmapped reads).
+    '''
+    def __init__(self, fname, tags, quiet=True, batch_size=1000, queue_size=16, namesort=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fname = fname
+        self.tags = tags
+        self.quiet = quiet
+        self.namesort = namesort
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(queue_size)
+
+    def run(self):
+        try:
+            bam = pysam.Samfile(self.fname, "rb")
+            reads = self.namesort.reads(self.fname, quiet=self.quiet) if self.namesort else None
+            batch = []
+            for reads in ngsutils.bam.bam_batch_reads(bam, quiet=self.quiet, reads=reads):
+                batch.append((reads[0].qname, [(None if read.is_unmapped else _tag_values(read, self.tags), read) for read in reads]))
+                if len(batch) >= self.batch_size:
+                    self.queue.put(batch)
+                    batch = []
+            if batch:
+                self.queue.put(batch)
+            bam.close()
+            self.queue.put(None)
+        except Exception, e:
+            self.queue.put(e)
+
+    def groups(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            for group in batch:
+                yield group
+
+
+def _tag_values(read, tags):
+    tag_val = []
+    for tag in tags:
+        val = float(read.opt(tag[:2]))
+        if tag[-1] == '-':
+            val = -val
+        tag_val.append(val)
+    return tuple(tag_val)
+
+
+_name_runs = re.compile('[0-9]+|[^0-9]')
+
+
+def natural_name_key(name):
+    '''
+    Sort key for read names in the order used by 'samtools sort -n': runs of
+    digits are compared as numbers, other characters by value.
+
+    >>> sorted(['read10', 'read9', 'read1a', 'read1', 'r#'], key=natural_name_key)
+    ['r#', 'read1', 'read1a', 'read9', 'read10']
+    '''
+    key = []
+    for run in _name_runs.findall(name):
+        if run[0] in '0123456789':
+            # any digit compares the same way against a non-digit
+            key.append((48, int(run), run))
+        else:
+            key.append((ord(run),))
+    return key
+
+
+def _heap_merge(gens, key=None):
+    '''
+    Merges name-sorted groups from each input. Yields a list of (i, group)
+    for each read name. key is the sort key for the read names (the default
+    is to compare names directly).
+    '''
+    if key is None:
+        key = lambda name: name
+
+    heap = []
+    for i, gen in enumerate(gens):
+        for group in gen:
+            heap.append((key(group[0]), i, group))
+            break
+
+    heapq.heapify(heap)
+
+    while heap:
+        name, i, group = heapq.heappop(heap)
+        matches = [(i, group)]
+        while heap and heap[0][0] == name:
+            matches.append(heapq.heappop(heap)[1:])
+
+        for i, group in matches:
+            for nextgroup in gens[i]:
+                nextname = key(nextgroup[0])
+                if nextname < name:
+                    raise ValueError('Input files are not sorted by read name! (%s, %s)' % (group[0], nextgroup[0]))
+                heapq.heappush(heap, (nextname, i, nextgroup))
+                break
+
+        matches.sort()
+        yield matches
+
+
+def _ordered_merge(gens):
+    '''
+    Merges groups from inputs that are all in the same order as the first
+    file. Yields a list of (i, group) for each read name.
+    '''
+    current = [None] * len(gens)
+    for group in gens[0]:
+        matches = [(0, group)]
+        for i in xrange(1, len(gens)):
+            if current[i] is None:
+                for nextgroup in gens[i]:
+                    current[i] = nextgroup
+                    break
+            if current[i] is not None and current[i][0] == group[0]:
+                matches.append((i, current[i]))
+                current[i] = None
+        yield matches
+
+
+def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False, quiet=False, name_sorted=False, namesort=None):
+    '''
+    If the inputs are sorted by name (name_sorted=True, in 'samtools sort -n'
+    order), the inputs are merged using a heap, so any file can contain reads
+    not present in the others. Otherwise, all files must be in the same order
+    as the first file.
+
+    If namesort (a NameSorter) is given, each input is sorted by name as it
+    is read.
+
+    SO:queryname in the BAM headers isn't used to pick the merge, since it
+    doesn't say how the names were compared.
+    '''
+
+    readers = []
     counts = []
-    unmapped = 0
+    unmapped_count = 0
 
-    for infile in infiles:
-        bam = pysam.Samfile(infile, "rb")
-        last_reads.append(None)
-        bams.append(bam)
+    for i, infile in enumerate(infiles):
+        reader = _BamGroupReader(infile, tags, quiet=quiet or i > 0, namesort=namesort)
+        reader.start()
+        readers.append(reader)
         counts.append(0)
-        bamgens.append(ngsutils.bam.bam_batch_reads(bam))
-
-    outfile = pysam.Samfile('%s.tmp' % fname, "wb", template=bams[0])
-
-    while True:
-        found = False
-        for i, bamgen in enumerate(bamgens):
-            if last_reads[i] == None:
-                try:
-                    last_reads[i] = bamgen.next()
-                    if last_reads[i]:
-                        found = True
-                except:
-                    pass
-            else:
-                found = True
-        if not found:
-            break
 
+    template = pysam.Samfile(infiles[0], "rb")
+    outfile = pysam.Samfile('%s.tmp' % fname, "wb", template=template)
+    template.close()
+
+    gens = [reader.groups() for reader in readers]
+
+    if namesort:
+        merged = _heap_merge(gens)
+    elif name_sorted:
+        merged = _heap_merge(gens, natural_name_key)
+    else:
+        merged = _ordered_merge(gens)
+
+    for matches in merged:
         best_val = None
         best_reads = []
         best_source = 0
@@ -89,40 +243,23 @@ def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False,
         mappings = {}
         unmapped = None
 
-        first_group = last_reads[0]
-        for i in xrange(len(last_reads)):
-            if not last_reads[i]:
-                continue
-
-            match = False
-            for read in last_reads[i]:                        
-                if read.qname == first_group[0].qname:
-                    match = True
-
-                    if not read.is_unmapped:
-                        tag_val = []
-                        for tag in tags:
-                            val = float(read.opt(tag[:2]))
-                            if tag[-1] == '-':
-                                val = -val
-                            tag_val.append(val)
-
-                        if keepall:
-                            if not (read.tid, read.pos) in mappings:
-                                mappings[(read.tid, read.pos)] = (tag_val, i, read)
-                            elif tag_val > mappings[(read.tid, read.pos)][0]:
-                                mappings[(read.tid, read.pos)] = (tag_val, i, read)
-                        else:        
-                            if not best_val or tag_val > best_val:
-                                best_val = tag_val
-                                best_reads = [read]
-                                best_source = i
-                            elif tag_val == best_val:
-                                best_reads.append(read)
-                    elif not discard:
-                        unmapped = read
-            if match:
-                last_reads[i] = None
+        for i, (qname, group) in matches:
+            for tag_val, read in group:
+                if tag_val is not None:
+                    if keepall:
+                        if not (read.tid, read.pos) in mappings:
+                            mappings[(read.tid, read.pos)] = (tag_val, i, read)
+                        elif tag_val > mappings[(read.tid, read.pos)][0]:
+                            mappings[(read.tid, read.pos)] = (tag_val, i, read)
+                    else:
+                        if not best_val or tag_val > best_val:
+                            best_val = tag_val
+                            best_reads = [read]
+                            best_source = i
+                        elif tag_val == best_val:
+                            best_reads.append(read)
+                elif not discard:
+                    unmapped = read
 
         if keepall and mappings:
             outs = []
@@ -138,19 +275,15 @@ def bam_merge(fname, infiles, tags=['AS+', 'NM-'], discard=False, keepall=False,
             for read in best_reads:
                 outfile.write(read)
         elif unmapped:
-            unmapped += 1
-
-            if not discard:
-                outfile.write(unmapped)
+            unmapped_count += 1
+            outfile.write(unmapped)
 
     if not quiet:
         for fn, cnt in zip(infiles, counts):
             print "%s\t%s" % (fn, cnt)
-        print "unmapped\t%s" % unmapped
+        print "unmapped\t%s" % unmapped_count
 
     outfile.close()
-    for bam in bams:
-        bam.close()
 
     os.rename('%s.tmp' % fname, fname)
 
@@ -160,6 +293,10 @@ if __name__ == '__main__':
     last = None
     discard = False
     keepall = False
+    name_sorted = False
+    namesort = None
+    sortmem = 512
+    sortprocs = 1
     tags = []
 
     for arg in sys.argv[1:]:
@@ -168,12 +305,22 @@ if __name__ == '__main__':
         elif last == '-tag':
             tags.append(arg)
             last = None
-        elif arg in ['-tag']:
+        elif last == '-sortmem':
+            sortmem = int(arg)
+            last = None
+        elif last == '-sortprocs':
+            sortprocs = int(arg)
+            last = None
+        elif arg in ['-tag', '-sortmem', '-sortprocs']:
             last = arg
+        elif arg == '-namesort':
+            namesort = True
         elif arg == '-keepall':
             keepall = True
         elif arg == '-discard':
             discard = True
+        elif arg == '-sorted':
+            name_sorted = True
         elif not outfile:
             outfile = arg
         elif os.path.exists(arg):
@@ -185,4 +332,6 @@ if __name__ == '__main__':
     if not infiles or not outfile:
         usage()
     else:
-        bam_merge(outfile, infiles, tags, discard, keepall)
+        if namesort:
+            namesort = NameSorter(sortmem, sortprocs)
+        bam_merge(outfile, infiles, tags, discard, keepall, name_sorted=name_sorted, namesort=namesort)
@@ -23,6 +23,7 @@ import sys
 import math
 import subprocess
 from ngsutils.bam import bam_pileup_iter
+from ngsutils.support.refcache import RefCache
 import pysam
 
 
@@ -85,7 +86,7 @@ Options:
 
 def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0, name=None, min_ci_low=None):
     bam = pysam.Samfile(bam_fname, "rb")
-    ref = pysam.Fastafile(ref_fname)
+    ref = RefCache(ref_fname)
 
     if not name:
         name = os.path.basename(bam_fname)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+## category General
+## desc Builds a compact read-name index for whitelists/blacklists
+'''
+Builds a compact read-name index for whitelists/blacklists
+
+Large whitelists/blacklists of read names (used by filter, count, and export)
+take a lot of memory and time to load as text. This converts a name list (one
+name per line, first column) into a binary index that is memory-mapped when
+used, and can be shared between processes.
+
+The index file can be used in place of the text file anywhere a whitelist
+or blacklist is accepted.
+'''
+
+import os
+import sys
+from ngsutils.support.nameset import build_name_index, read_name_list
+
+
+def usage(msg=None):
+    if msg:
+        print '%s\n' % msg
+    print __doc__
+    print '''Usage: bamutils nameindex {opts} names.txt names.idx
+
+Options:
+  -exact       Store the names too, so that matches are verified exactly
+               (default: only 64-bit name hashes are stored)
+  -bloom num   Bloom filter size (bits per name) (default: 10, 0 to disable)
+  -tmpdir dir  Directory for temporary files (names are sorted in chunks)
+               (default: the same directory as names.idx)
+'''
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    infile = None
+    outfile = None
+    exact = False
+    bits = 10
+    tmpdir = None
+    last = None
+
+    for arg in sys.argv[1:]:
+        if arg == '-h':
+            usage()
+        elif last == '-bloom':
+            bits = int(arg)
+            last = None
+        elif last == '-tmpdir':
+            tmpdir = arg
+            last = None
+        elif arg in ['-bloom', '-tmpdir']:
+            last = arg
+        elif arg == '-exact':
+            exact = True
+        elif not infile:
+            if not os.path.exists(arg):
+                usage('Missing file: %s' % arg)
+            infile = arg
+        elif not outfile:
+            outfile = arg
+        else:
+            usage('Unknown argument: %s' % arg)
+
+    if not infile or not outfile:
+        usage()
+
+    build_name_index(read_name_list(infile), outfile, exact, bits, tmpdir=tmpdir)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+## category General
+## desc Sorts a BAM file by read name
+'''
+Sorts a BAM file by read name.
+
+Reads are sorted into chunks (limited by a memory budget) that are written to
+temporary files in a compact binary format. The chunks are then merged
+together. If more than one process is used, the chunks are sorted and written
+in parallel while the next chunk is being read.
+
+Reads are sorted by name (byte order), keeping the original order for
+mappings of the same read. This is the order expected by best, keepbest,
+merge, and pair. Those commands can also use this sort directly (-namesort),
+without writing a sorted BAM file first.
+'''
+
+import os
+import sys
+import struct
+import tempfile
+import zlib
+import cPickle
+import heapq
+
+import pysam
+from eta import ETA
+import ngsutils.bam
+
+_BLOCK = struct.Struct('<I')
+
+
+def _read_record(read, seqno):
+    return (read.qname, seqno, read.flag, read.tid, read.pos, read.mapq, read.cigar, read.rnext, read.pnext, read.tlen, read.seq, read.qual, read.tags)
+
+
+def _record_read(record):
+    read = pysam.AlignedRead()
+    read.qname = record[0]
+    read.flag = record[2]
+    read.tid = record[3]
+    read.pos = record[4]
+    read.mapq = record[5]
+    if record[6]:
+        read.cigar = record[6]
+    read.rnext = record[7]
+    read.pnext = record[8]
+    read.tlen = record[9]
+    read.seq = record[10]
+    read.qual = record[11]
+    read.tags = record[12]
+    return read
+
+
+def _read_size(read):
+    'Rough estimate of the memory used by a read (bytes)'
+    return 400 + len(read.qname) + 2 * read.rlen + 16 * len(read.cigar or [])
+
+
+def _write_tmp(records, tmpdir, tmpprefix='.tmp', blocksize=10000):
+    '''
+    Sorts a chunk of records and writes them to a temporary file. The file is
+    a series of blocks: uint32 length + zlib compressed pickled list of
+    records.
+    '''
+    records.sort()
+    tmp = tempfile.NamedTemporaryFile(prefix=tmpprefix, dir=tmpdir, delete=False)
+    for i in xrange(0, len(records), blocksize):
+        buf = zlib.compress(cPickle.dumps(records[i:i + blocksize], cPickle.HIGHEST_PROTOCOL), 1)
+        tmp.write(_BLOCK.pack(len(buf)))
+        tmp.write(buf)
+    tmp.close()
+    return tmp.name
+
+
+def _write_tmp_worker(args):
+    return _write_tmp(*args)
+
+
+def _read_tmp(fname):
+    'Yields the records from a temporary chunk file'
+    with open(fname, 'rb') as f:
+        while True:
+            buf = f.read(_BLOCK.size)
+            if not buf:
+                break
+            size = _BLOCK.unpack(buf)[0]
+            for record in cPickle.loads(zlib.decompress(f.read(size))):
+                yield record
+
+
+def _merge_tmp(tmpfiles, tmpdir, tmpprefix='.tmp', max_files=128):
+    '''
+    Reduces the number of temporary files to at most max_files by merging
+    groups of them together.
+    '''
+    while len(tmpfiles) > max_files:
+        merged = []
+        for i in xrange(0, len(tmpfiles), max_files):
+            group = tmpfiles[i:i + max_files]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+
+            tmp = tempfile.NamedTemporaryFile(prefix=tmpprefix, dir=tmpdir, delete=False)
+            block = []
+            for record in heapq.merge(*[_read_tmp(x) for x in group]):
+                block.append(record)
+                if len(block) >= 10000:
+                    buf = zlib.compress(cPickle.dumps(block, cPickle.HIGHEST_PROTOCOL), 1)
+                    tmp.write(_BLOCK.pack(len(buf)))
+                    tmp.write(buf)
+                    block = []
+            if block:
+                buf = zlib.compress(cPickle.dumps(block, cPickle.HIGHEST_PROTOCOL), 1)
+                tmp.write(_BLOCK.pack(len(buf)))
+                tmp.write(buf)
+            tmp.close()
+
+            for fname in group:
+                os.unlink(fname)
+            merged.append(tmp.name)
+        tmpfiles = merged
+    return tmpfiles
+
+
+def bam_namesort_iter(fname, mem=512, procs=1, tmpdir=None, tmpprefix='.tmp', quiet=False):
+    '''
+    Yields the reads from a BAM file sorted by read name.
+
+    mem is the memory budget (in MB) for reads held in memory. With more than
+    one process, the budget is split between the chunk being read and the
+    chunks being sorted/written. If all of the reads fit in one chunk, no
+    temporary files are written.
+    '''
+    if not tmpdir:
+        tmpdir = os.path.dirname(os.path.abspath(fname))
+
+    procs = max(procs, 1)
+    chunk_bytes = mem * 1024 * 1024 / procs
+
+    bam = ngsutils.bam.bam_open(fname)
+
+    pool = None
+    pending = []
+    tmpfiles = []
+    chunk = []
+    chunk_size = 0
+    count = 0
+
+    try:
+        for read in ngsutils.bam.bam_iter(bam, quiet=quiet):
+            chunk.append(read)
+            chunk_size += _read_size(read)
+            count += 1
+
+            if chunk_size >= chunk_bytes:
+                records = [_read_record(r, count - len(chunk) + i) for i, r in enumerate(chunk)]
+                chunk = []
+                chunk_size = 0
+
+                if procs > 1:
+                    if pool is None:
+                        import multiprocessing
+                        pool = multiprocessing.Pool(procs - 1)
+
+                    # limit the number of chunks in memory
+                    while len(pending) >= procs - 1:
+                        tmpfiles.append(pending.pop(0).get())
+
+                    pending.append(pool.apply_async(_write_tmp_worker, [(records, tmpdir, tmpprefix)]))
+                else:
+                    tmpfiles.append(_write_tmp(records, tmpdir, tmpprefix))
+
+                records = None
+
+        bam.close()
+
+        for result in pending:
+            tmpfiles.append(result.get())
+        pending = []
+
+        if pool:
+            pool.close()
+            pool.join()
+            pool = None
+
+        if not tmpfiles:
+            # everything fits in memory (sort is stable, so mappings stay in order)
+            chunk.sort(key=lambda read: read.qname)
+            for read in chunk:
+                yield read
+            return
+
+        if chunk:
+            tmpfiles.append(_write_tmp([_read_record(r, count - len(chunk) + i) for i, r in enumerate(chunk)], tmpdir, tmpprefix))
+            chunk = []
+
+        tmpfiles = _merge_tmp(tmpfiles, tmpdir, tmpprefix)
+
+        eta = None
+        if not quiet:
+            eta = ETA(count)
+
+        for i, record in enumerate(heapq.merge(*[_read_tmp(x) for x in tmpfiles])):
+            if eta:
+                eta.print_status(i, extra=record[0])
+            yield _record_read(record)
+
+        if eta:
+            eta.done()
+
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        for tmpfile in tmpfiles:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+
+def namesort_header(bam):
+    'Returns a copy of the BAM header marked as sorted by name (SO:queryname)'
+    header = bam.header
+    if hasattr(header, 'to_dict'):
+        header = header.to_dict()
+    else:
+        header = dict(header)
+
+    hd = dict(header.get('HD', {'VN': '1.4'}))
+    hd['SO'] = 'queryname'
+    header['HD'] = hd
+    return header
+
+
+class NameSorter(object):
+    '''
+    Options for sorting BAM files by name on the fly. This is passed to the
+    commands that require name-sorted input (best, keepbest, merge, pair).
+    '''
+    def __init__(self, mem=512, procs=1, tmpdir=None):
+        self.mem = mem
+        self.procs = procs
+        self.tmpdir = tmpdir
+
+    def reads(self, fname, quiet=False):
+        return bam_namesort_iter(fname, self.mem, self.procs, self.tmpdir, '.tmp.%s' % os.path.basename(fname), quiet)
+
+
+def bam_namesort(infile, outfile, mem=512, procs=1, tmpdir=None, quiet=False):
+    bam = ngsutils.bam.bam_open(infile)
+    header = namesort_header(bam)
+    bam.close()
+
+    out = pysam.Samfile('%s.tmp' % outfile, 'wb', header=header)
+    for read in bam_namesort_iter(infile, mem, procs, tmpdir, '.tmp.%s' % os.path.basename(infile), quiet):
+        out.write(read)
+    out.close()
+    os.rename('%s.tmp' % outfile, outfile)
+
+
+def usage(msg=None):
+    if msg:
+        print '%s\n' % msg
+    print __doc__
+    print '''\
+Usage: bamutils namesort {opts} in.bam out.bam
+
+Options:
+  -mem MB   Memory budget for reads in memory (default: 512)
+  -p num    Sort and write chunks using {num} processes (default: 1)
+  -T dir    Use this directory for temporary files
+            (default: the same directory as in.bam)
+'''
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    infile = None
+    outfile = None
+    mem = 512
+    procs = 1
+    tmpdir = None
+    last = None
+
+    for arg in sys.argv[1:]:
+        if arg == '-h':
+            usage()
+        elif last == '-mem':
+            mem = int(arg)
+            last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif arg in ['-mem', '-p', '-T']:
+            last = arg
+        elif not infile:
+            if not os.path.exists(arg):
+                usage('Missing file: %s' % arg)
+            infile = arg
+        elif not outfile:
+            outfile = arg
+        else:
+            usage('Unknown option: %s' % arg)
+
+    if not infile or not outfile:
+        usage()
+
+    bam_namesort(infile, outfile, mem, procs, tmpdir)
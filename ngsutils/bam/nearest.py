@@ -14,39 +14,21 @@ report the distance to the site.
 import sys
 import os
 import ngsutils.bam
-from ngsutils.bed import BedFile
+from ngsutils.bed import BedFile, BedNearest
 
 
 def find_nearest(bam, bed, maxdist=100000, out=sys.stdout):
+    index = BedNearest(bed)
+
     for read in ngsutils.bam.bam_iter(bam):
         if read.is_unmapped:
             continue
 
-        dists = []  # will be an list tuples: (abs_val of the distance, 'up/down') (respective to + strand)
-
         chrom = bam.getrname(read.tid)
         strand = '-' if read.is_reverse else '+'
-        start = max(0, read.pos - maxdist)
-        end = min(read.aend + maxdist, bam.lengths[read.tid])
-
-        for region in bed.fetch(chrom, start, end, strand):
-            if region.start <= read.pos <= region.end:
-                # start is w/in region
-                dists.append((0, ''))
-                continue
-            elif region.start <= read.aend <= region.end:
-                # end is w/in region
-                dists.append((0, ''))
-                continue
-            elif read.pos <= region.start <= region.end <= read.aend:
-                # read spans the entire region
-                dists.append((0,''))
-                continue
-            elif region.end < read.pos:
-                dists.append((read.pos - region.end, 'up'))
-            else:
-                dists.append((region.start - read.aend, 'down'))
-            
+
+        # will be an list tuples: (abs_val of the distance, 'up/down', region) (respective to + strand)
+        dists = index.nearest(chrom, read.pos, read.aend, strand, maxdist)
 
         if dists:
             dists.sort()
@@ -59,7 +41,6 @@ def find_nearest(bam, bed, maxdist=100000, out=sys.stdout):
                     distance = -distance
                 elif read.is_reverse and orient == 'up':
                     distance = -distance
-                    
 
             out.write('%s\t%s\n' % (read.qname, distance))
         else:
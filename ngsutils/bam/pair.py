@@ -7,7 +7,8 @@ the most likely pairing partners based upon strand, insert distance, and
 maximizing alignment scores.
 
 It is very important that the files are either in the same order with each
-read present in both files or sorted in name order.
+read present in both files or sorted in name order. (Use -namesort to sort
+the files by name on the fly.)
 
 The value of the attribute/tag given will be used to determine which reads
 should be kept and which should be discarded. The tag should be a numeric
@@ -19,8 +20,10 @@ satisfies strand and distance values.
 
 import os
 import sys
+import bisect
 import pysam
 import ngsutils.bam
+from ngsutils.bam.namesort import NameSorter
 
 
 def usage(msg=None):
@@ -52,6 +55,11 @@ Options
 
   -reason tag         Write the reason for failure to this tag (only for
                       failed reads/mappings) Must be a valid two char name.
+
+  -namesort           Sort the input files by read name on the fly
+  -sortmem MB         Memory budget for -namesort, per file (default: 512)
+  -sortprocs num      Number of processes for -namesort, per file
+                      (default: 1)
 """
     sys.exit(1)
 
@@ -79,9 +87,101 @@ def is_valid_pair(read1, read2):
     return True, ''
 
 
+def _bucket_reads(reads):
+    '''
+    Buckets mapped reads by (tid, is_reverse). Each bucket is a tuple of
+    sorted positions and the matching indexes into reads.
+    '''
+    buckets = {}
+    for i, read in enumerate(reads):
+        if read.is_unmapped:
+            continue
+        key = (read.tid, read.is_reverse)
+        if not key in buckets:
+            buckets[key] = []
+        buckets[key].append((read.pos, i))
+
+    for key in buckets:
+        vals = sorted(buckets[key])
+        buckets[key] = ([pos for pos, i in vals], [i for pos, i in vals])
+
+    return buckets
+
+
+def _mate_window(read, buckets, max_size):
+    '''
+    Returns the indexes of the possible mates for a read that are on the
+    opposite strand, facing the read, and within max_size.
+    '''
+    if read.is_unmapped:
+        return []
+
+    key = (read.tid, not read.is_reverse)
+    if not key in buckets:
+        return []
+
+    positions, idxs = buckets[key]
+    if not read.is_reverse:
+        # mates on the - strand, at or after this read
+        lo = bisect.bisect_left(positions, read.pos)
+        hi = bisect.bisect_right(positions, read.pos + max_size)
+    else:
+        # mates on the + strand, at or before this read
+        lo = bisect.bisect_left(positions, read.aend - max_size)
+        hi = bisect.bisect_right(positions, read.pos)
+
+    return sorted(idxs[lo:hi])
+
+
+def _fail_reasons(read, others, buckets):
+    '''
+    Returns the set of reasons that a read couldn't be paired with any of the
+    other reads (same as calling is_valid_pair for each), without comparing
+    each combination. Assumes that no valid pair was found for this read.
+    '''
+    if not others:
+        return set()
+
+    if read.is_unmapped:
+        return set(['unmapped'])
+
+    reasons = set()
+    for tid, is_reverse in buckets:
+        if tid != read.tid:
+            reasons.add('chromosome')
+            break
+
+    if len(others) > sum([len(buckets[k][0]) for k in buckets]):
+        reasons.add('unmapped')
+
+    if (read.tid, read.is_reverse) in buckets:
+        reasons.add('orientation')
+
+    key = (read.tid, not read.is_reverse)
+    if key in buckets:
+        positions = buckets[key][0]
+        if not read.is_reverse:
+            if positions[0] < read.pos:
+                reasons.add('direction')
+            if positions[-1] >= read.pos:
+                reasons.add('size')
+        else:
+            if positions[-1] > read.pos:
+                reasons.add('direction')
+            if positions[0] <= read.pos:
+                reasons.add('size')
+
+    return reasons
+
+
 def find_pairs(reads1, reads2, min_size, max_size, tags):
     '''
     returns pairs, fail1, fail2
+
+    Possible mates for each read1 mapping are found by bucketing the read2
+    mappings by reference and strand and only looking at those within
+    max_size, so multi-mapped reads don't require comparing every
+    combination.
     '''
 
     possible = []
@@ -89,70 +189,62 @@ def find_pairs(reads1, reads2, min_size, max_size, tags):
     fail2 = []
 
     valid = set()
+    buckets2 = _bucket_reads(reads2)
+
+    tag_vals1 = {}
+    tag_vals2 = {}
+
+    def _tag_vals(cache, reads, i):
+        if not i in cache:
+            cache[i] = [float(reads[i].opt(tag[:2])) for tag in tags]
+        return cache[i]
+
+    for i, r1 in enumerate(reads1):
+        for j in _mate_window(r1, buckets2, max_size):
+            r2 = reads2[j]
+
+            # there can be some strange edge cases for insert size, so we'll just look
+            # for the biggest
+            ins_size = max(r2.aend - r1.pos, r1.aend - r2.pos)
+
+            # Note: you can't subtract junctions (N) from the insert size
+            # because for RNA reads you can still have hidden introns between
+            # the two reads.
+
+            if ins_size < min_size or ins_size > max_size:
+                continue
+
+            tag_val = []
+            for tag, val1, val2 in zip(tags, _tag_vals(tag_vals1, reads1, i), _tag_vals(tag_vals2, reads2, j)):
+                val = val1 + val2
+                if tag[-1] == '+':
+                    # we will sort ascending to minimize size, so + tags (AS) need to be reversed
+                    val = -val
+                tag_val.append(val)
+
+            possible.append((tag_val, ins_size, r1, r2))
+            valid.add((1, r1.tid, r1.pos))
+            valid.add((2, r2.tid, r2.pos))
+
+    # reasons are combined for mappings at the same position
     reasons = {}
+    buckets1 = None
 
     for r1 in reads1:
-        for r2 in reads2:
-            is_valid, reason = is_valid_pair(r1, r2)
-            if is_valid:
-                # there can be some strange edge cases for insert size, so we'll just look
-                # for the biggest
-                ins_size = max(r2.aend - r1.pos, r1.aend - r2.pos)
-
-
-                # This doesn't work for RNA reads - you can still have hidden introns
-                # between the two reads. I'm leaving this here so that when I'm tempted
-                # to add this check again, I'll remember why it's a bad idea.
-
-                # junctionstarts = set()
-
-                # pos = r1.pos
-                # for op, size in r1.cigar:
-                #     if op == 0 or op == 2:
-                #         pos += size
-                #     elif op == 3:
-                #         junctionstarts.add(pos)
-                #         ins_size -= size
-
-                # pos = r2.pos
-                # for op, size in r2.cigar:
-                #     if op == 0 or op == 2:
-                #         pos += size
-                #     elif op == 3:
-                #         if not pos in junctionstarts:
-                #             ins_size -= size
-
-                if ins_size < min_size or ins_size > max_size:
-                    if not (1, r1.tid, r1.pos) in reasons:
-                        reasons[(1, r1.tid, r1.pos)] = set()
-                    if not (2, r2.tid, r2.pos) in reasons:
-                        reasons[(2, r2.tid, r2.pos)] = set()
-
-                    reasons[(1, r1.tid, r1.pos)].add('size')
-                    reasons[(2, r2.tid, r2.pos)].add('size')
-                    continue
-
-                tag_val = []
-                for tag in tags:
-                    val = float(r1.opt(tag[:2]))
-
-                    val += float(r2.opt(tag[:2]))
-                    if tag[-1] == '+':
-                        # we will sort ascending to minimize size, so + tags (AS) need to be reversed
-                        val = -val
-                    tag_val.append(val)
-
-                possible.append((tag_val, ins_size, r1, r2))
-                valid.add((1, r1.tid, r1.pos))
-                valid.add((2, r2.tid, r2.pos))
-            else:
-                if not (1, r1.tid, r1.pos) in reasons:
-                    reasons[(1, r1.tid, r1.pos)] = set()
-                if not (2, r2.tid, r2.pos) in reasons:
-                    reasons[(2, r2.tid, r2.pos)] = set()
+        if not (1, r1.tid, r1.pos) in valid:
+            key = (1, r1.tid, r1.pos)
+            if not key in reasons:
+                reasons[key] = set()
+            reasons[key] |= _fail_reasons(r1, reads2, buckets2)
 
-                reasons[(1, r1.tid, r1.pos)].add(reason)
-                reasons[(2, r2.tid, r2.pos)].add(reason)
+    for r2 in reads2:
+        if not (2, r2.tid, r2.pos) in valid:
+            if buckets1 is None:
+                buckets1 = _bucket_reads(reads1)
+            key = (2, r2.tid, r2.pos)
+            if not key in reasons:
+                reasons[key] = set()
+            reasons[key] |= _fail_reasons(r2, reads1, buckets1)
 
     for r1 in reads1:
         if not (1, r1.tid, r1.pos) in valid:
@@ -165,7 +257,11 @@ def find_pairs(reads1, reads2, min_size, max_size, tags):
     return possible, fail1, fail2
 
 
-def bam_pair(out_fname, read1_fname, read2_fname, tags=['AS+', 'NM-'], min_size=50, max_size=1000, fail1_fname=None, fail2_fname=None, reason_tag=None, quiet=False):
+def bam_pair(out_fname, read1_fname, read2_fname, tags=['AS+', 'NM-'], min_size=50, max_size=1000, fail1_fname=None, fail2_fname=None, reason_tag=None, quiet=False, namesort=None):
+    '''
+    If namesort (a NameSorter) is given, the inputs are sorted by name as
+    they are read.
+    '''
     bam1 = pysam.Samfile(read1_fname, "rb")
     bam2 = pysam.Samfile(read2_fname, "rb")
     out = pysam.Samfile('%s.tmp' % out_fname, "wb", template=bam1)
@@ -182,8 +278,12 @@ def bam_pair(out_fname, read1_fname, read2_fname, tags=['AS+', 'NM-'], min_size=
         else:
             fail2 = pysam.Samfile('%s.tmp' % fail2_fname, "wb", template=bam1)
 
-    gen1 = ngsutils.bam.bam_batch_reads(bam1, quiet=quiet)
-    gen2 = ngsutils.bam.bam_batch_reads(bam2, quiet=True)
+    if namesort:
+        gen1 = ngsutils.bam.bam_batch_reads(bam1, reads=namesort.reads(read1_fname, quiet=quiet))
+        gen2 = ngsutils.bam.bam_batch_reads(bam2, reads=namesort.reads(read2_fname, quiet=True))
+    else:
+        gen1 = ngsutils.bam.bam_batch_reads(bam1, quiet=quiet)
+        gen2 = ngsutils.bam.bam_batch_reads(bam2, quiet=True)
 
     reads1 = None
     reads2 = None
@@ -321,6 +421,9 @@ if __name__ == '__main__':
     min_size = 50
     max_size = 10000
     reason_tag = None
+    namesort = None
+    sortmem = 512
+    sortprocs = 1
     tags = []
 
     last = None
@@ -343,8 +446,16 @@ if __name__ == '__main__':
         elif last == '-reason':
             reason_tag = arg
             last = None
-        elif arg in ['-tag', '-fail1', '-fail2', '-size', '-reason']:
+        elif last == '-sortmem':
+            sortmem = int(arg)
+            last = None
+        elif last == '-sortprocs':
+            sortprocs = int(arg)
+            last = None
+        elif arg in ['-tag', '-fail1', '-fail2', '-size', '-reason', '-sortmem', '-sortprocs']:
             last = arg
+        elif arg == '-namesort':
+            namesort = True
         elif not out_fname:
             out_fname = arg
         elif not read1_fname and os.path.exists(arg):
@@ -360,4 +471,6 @@ if __name__ == '__main__':
     if not read1_fname or not read2_fname or not out_fname:
         usage()
     else:
-        bam_pair(out_fname, read1_fname, read2_fname, tags, min_size, max_size, fail1_fname, fail2_fname, reason_tag)
+        if namesort:
+            namesort = NameSorter(sortmem, sortprocs)
+        bam_pair(out_fname, read1_fname, read2_fname, tags, min_size, max_size, fail1_fname, fail2_fname, reason_tag, namesort=namesort)
@@ -13,12 +13,28 @@ The orientation for paired-end reads is assumed to be "FR" (forward-reverse).
 Note: The BAM file must be sorted in order to find duplicates. For paired-end
       reads, the the proper-pair (0x4) flag must be set and the isize/tlen
       field must be correctly calculated.
+
+Duplicates are found using the position, strand, and insert size of the
+first read in each pair. The mates of duplicate reads are flagged when they
+are reached. The names of the mates still to be flagged are kept in memory
+(up to a limit), and are written to a temporary file if there are too many.
+
+If the BAM file is indexed, each reference can be processed in parallel.
+
+If the reads have a unique molecular identifier (UMI) tag, reads at the same
+position are only duplicates if they also have the same UMI. UMIs within a
+given number of mismatches (Hamming distance) can be grouped together, to
+allow for sequencing errors in the UMI.
 '''
 
 import sys
 import os
+import heapq
+import itertools
+import struct
+import tempfile
 import pysam
-from ngsutils.bam import bam_iter
+from ngsutils.bam import bam_iter, bam_map_refs
 
 
 def usage(msg=None):
@@ -42,103 +58,445 @@ Options:
                          mapped to it, but they are not pcr duplicates, then
                          there each will be reported separately.
 
-    You must set either -bam or -counts (or both).
+    -hist filename       Output a histogram of the number of copies of each
+                         read/fragment (copies, count)
+
+    You must set either -bam, -counts, or -hist.
+
+    -p num               Process each reference in parallel using {num}
+                         processes (requires an indexed BAM file)
+
+    -maxpending num      Maximum number of mate names to keep in memory
+                         (per process) before writing them to a temporary
+                         file (default: 1000000)
+
+    -T dir               Temporary directory (default: same as the input)
+
+    -umi tag             Read tag with the UMI for each read
+    -umidist num         Group UMIs with up to {num} mismatches (default: 0)
 
 ''')
 
     sys.exit(1)
 
 
-def __flush_cur_reads(cur_reads, outbam, inbam, countfile=None):
-    if cur_reads:
-        for k in cur_reads:
-            count = 0
+_PENDING = struct.Struct('<qq')
+
+
+class _PendingMates(object):
+    '''
+    Keeps track of the mates of duplicate reads that still need to be flagged.
+    Mates are stored by their position and a hash of the read name.
+
+    If there are more than {max_pending} mates, the half with the farthest
+    positions is written to a temporary file and loaded back when the reads
+    reach those positions.
+    '''
+    def __init__(self, max_pending=1000000, tmpdir=None):
+        self.max_pending = max_pending
+        self.tmpdir = tmpdir
+        self.pending = {}
+        self.positions = []
+        self.size = 0
+
+        self.spilled = []
+        self.tmpfiles = []
+
+    def add(self, pos, name):
+        self._add(pos, name)
+        if self.size > self.max_pending:
+            self._spill()
+
+    def _add(self, pos, name):
+        if not pos in self.pending:
+            self.pending[pos] = set()
+            heapq.heappush(self.positions, pos)
+
+        names = self.pending[pos]
+        if not name in names:
+            names.add(name)
+            self.size += 1
+
+    def pop(self, pos, name):
+        '''
+        Returns True if the mate is pending (and removes it). Mates with a
+        position before pos will never be found, so they are discarded.
+        '''
+        self._load(pos)
+
+        while self.positions and self.positions[0] < pos:
+            oldpos = heapq.heappop(self.positions)
+            if oldpos in self.pending:
+                self.size -= len(self.pending[oldpos])
+                del self.pending[oldpos]
+
+        names = self.pending.get(pos)
+        if names and name in names:
+            names.remove(name)
+            self.size -= 1
+            return True
+        return False
+
+    def _spill(self):
+        positions = sorted(self.pending)
+        spill = positions[len(positions) / 2:]
+        if not spill:
+            return
+
+        tmp = tempfile.NamedTemporaryFile(prefix='.tmp.pcrdup', dir=self.tmpdir, delete=False)
+        for pos in spill:
+            names = self.pending.pop(pos)
+            self.size -= len(names)
+            for name in sorted(names):
+                tmp.write(_PENDING.pack(pos, name))
+        tmp.close()
+
+        self.tmpfiles.append(tmp.name)
+        gen = self._read_tmp(tmp.name)
+        for pos, name in gen:
+            heapq.heappush(self.spilled, (pos, name, gen))
+            break
+
+    def _read_tmp(self, fname, chunk=4096):
+        with open(fname, 'rb') as f:
+            while True:
+                buf = f.read(_PENDING.size * chunk)
+                if not buf:
+                    break
+                for i in xrange(0, len(buf), _PENDING.size):
+                    yield _PENDING.unpack_from(buf, i)
+
+    def _load(self, pos):
+        while self.spilled and self.spilled[0][0] <= pos:
+            spos, name, gen = heapq.heappop(self.spilled)
+            if spos == pos:
+                self._add(spos, name)
+            for spos, name in gen:
+                heapq.heappush(self.spilled, (spos, name, gen))
+                break
+
+    def close(self):
+        self.spilled = []
+        for fname in self.tmpfiles:
+            if os.path.exists(fname):
+                os.unlink(fname)
+        self.tmpfiles = []
+
+
+def _dup_key(read, fragment):
+    '''
+    Packed duplicate key (for reads starting at the same position):
+    (insert size << 1) | strand. Fragments only use the strand.
+    '''
+    strand = 1 if read.is_reverse else 0
+    if fragment:
+        return strand
+    return (read.isize << 1) | strand
+
+
+_umi_bases = 'ACGTN'
+
+
+def _umi_neighbors(umi, dist):
+    'Yields all of the sequences with 1 to {dist} substitutions from umi'
+    for d in xrange(1, dist + 1):
+        for positions in itertools.combinations(xrange(len(umi)), d):
+            for bases in itertools.product(_umi_bases, repeat=d):
+                seq = list(umi)
+                for pos, base in zip(positions, bases):
+                    if seq[pos] == base:
+                        break
+                    seq[pos] = base
+                else:
+                    yield ''.join(seq)
+
+
+def _hamming(one, two, dist):
+    if len(one) != len(two):
+        return False
+    mismatches = 0
+    for a, b in zip(one, two):
+        if a != b:
+            mismatches += 1
+            if mismatches > dist:
+                return False
+    return True
+
+
+def umi_groups(reads, dist=0):
+    '''
+    Groups reads by UMI. reads is a list of (umi, value) tuples. UMIs within
+    {dist} mismatches of each other are (transitively) grouped together.
+    Returns a list of groups (lists of values).
+
+    Similar UMIs are found by looking up each possible neighbor of a UMI in
+    the hash of UMIs present, unless there are few enough UMIs that comparing
+    each pair is faster.
+    '''
+    by_umi = {}
+    for umi, val in reads:
+        if not umi in by_umi:
+            by_umi[umi] = [val]
+        else:
+            by_umi[umi].append(val)
+
+    if not dist or len(by_umi) == 1:
+        return by_umi.values()
+
+    parent = dict([(umi, umi) for umi in by_umi])
+
+    def _find(umi):
+        while parent[umi] != umi:
+            parent[umi] = parent[parent[umi]]
+            umi = parent[umi]
+        return umi
+
+    def _union(one, two):
+        one = _find(one)
+        two = _find(two)
+        if one != two:
+            parent[two] = one
+
+    umis = sorted(by_umi)
+    umilen = max([len(x) for x in umis])
+    neighbors = sum([_choose(umilen, d) * (len(_umi_bases) - 1) ** d for d in xrange(1, dist + 1)])
+
+    if len(umis) < neighbors:
+        for i, one in enumerate(umis):
+            for two in umis[i + 1:]:
+                if _hamming(one, two, dist):
+                    _union(one, two)
+    else:
+        for umi in umis:
+            for neighbor in _umi_neighbors(umi, dist):
+                if neighbor in by_umi:
+                    _union(umi, neighbor)
 
-            for i, (mapq, idx, r) in enumerate(sorted(cur_reads[k])[::-1]):
-                count += 1
-                if i > 0:
-                    r.is_duplicate = True
-                if outbam:
-                    outbam.write(r)
+    groups = {}
+    for umi in umis:
+        root = _find(umi)
+        if not root in groups:
+            groups[root] = []
+        groups[root].extend(by_umi[umi])
 
-            if countfile:
-                countfile.write('%s\t%s\t%s\t%s\n' % (inbam.references[k[0]], k[1], k[2], count))
+    return groups.values()
 
 
-def pcrdup_mark(inbam, outbam, fragment=False, countfile=None):
-    cur_pos = None
-    cur_reads = {}
+def _choose(n, k):
+    val = 1
+    for i in xrange(k):
+        val = val * (n - i) / (i + 1)
+    return val
+
+
+def _read_umi(read, tag):
+    try:
+        return read.opt(tag)
+    except KeyError:
+        return ''
+
+
+def pcrdup_mark(inbam, outbam, fragment=False, countfile=None, histogram=None, max_pending=1000000, tmpdir=None, reads=None, quiet=False, umi_tag=None, umi_dist=0):
+    '''
+    Marks duplicates in a (coordinate sorted) BAM file. By default, all of
+    the reads in inbam are used, but a different read iterator can be given
+    (for example, one reference).
 
-    total = 0
-    unique = 0
-    duplicates = 0
+    If histogram (dict) is given, it is updated with the number of
+    reads/fragments for each number of copies.
 
-    dup_list = set()
+    If umi_tag is given, duplicates must also have the same UMI (or within
+    umi_dist mismatches).
+
+    Returns (total, unique, duplicates).
+    '''
+    stats = [0, 0, 0]  # total, unique, duplicates
+    pending = _PendingMates(max_pending, tmpdir)
+
+    cur_pos = None
+    cur_reads = []  # all reads at the current position
+    cur_dups = {}   # dup key -> [(mapq, -idx, read), ...]
 
     def callback(read):
-        return '%s, %s, %s - %s' % (total, unique, duplicates, read.qname)
+        return '%s, %s, %s - %s' % (stats[0], stats[1], stats[2], read.qname)
+
+    def _flush():
+        for k in sorted(cur_dups):
+            if umi_tag:
+                groups = umi_groups([(_read_umi(val[2], umi_tag), val) for val in cur_dups[k]], umi_dist)
+                groups.sort(key=lambda group: -max([val[1] for val in group]))
+            else:
+                groups = [cur_dups[k]]
+
+            for group in groups:
+                dups = sorted(group)[::-1]
+                stats[1] += 1
+                stats[2] += len(dups) - 1
+
+                for mapq, idx, r in dups[1:]:
+                    r.is_duplicate = True
+                    if not fragment:
+                        pending.add(r.pnext, hash(r.qname))
+
+                if countfile:
+                    if fragment:
+                        countfile.write('%s\t%s\t\t%s\n' % (inbam.references[cur_pos[0]], cur_pos[1], len(dups)))
+                    else:
+                        countfile.write('%s\t%s\t%s\t%s\n' % (inbam.references[cur_pos[0]], cur_pos[1], k >> 1, len(dups)))
 
-    for read in bam_iter(bamfile, callback=callback):
-        if not read.is_paired or read.is_read1:
-            total += 1
+                if histogram is not None:
+                    histogram[len(dups)] = histogram.get(len(dups), 0) + 1
 
-        if read.is_unmapped:
-            __flush_cur_reads(cur_reads, outbam, inbam, countfile)
+        for r, is_mate in cur_reads:
+            if is_mate and pending.pop(r.pos, hash(r.qname)):
+                r.is_duplicate = True
             if outbam:
-                outbam.write(read)
-            continue
+                outbam.write(r)
 
-        start_pos = (read.tid, read.pos)
+    if reads is None:
+        reads = bam_iter(inbam, quiet=quiet, callback=callback)
 
-        if fragment:
-            dup_pos = (read.tid, read.pos, '')
-        else:
-            # isize is the insert length, which if this is the first read, will
-            # be the right most part of the second read. If the ends of the reads
-            # are trimmed for QC reasons, only the 5' pos of the first read and the 3'
-            # pos of the second read will be accurate.
-            
-            dup_pos = (read.tid, read.pos, read.isize)
+    try:
+        for read in reads:
+            if not read.is_paired or read.is_read1:
+                stats[0] += 1
 
-        if not cur_pos or start_pos != cur_pos:
-            __flush_cur_reads(cur_reads, outbam, inbam, countfile)
+            if read.is_unmapped and read.tid < 0:
+                _flush()
+                cur_pos = None
+                cur_reads = []
+                cur_dups = {}
+                if outbam:
+                    outbam.write(read)
+                continue
+
+            start_pos = (read.tid, read.pos)
+
+            if start_pos != cur_pos:
+                _flush()
+                if cur_pos and read.tid != cur_pos[0]:
+                    pending.close()
+                    pending = _PendingMates(max_pending, tmpdir)
+
+                cur_pos = start_pos
+                cur_reads = []
+                cur_dups = {}
+
+            if read.is_unmapped or (not fragment and (read.mate_is_unmapped or not read.is_paired or not read.is_proper_pair or read.isize < 0)):
+                # this is a paired file, but the mate isn't paired or proper or mapped
+                # (or this is the second read). Only flag it if the mate was a duplicate.
+                cur_reads.append((read, not read.is_unmapped and not fragment))
+                continue
+
+            k = _dup_key(read, fragment)
+            if k in cur_dups:
+                cur_dups[k].append((read.mapq, -len(cur_reads), read))
+            else:
+                cur_dups[k] = [(read.mapq, -len(cur_reads), read), ]
 
-            cur_pos = start_pos
-            cur_reads = {}
-            idx = 0
+            cur_reads.append((read, False))
 
-        if not fragment and (read.mate_is_unmapped or not read.is_paired or not read.is_proper_pair or read.isize < 0):
-            # this is a paired file, but the mate isn't paired or proper or mapped
-            # just write it out, no flags to set.
+        _flush()
+    finally:
+        pending.close()
 
-            if read.qname in dup_list:
-                read.is_duplicate = True
-                dup_list.remove(read.qname)
+    return tuple(stats)
 
-            if outbam:
-                outbam.write(read)
-        elif dup_pos in cur_reads:
-            duplicates += 1
-            if not fragment:
-                dup_list.add(read.qname)
-            cur_reads[dup_pos].append((read.mapq, -idx, read))
-        else:
-            unique += 1
-            cur_reads[dup_pos] = [(read.mapq, -idx, read), ]
 
-        idx += 1
+def _pcrdup_ref(fname, ref, tmpdir, fragment, bam_out, counts_out, max_pending, umi_tag, umi_dist):
+    '''
+    Marks duplicates for one reference (for parallel processing). Output is
+    written to temporary files. ref '*' is used for the unplaced unmapped
+    reads at the end of the file.
+    '''
+    inbam = pysam.Samfile(fname, "rb")
 
-    __flush_cur_reads(cur_reads, outbam, inbam, countfile)
+    outname = None
+    outbam = None
+    countname = None
+    countfile = None
+
+    if bam_out:
+        tmp = tempfile.NamedTemporaryFile(prefix='.tmp.pcrdup', suffix='.bam', dir=tmpdir, delete=False)
+        tmp.close()
+        outname = tmp.name
+        outbam = pysam.Samfile(outname, "wb", template=inbam)
+
+    if counts_out:
+        tmp = tempfile.NamedTemporaryFile(prefix='.tmp.pcrdup', suffix='.txt', dir=tmpdir, delete=False)
+        countname = tmp.name
+        countfile = tmp
+
+    histogram = {}
+    stats = pcrdup_mark(inbam, outbam, fragment, countfile, histogram, max_pending, tmpdir, reads=inbam.fetch(ref), umi_tag=umi_tag, umi_dist=umi_dist)
+
+    inbam.close()
+    if outbam:
+        outbam.close()
+    if countfile:
+        countfile.close()
+
+    return outname, countname, histogram, stats
+
+
+def pcrdup_mark_parallel(fname, outname=None, countfile=None, histogram=None, fragment=False, procs=1, max_pending=1000000, tmpdir=None, umi_tag=None, umi_dist=0):
+    '''
+    Marks duplicates for each reference in a separate process (requires an
+    indexed BAM file). The output for each reference is concatenated in order.
+
+    Returns (total, unique, duplicates).
+    '''
+    bam = pysam.Samfile(fname, "rb")
+    refs = list(bam.references) + ['*']
+    bam.close()
+
+    stats = [0, 0, 0]
+    bamparts = []
+
+    try:
+        for partname, countname, hist, part_stats in bam_map_refs(fname, _pcrdup_ref, procs, refs, tmpdir, fragment, outname is not None, countfile is not None, max_pending, umi_tag, umi_dist):
+            if partname:
+                bamparts.append(partname)
+
+            if countname:
+                with open(countname) as f:
+                    for line in f:
+                        countfile.write(line)
+                os.unlink(countname)
+
+            if histogram is not None:
+                for k in hist:
+                    histogram[k] = histogram.get(k, 0) + hist[k]
+
+            for i, val in enumerate(part_stats):
+                stats[i] += val
+
+        if outname:
+            pysam.cat('-o', outname, *bamparts)
+    finally:
+        for partname in bamparts:
+            if os.path.exists(partname):
+                os.unlink(partname)
+
+    return tuple(stats)
+
+
+def _write_histogram(histogram, out):
+    for copies in sorted(histogram):
+        out.write('%s\t%s\n' % (copies, histogram[copies]))
 
-    sys.stdout.write('Total reads:\t%s\n' % total)
-    sys.stdout.write('Unique reads:\t%s\n' % unique)
-    sys.stdout.write('PCR duplicates:\t%s\n' % duplicates)
 
 if __name__ == '__main__':
     infile = None
     outfile = None
     countfname = None
+    histfname = None
     fragment = False
+    procs = 1
+    max_pending = 1000000
+    tmpdir = None
+    umi_tag = None
+    umi_dist = 0
 
     last = None
 
@@ -148,10 +506,28 @@ if __name__ == '__main__':
         elif last == '-counts':
             countfname = arg
             last = None
+        elif last == '-hist':
+            histfname = arg
+            last = None
         elif last == '-bam':
             outfile = arg
             last = None
-        elif arg in ['-counts', '-bam']:
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-maxpending':
+            max_pending = int(arg)
+            last = None
+        elif last == '-T':
+            tmpdir = arg
+            last = None
+        elif last == '-umi':
+            umi_tag = arg
+            last = None
+        elif last == '-umidist':
+            umi_dist = int(arg)
+            last = None
+        elif arg in ['-counts', '-hist', '-bam', '-p', '-maxpending', '-T', '-umi', '-umidist']:
             last = arg
         elif arg == '-frag':
             fragment = True
@@ -166,23 +542,42 @@ if __name__ == '__main__':
             else:
                 usage("%s exists! Not overwriting file." % arg)
 
-    if not infile or not (outfile or countfname):
+    if not infile or not (outfile or countfname or histfname):
         usage()
 
-    bamfile = pysam.Samfile(infile, "rb")
-    bamout = None
-    if outfile:
-        bamout = pysam.Samfile(outfile, "wb", template=bamfile)
+    if not tmpdir:
+        tmpdir = os.path.dirname(os.path.abspath(infile))
 
     if countfname:
         countfile = open(countfname, 'w')
     else:
         countfile = None
 
-    pcrdup_mark(bamfile, bamout, fragment, countfile)
+    histogram = {} if histfname else None
+
+    if procs > 1:
+        if not os.path.exists('%s.bai' % infile):
+            usage('-p requires an indexed BAM file')
+        total, unique, duplicates = pcrdup_mark_parallel(infile, outfile, countfile, histogram, fragment, procs, max_pending, tmpdir, umi_tag, umi_dist)
+    else:
+        bamfile = pysam.Samfile(infile, "rb")
+        bamout = None
+        if outfile:
+            bamout = pysam.Samfile(outfile, "wb", template=bamfile)
+
+        total, unique, duplicates = pcrdup_mark(bamfile, bamout, fragment, countfile, histogram, max_pending, tmpdir, umi_tag=umi_tag, umi_dist=umi_dist)
+
+        bamfile.close()
+        if bamout:
+            bamout.close()
 
-    bamfile.close()
-    if bamout:
-        bamout.close()
     if countfile:
-        countfile.close()
\ No newline at end of file
+        countfile.close()
+
+    if histfname:
+        with open(histfname, 'w') as out:
+            _write_histogram(histogram, out)
+
+    sys.stdout.write('Total reads:\t%s\n' % total)
+    sys.stdout.write('Unique reads:\t%s\n' % unique)
+    sys.stdout.write('PCR duplicates:\t%s\n' % duplicates)
@@ -12,9 +12,16 @@ The following fields will be added to the BED file:
     total unique reads
     total coverage (sum of coverage over each base)
     coverage density (total coverage / length)
+
+In batch mode (-batch), the peaks are sorted and nearby peaks are merged into
+windows. The reads for each window are read once, and the coverage for all of
+the peaks in the window is calculated together. Windows can be processed in
+parallel. In batch mode, coverage is only counted for bases within each peak.
+Peaks are written in the same order as the BED file.
 '''
 import sys
 import os
+import bisect
 from ngsutils.bam import bam_open
 
 
@@ -42,20 +49,234 @@ def bam_peakheight(bam, bed_fobj, mask=1796):
         print '\t'.join([str(x) for x in cols])
 
 
+def _read_cov_blocks(read):
+    '''
+    Yields the (start, end) of the covered blocks of a read. Deletions are
+    counted as covered (like a pileup), skipped regions (N) are not.
+    '''
+    start = read.pos
+    pos = read.pos
+    for op, size in read.cigar:
+        if op in [0, 2, 7, 8]:
+            pos += size
+        elif op == 3:
+            if pos > start:
+                yield start, pos
+            pos += size
+            start = pos
+    if pos > start:
+        yield start, pos
+
+
+def peak_windows(peaks, merge_distance=1000, max_window=1000000):
+    '''
+    Groups peaks into fetch windows. peaks is a list of (ref, start, end, idx).
+    Peaks are sorted and merged into the same window if they are within
+    merge_distance of each other (up to max_window bp per window).
+
+    Yields (ref, [(start, end, idx), ...]) with peaks sorted by start.
+    '''
+    window = []
+    window_ref = None
+    window_start = None
+    window_end = None
+
+    for ref, start, end, idx in sorted(peaks):
+        if window and (ref != window_ref or start > window_end + merge_distance or max(end, window_end) - window_start > max_window):
+            yield window_ref, window
+            window = []
+
+        if not window:
+            window_ref = ref
+            window_start = start
+            window_end = end
+        else:
+            window_end = max(end, window_end)
+
+        window.append((start, end, idx))
+
+    if window:
+        yield window_ref, window
+
+
+def measure_window(bam, ref, peaks, mask=1796):
+    '''
+    Measures all of the peaks in a window at once. peaks is a list of
+    (start, end, idx) sorted by start.
+
+    The coverage for the window is built as runs of constant coverage (from
+    the start/end of each read block), so the cost depends on the number of
+    reads, not the size of the window.
+
+    Returns a list of (idx, max coverage, unique reads, total coverage).
+    '''
+    wstart = peaks[0][0]
+    wend = max([end for start, end, idx in peaks])
+    starts = [start for start, end, idx in peaks]
+    maxlen = max([end - start for start, end, idx in peaks])
+
+    events = []
+    names = [set() for x in peaks]
+
+    for read in bam.fetch(ref, wstart, wend):
+        if read.is_unmapped or read.flag & mask or not read.cigar:
+            continue
+
+        for bstart, bend in _read_cov_blocks(read):
+            if bend <= wstart or bstart >= wend:
+                continue
+
+            events.append((max(bstart, wstart), 1))
+            events.append((min(bend, wend), -1))
+
+            for i in xrange(bisect.bisect_right(starts, bstart - maxlen), bisect.bisect_left(starts, bend)):
+                if peaks[i][1] > bstart:
+                    names[i].add(read.qname)
+
+    events.sort()
+
+    # coverage is covs[i] from positions[i] to positions[i + 1]
+    positions = []
+    covs = []
+    cov = 0
+    for pos, delta in events:
+        cov += delta
+        if positions and positions[-1] == pos:
+            covs[-1] = cov
+        else:
+            positions.append(pos)
+            covs.append(cov)
+
+    results = []
+    for i, (start, end, idx) in enumerate(peaks):
+        j = bisect.bisect_right(positions, start) - 1
+        pos = start
+        max_coverage = 0
+        coverage_acc = 0
+
+        while pos < end:
+            cov = covs[j] if j >= 0 else 0
+            if j + 1 < len(positions) and positions[j + 1] < end:
+                seg_end = positions[j + 1]
+            else:
+                seg_end = end
+
+            coverage_acc += cov * (seg_end - pos)
+            if cov > max_coverage:
+                max_coverage = cov
+
+            pos = seg_end
+            j += 1
+
+        results.append((idx, max_coverage, len(names[i]), coverage_acc))
+
+    return results
+
+
+_worker_bam = None
+
+
+def _window_worker_init(bam_fname):
+    global _worker_bam
+    _worker_bam = bam_open(bam_fname)
+
+
+def _window_worker(args):
+    ref, peaks, mask = args
+    return measure_window(_worker_bam, ref, peaks, mask)
+
+
+def bam_peakheight_batch(bam_fname, bed_fobj, mask=1796, merge_distance=1000, procs=1, out=sys.stdout):
+    '''
+    Batch mode: measures peaks in merged windows (optionally in parallel).
+    Requires an indexed BAM file.
+    '''
+    lines = []
+    peaks = []
+    for line in bed_fobj:
+        cols = line.strip('\n').split('\t')
+        if line[0] == '#' or line.startswith('track') or len(cols) < 3:
+            lines.append(line.strip('\n'))
+            continue
+
+        peaks.append((cols[0], int(cols[1]), int(cols[2]), len(lines)))
+        lines.append(cols)
+
+    jobs = [(ref, window, mask) for ref, window in peak_windows(peaks, merge_distance)]
+
+    if procs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(procs, _window_worker_init, (bam_fname,))
+        results = pool.imap_unordered(_window_worker, jobs)
+    else:
+        pool = None
+        bam = bam_open(bam_fname)
+        results = (measure_window(bam, ref, window, mask) for ref, window, mask in jobs)
+
+    try:
+        for window in results:
+            for idx, max_coverage, read_count, coverage_acc in window:
+                cols = lines[idx]
+                start = int(cols[1])
+                end = int(cols[2])
+                cols.append(max_coverage)
+                cols.append(read_count)
+                cols.append(coverage_acc)
+                cols.append(float(coverage_acc) / (end - start) if end > start else 0.0)
+
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+        else:
+            bam.close()
+
+    for cols in lines:
+        if type(cols) == str:
+            out.write('%s\n' % cols)
+        else:
+            out.write('%s\n' % '\t'.join([str(x) for x in cols]))
+
+
 def usage():
     print __doc__
     print """\
 Usage: bamutils peakheight {options} bamfile peaks.bed
+
+Options:
+  -batch        Measure peaks in merged windows (requires an indexed BAM file)
+  -dist N       Merge peaks within N bp into the same window (batch mode)
+                (default: 1000)
+  -p N          Process windows in parallel using N processes (batch mode)
 """
     sys.exit(1)
 
 if __name__ == "__main__":
     bam_fname = None
     bed_fname = None
+    batch = False
+    merge_distance = 1000
+    procs = 1
+    last = None
 
     for arg in sys.argv[1:]:
         if arg == '-h':
             usage()
+        elif last == '-dist':
+            merge_distance = int(arg)
+            last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif arg in ['-dist', '-p']:
+            last = arg
+        elif arg == '-batch':
+            batch = True
         elif not bam_fname and os.path.exists(arg):
             bam_fname = arg
         elif not bed_fname and os.path.exists(arg):
@@ -66,8 +287,17 @@ if __name__ == "__main__":
     if not bam_fname or not bed_fname:
         usage()
 
-    bam = bam_open(bam_fname)
-    with open(bed_fname) as f:
-        bam_peakheight(bam, f)
+    if batch:
+        if not os.path.exists('%s.bai' % bam_fname):
+            print '-batch requires an indexed BAM file'
+            usage()
+
+        with open(bed_fname) as f:
+            bam_peakheight_batch(bam_fname, f, merge_distance=merge_distance, procs=procs)
+
+    else:
+        bam = bam_open(bam_fname)
+        with open(bed_fname) as f:
+            bam_peakheight(bam, f)
 
-    bam.close()
+        bam.close()
@@ -7,10 +7,17 @@ Calculates simple stats for a BAM file
 
 import os
 import sys
-from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open
+import zlib
+from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open, bam_map_refs
 from ngsutils.gtf import GTF
 from ngsutils.support.regions import RegionTagger
 from ngsutils.support.stats import counts_mean_stdev
+from ngsutils.support.nameset import BoundedNameSet
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
 
 
 class FeatureBin(object):
@@ -97,6 +104,19 @@ class FeatureBin(object):
         if not self._max or self._max < val:
             self._max = val
 
+    def merge(self, other):
+        self.missing += other.missing
+        for val in other.bins:
+            if not val in self.bins:
+                self.bins[val] = 0
+                self._keys.append(val)
+            self.bins[val] += other.bins[val]
+
+        if other._min is not None and (self._min is None or self._min > other._min):
+            self._min = other._min
+        if other._max is not None and (self._max is None or self._max < other._max):
+            self._max = other._max
+
 
 def usage():
     print __doc__
@@ -154,6 +174,48 @@ Options:
 
             Note: For paired-end reads, only the first fragment is counted
                   regardless of the {-all} option above
+
+    -maxnames num
+
+            Reads with multiple mappings (IH/NH > 1) are only counted once,
+            at their primary alignment. If the alignments aren't flagged as
+            secondary (0x100), the first alignment for a read is counted. The
+            number of these reads is also reported. To do this, the names of
+            up to {num} of these reads are stored exactly (default: 10000000).
+            After that, a Bloom filter is used to limit memory use and the
+            estimated error rate is reported. This is the chance that a new
+            read is taken for one that was already seen: it is then missing
+            from the "Multiple mappings" count, and if its alignments aren't
+            flagged as secondary, the read isn't counted at all.
+
+    -nameerror val
+
+            The maximum error rate for the Bloom filter (default: 0.001)
+
+            Note: when stats are merged (-p or -load), the Bloom filters are
+                  combined, so the number of reads with multiple mappings is
+                  an estimate (shown as ~count) and the error rate may be
+                  higher than this value.
+
+    -p num
+
+            Calculate the stats in parallel using {num} processes. Reads are
+            split up by a hash of the read name, so each process reads the
+            whole BAM file.
+
+    -save filename
+
+            Save the stats (for one BAM file) so that they can be updated
+            later with more reads (see -load).
+
+    -load filename
+
+            Add these previously saved stats to the stats for the BAM file.
+            The same -tags, -delim, and -all options must be used.
+
+            For example:
+                bamutils stats -save run.stats run1.bam
+                bamutils stats -load run.stats -save run.stats run2.bam
 """
     sys.exit(1)
 
@@ -184,11 +246,296 @@ class FlagCounts(object):
             if (fd & flag) > 0:
                 self.counts[fd] += 1
 
+    def merge(self, other):
+        for fd in other.counts:
+            self.counts[fd] += other.counts[fd]
+
+
+class StatsAccumulator(object):
+    '''
+    Accumulates the stats for a set of reads. Reads are added one at a time
+    with add(). Stats for separate parts of a file (for example, each
+    reference) can be combined with merge(), and partial stats can be saved
+    to disk (save/load) and updated later.
+
+    references is the list of reference names for the BAM file. regiontagger
+    (optional) is a RegionTagger; only its counts are saved/merged. Reads are
+    tagged in batches of {region_batch} reads (see RegionTagger.tag_reads);
+    call flush() after the last read is added.
+
+    Reads with multiple mappings (IH/NH > 1) are only counted once: at their
+    primary alignment (secondary alignments are skipped), or if there are no
+    secondary flags, at their first alignment. Because of the latter, all of
+    the alignments for a read must be added to the same accumulator (see
+    _stats_shard). The names of the counted reads are tracked with a
+    BoundedNameSet: max_names names are stored exactly, after that a Bloom
+    filter with a false positive rate of name_error is used.
+    '''
+    def __init__(self, references, delim=None, tags=[], show_all=False, regiontagger=None, max_names=10000000, name_error=0.001, region_batch=10000):
+        self.references = list(references)
+        self.delim = delim
+        self.show_all = show_all
+        self.regiontagger = regiontagger
+
+        self.total = 0
+        self.mapped = 0
+        self.unmapped = 0
+        self.flag_counts = FlagCounts()
+        self.tlen_counts = {}
+        self.names = BoundedNameSet(max_names, name_error)
+        self.has_ih = True
+        self.has_nh = True
+
+        self.tagbins = {}
+        for tag in tags:
+            self.tagbins[tag] = FeatureBin(tag)
+
+        # reference key for each tid
+        if delim:
+            self._ref_keys = [rname.split(delim)[0] for rname in self.references]
+        else:
+            self._ref_keys = self.references[:]
+
+        self.refs = {}
+        for key in self._ref_keys:
+            self.refs[key] = 0
+
+        self._region_counts = None
+        self.region_batch = region_batch
+        self._region_reads = []
+
+    @property
+    def region_counts(self):
+        if self.regiontagger:
+            self.flush()
+            return self.regiontagger.counts
+        return self._region_counts
+
+    def flush(self):
+        'Tags any reads that are waiting for the region tagger'
+        if self._region_reads:
+            reads = self._region_reads
+            self._region_reads = []
+            self.regiontagger.tag_reads(reads, [self.references[read.tid] for read in reads])
+
+    def add(self, read):
+        if not self.show_all and read.is_paired and not read.is_read1:
+            # only operate on the first fragment
+            return
+
+        multiple = False
+        if self.has_ih:
+            try:
+                if read.opt('IH') > 1:
+                    multiple = True
+            except KeyError:
+                if not read.is_unmapped:
+                    self.has_ih = False
+                #missing IH tag - ignore
+
+        if self.has_nh and not multiple:
+            try:
+                if read.opt('NH') > 1:
+                    multiple = True
+            except KeyError:
+                if not read.is_unmapped:
+                    self.has_nh = False
+                #missing NH tag - ignore
+
+        if multiple:
+            if read.is_secondary:
+                # reads only count once for this (at the primary alignment)
+                return
+            if not self.names.add(read.qname):
+                # no secondary flags, so only the first alignment counts
+                return
+
+        self.flag_counts.add(read.flag)
+
+        self.total += 1
+        if read.is_unmapped:
+            self.unmapped += 1
+            return
+
+        self.mapped += 1
+
+        if read.is_proper_pair and read.tid == read.mrnm:
+            # we don't care about reads that don't map to the same reference
+
+            # note: this doesn't work for RNA mapped to a reference genome...
+            # for RNA, you'd need to map to a transcript library (refseq) to get
+            # an accurate template length
+            #
+            # just skipping 'N' cigar values won't cut it either... since the pairs
+            # will likely silently span a gap.
+
+            if read.is_reverse:
+                k = -read.tlen
+            else:
+                k = read.tlen
+
+            self.tlen_counts[k] = self.tlen_counts.get(k, 0) + 1
+
+        self.refs[self._ref_keys[read.tid]] += 1
+
+        if self.regiontagger:
+            self._region_reads.append(read)
+            if len(self._region_reads) >= self.region_batch:
+                self.flush()
+
+        for tagbin in self.tagbins.itervalues():
+            tagbin.add(read)
+
+    def merge(self, other):
+        '''
+        Adds the stats from another accumulator (with the same options).
+        '''
+        if sorted(self.tagbins) != sorted(other.tagbins) or self.delim != other.delim or self.show_all != other.show_all:
+            raise ValueError('Stats were calculated with different options!')
+
+        self.total += other.total
+        self.mapped += other.mapped
+        self.unmapped += other.unmapped
+        self.flag_counts.merge(other.flag_counts)
+        self.names.update(other.names)
+
+        for k in other.tlen_counts:
+            self.tlen_counts[k] = self.tlen_counts.get(k, 0) + other.tlen_counts[k]
+
+        for k in other.refs:
+            self.refs[k] = self.refs.get(k, 0) + other.refs[k]
+
+        for tag in other.tagbins:
+            self.tagbins[tag].merge(other.tagbins[tag])
+
+        if other.region_counts:
+            counts = self.region_counts
+            if counts is None:
+                counts = self._region_counts = {}
+            for k in other.region_counts:
+                counts[k] = counts.get(k, 0) + other.region_counts[k]
+
+        return self
+
+    def __getstate__(self):
+        # the region tagger (GTF annotation) isn't saved, only its counts
+        state = self.__dict__.copy()
+        state['_region_counts'] = self.region_counts
+        state['regiontagger'] = None
+        state['_region_reads'] = []
+        return state
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+
+
+_shard_gtf = None
+_shard_tagger = None
+
+
+def _stats_shard(fname, shard, shards, delim, tags, show_all, max_names, name_error):
+    '''
+    Calculates the stats for the reads with a name hash of {shard} (modulo
+    {shards}), for parallel processing. All of the alignments for a read are
+    in the same shard. The region tagger is built once per worker process
+    from the GTF annotation (_shard_gtf).
+    '''
+    global _shard_tagger
+    bamfile = bam_open(fname)
+
+    regiontagger = None
+    if _shard_gtf:
+        if _shard_tagger is None:
+            _shard_tagger = RegionTagger(_shard_gtf, bamfile.references, only_first_fragment=True)
+        regiontagger = _shard_tagger
+        for k in regiontagger.counts:
+            regiontagger.counts[k] = 0
+
+    stats = StatsAccumulator(bamfile.references, delim, tags, show_all, regiontagger, max_names, name_error)
+    for read in bam_iter(bamfile, quiet=True):
+        if zlib.crc32(read.qname) % shards == shard:
+            stats.add(read)
+    stats.flush()
+    bamfile.close()
+
+    return stats
+
+
+def bam_stats_parallel(fname, gtf=None, delim=None, tags=[], show_all=False, procs=1, max_names=10000000, name_error=0.001):
+    '''
+    Splits the reads into {procs} shards by name hash, calculates the stats
+    for each shard in a separate process, and merges them together.
+    '''
+    global _shard_gtf, _shard_tagger
+    bamfile = bam_open(fname)
+    references = list(bamfile.references)
+    bamfile.close()
+
+    stats = StatsAccumulator(references, delim, tags, show_all, None, max_names, name_error)
+    if gtf:
+        stats._region_counts = {}
+
+    # worker processes inherit the GTF annotation
+    _shard_gtf = gtf
+    _shard_tagger = None
+    try:
+        # each job is a shard number (instead of a reference)
+        for part in bam_map_refs(fname, _stats_shard, procs, range(procs), procs, delim, tags, show_all, max_names, name_error):
+            stats.merge(part)
+    finally:
+        _shard_gtf = None
+        _shard_tagger = None
+
+    return stats
+
+
+class _RegionCounts(object):
+    'Region counts from merged/saved stats (in place of a RegionTagger)'
+    def __init__(self, counts):
+        self.counts = counts
+
 
 class BamStats(object):
-    def __init__(self, bamfile, gtf=None, region=None, delim=None, tags=[], show_all=False):
+    def __init__(self, bamfile, gtf=None, region=None, delim=None, tags=[], show_all=False, procs=1, stats=None, max_names=10000000, name_error=0.001):
+        '''
+        Calculates the stats for a BAM file. If procs > 1, the reads are split
+        up by name and processed in parallel. Previously saved
+        stats (a StatsAccumulator) can be given to update them with the reads
+        from this file.
+        '''
+        if procs > 1 and not region:
+            acc = bam_stats_parallel(bamfile.filename, gtf, delim, tags, show_all, procs, max_names, name_error)
+        else:
+            acc = self._calc(bamfile, gtf, region, delim, tags, show_all, max_names, name_error)
+
+        if stats:
+            acc = stats.merge(acc)
+
+        self.stats = acc
+        self.total = acc.total
+        self.mapped = acc.mapped
+        self.unmapped = acc.unmapped
+        self.flag_counts = acc.flag_counts
+        self.tagbins = acc.tagbins
+        self.refs = acc.refs
+        self.tlen_counts = acc.tlen_counts
+        self.names = acc.names
+
+        if acc.regiontagger:
+            self.regiontagger = acc.regiontagger
+        elif acc.region_counts is not None:
+            self.regiontagger = _RegionCounts(acc.region_counts)
+        else:
+            self.regiontagger = None
+
+    def _calc(self, bamfile, gtf, region, delim, tags, show_all, max_names, name_error):
         regiontagger = None
-        flag_counts = FlagCounts()
 
         ref = None
         start = None
@@ -208,123 +555,22 @@ class BamStats(object):
                 end = int(startend)
                 sys.stderr.write('Region: %s:%s\n' % (ref, start + 1))
 
-        total = 0
-        mapped = 0
-        unmapped = 0
-        
-        tlen_counts = {}
-
-        names = set()
-        refs = {}
-
-        tagbins = {}
-        for tag in tags:
-            tagbins[tag] = FeatureBin(tag)
-
-        for rname in bamfile.references:
-            if delim:
-                refs[rname.split(delim)[0]] = 0
-            else:
-                refs[rname] = 0
+        acc = StatsAccumulator(bamfile.references, delim, tags, show_all, regiontagger, max_names, name_error)
 
         # setup region or whole-file readers
-        def _foo1():
-            for read in bamfile.fetch(ref, start, end):
-                yield read
-
-        def _foo2():
-            for read in bam_iter(bamfile):
-                yield read
-
         if region:
-            read_gen = _foo1
+            reads = bamfile.fetch(ref, start, end)
         else:
-            read_gen = _foo2
-
-        has_ih = True
-        has_nh = True
+            reads = bam_iter(bamfile)
 
         try:
-            for read in read_gen():
-                if not show_all and read.is_paired and not read.is_read1:
-                    # only operate on the first fragment
-                    continue
-
-                try:
-                    if has_ih and read.opt('IH') > 1:
-                        if read.qname in names:
-                            # reads only count once for this...
-                            continue
-                        names.add(read.qname)
-                except KeyError:
-                    if not read.is_unmapped:
-                        has_ih = False
-                    #missing IH tag - ignore
-                    pass
-
-                try:
-                    if has_nh and read.opt('NH') > 1:
-                        if read.qname in names:
-                            # reads only count once for this...
-                            continue
-                        names.add(read.qname)
-                except KeyError:
-                    if not read.is_unmapped:
-                        has_nh = False
-                    #missing NH tag - ignore
-                    pass
-
-                flag_counts.add(read.flag)
-
-                total += 1
-                if read.is_unmapped:
-                    unmapped += 1
-                    continue
-
-                mapped += 1
-
-                if read.is_proper_pair and read.tid == read.mrnm:
-                    # we don't care about reads that don't map to the same reference
-
-                    # note: this doesn't work for RNA mapped to a reference genome...
-                    # for RNA, you'd need to map to a transcript library (refseq) to get
-                    # an accurate template length
-                    #
-                    # just skipping 'N' cigar values won't cut it either... since the pairs
-                    # will likely silently span a gap.
-
-                    if read.is_reverse:
-                        k = -read.tlen
-                    else:
-                        k = read.tlen
-
-                    if not k in tlen_counts:
-                        tlen_counts[k] = 1
-                    else:
-                        tlen_counts[k] += 1
-
-                if delim:
-                    refs[bamfile.getrname(read.rname).split(delim)[0]] += 1
-                else:
-                    refs[bamfile.getrname(read.rname)] += 1
-
-                if regiontagger:
-                    regiontagger.add_read(read, bamfile.getrname(read.rname))
-
-                for tag in tagbins:
-                    tagbins[tag].add(read)
-
+            for read in reads:
+                acc.add(read)
         except KeyboardInterrupt:
             sys.stderr.write('*** Interrupted - displaying stats up to this point! ***\n\n')
 
-        self.total = total
-        self.mapped = mapped
-        self.unmapped = unmapped
-        self.flag_counts = flag_counts
-        self.tagbins = tagbins
-        self.refs = refs
-        self.regiontagger = regiontagger
-        self.tlen_counts = tlen_counts
+        acc.flush()
+        return acc
 
     def distribution_gen(self, tag):
         acc = 0.0
@@ -334,7 +580,7 @@ class BamStats(object):
             yield (val, count, pct)
 
 
-def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all=False, fillin_stats=True):
+def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all=False, fillin_stats=True, procs=1, load=None, save=None, max_names=10000000, name_error=0.001):
     if gtf_file:
         gtf = GTF(gtf_file)
     else:
@@ -342,7 +588,18 @@ def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all
 
     sys.stderr.write('Calculating Read stats...\n')
 
-    stats = [BamStats(bam_open(x), gtf, region, delim, tags, show_all=show_all) for x in infiles]
+    stats = []
+    for fname in infiles:
+        partial = None
+        if load:
+            partial = StatsAccumulator.load(load)
+
+        bamfile = bam_open(fname)
+        stats.append(BamStats(bamfile, gtf, region, delim, tags, show_all=show_all, procs=procs, stats=partial, max_names=max_names, name_error=name_error))
+        bamfile.close()
+
+    if save:
+        stats[0].stats.save(save)
 
     sys.stdout.write('\t')
     for fname, stat in zip(infiles, stats):
@@ -364,6 +621,22 @@ def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all
         sys.stdout.write('%s\t\t' % stat.unmapped)
     sys.stdout.write('\n')
 
+    if [stat for stat in stats if stat.names]:
+        sys.stdout.write('Multiple mappings:\t')
+        for stat in stats:
+            if stat.names.estimated:
+                sys.stdout.write('~%s\t\t' % len(stat.names))
+            else:
+                sys.stdout.write('%s\t\t' % len(stat.names))
+        sys.stdout.write('\n')
+
+        if [stat for stat in stats if not stat.names.exact]:
+            # approximate - some reads may not have been counted
+            sys.stdout.write('Multiple mappings error rate:\t')
+            for stat in stats:
+                sys.stdout.write('%0.6f\t\t' % stat.names.error_bound)
+            sys.stdout.write('\n')
+
     sys.stdout.write('\nFlag distribution\n')
     validflags = set()
     maxsize = 0
@@ -507,6 +780,11 @@ if __name__ == '__main__':
     show_all = False
     fillin_stats = True
     tags = []
+    procs = 1
+    load = None
+    save = None
+    max_names = 10000000
+    name_error = 0.001
 
     last = None
     for arg in sys.argv[1:]:
@@ -524,11 +802,29 @@ if __name__ == '__main__':
         elif last == '-tags':
             tags = arg.split(',')
             last = None
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif last == '-load':
+            if not os.path.exists(arg):
+                sys.stderr.write('Missing file: %s\n' % arg)
+                usage()
+            load = arg
+            last = None
+        elif last == '-save':
+            save = arg
+            last = None
+        elif last == '-maxnames':
+            max_names = int(arg)
+            last = None
+        elif last == '-nameerror':
+            name_error = float(arg)
+            last = None
         elif arg == '-all':
             show_all = True
         elif arg == '-nofill':
             fillin_stats = False
-        elif arg in ['-gtf', '-delim', '-tags', '-region']:
+        elif arg in ['-gtf', '-delim', '-tags', '-region', '-p', '-load', '-save', '-maxnames', '-nameerror']:
             last = arg
         elif os.path.exists(arg):
             infiles.append(arg)
@@ -538,5 +834,8 @@ if __name__ == '__main__':
 
     if not infiles:
         usage()
+    elif save and len(infiles) > 1:
+        sys.stderr.write('-save can only be used with one BAM file\n')
+        usage()
     else:
-        bam_stats(infiles, gtf, region, delim, tags, show_all=show_all, fillin_stats=fillin_stats)
+        bam_stats(infiles, gtf, region, delim, tags, show_all=show_all, fillin_stats=fillin_stats, procs=procs, load=load, save=save, max_names=max_names, name_error=name_error)
@@ -3,7 +3,10 @@
 Tests for bamutils export
 '''
 
+import os
+import shutil
 import StringIO
+import tempfile
 import unittest
 
 import ngsutils.bam
@@ -26,6 +29,13 @@ testbam2.add_read('bar2', 'gctagcta', 'AAAAAAAA', is_paired=True, is_read2=True)
 testbam3 = MockBam(['chr1'])
 testbam3.add_read('baz1', 'atcgatcg', 'AAAAAAAA', 0, 0, 8, '8M', mapq=10, isize=100, tlen=120, tags=[('ZZ', 'foo'), ('ZY', 100), ('ZX', 1.0), ('ZW', 'a'), ])
 
+testbam4 = MockBam(['chr1'])
+testbam4.add_read('a', mapq=3)
+for read in testbam4.fetch():
+    read.seq = None
+    read.qual = None
+    read.tags = []
+
 
 class ExportTest(unittest.TestCase):
     def testExport1(self):
@@ -54,6 +64,11 @@ class ExportTest(unittest.TestCase):
         self._run_test(testbam2, ['bar1|65|chr1|chr1|1|101', 'bar1|137|chr1|*|101|0'], fields=['-name', '-flags', '-ref', '-nextref', '-pos', '-nextpos'], unmapped=False)
         self._run_test(testbam2, ['bar2|77|*|*|0|0', 'bar2|141|*|*|0|0'], fields=['-name', '-flags', '-ref', '-nextref', '-pos', '-nextpos'], mapped=False)
 
+    def testMissingSeqQual(self):
+        'Empty fields keep their column'
+        self._run_test(testbam4, ['a|None|None|3'], fields=['-name', '-seq', '-qual', '-mapq'])
+        self._run_test(testbam4, ['a|None|3'], fields=['-name', '-seq', '-tag:*', '-mapq'])
+
     def testExtended(self):
         self._run_test(testbam3, ['baz1|10|100|120'], fields=['-name', '-mapq', '-isize', '-tlen'])
 
@@ -61,6 +76,57 @@ class ExportTest(unittest.TestCase):
         self._run_test(testbam3, ['baz1|ZZ:Z:foo|ZY:i:100|ZX:f:1.0|ZW:A:a'], fields=['-name', '-tag:*'])
         self._run_test(testbam3, ['baz1|foo'], fields=['-name', '-tag:ZZ'])
 
+    def testExportRead(self):
+        out = StringIO.StringIO('')
+        for read in testbam1.fetch():
+            ngsutils.bam.export.export_read(testbam1, read, ['-name', '-strand'], out)
+        self.assertEqual(out.getvalue(), 'foo3\t+\nfoo1\t+\nfoo2\t-\n')
+
+    def testBuffered(self):
+        out = StringIO.StringIO('')
+        ngsutils.bam.export.bam_export(testbam1, fields=['-name', '-pos'], out=out, quiet=True, bufsize=2)
+        self.assertEqual(out.getvalue(), 'foo3\t0\nfoo1\t1\nfoo2\t5\n')
+
+    @unittest.skipIf(ngsutils.bam.export.numpy is None, 'requires NumPy')
+    def testColumns(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fields = ['-name', '-ref', '-pos', '-mapq', '-tag:ZY', '-tag:ZX', '-tag:ZZ']
+            npz = os.path.join(tmpdir, 'out.npz')
+            ngsutils.bam.export.bam_export_columns(testbam3, npz, fields=fields, quiet=True)
+            cols = ngsutils.bam.export.numpy.load(npz)
+            self.assertEqual(list(cols['pos']), [1])
+            self.assertEqual(list(cols['mapq']), [10])
+            self.assertEqual(list(cols['tag_ZY']), [100])
+            self.assertEqual(list(cols['tag_ZX']), [1.0])
+            self.assertEqual(list(cols['tag_ZZ.values'][cols['tag_ZZ']]), ['foo'])
+            cols.close()
+
+            outdir = os.path.join(tmpdir, 'cols')
+            ngsutils.bam.export.bam_export_columns(testbam1, outdir, fields=['-ref', '-pos', '-tag:ZZ'], quiet=True)
+            self.assertEqual(sorted(os.listdir(outdir)), ['pos.npy', 'ref.npy', 'ref.values.npy', 'tag_ZZ.npy', 'tag_ZZ.values.npy'])
+            ref = ngsutils.bam.export.numpy.load(os.path.join(outdir, 'ref.npy'))
+            values = ngsutils.bam.export.numpy.load(os.path.join(outdir, 'ref.values.npy'))
+            self.assertEqual(list(values[ref]), ['*', 'chr1', 'chr1'])
+            self.assertEqual(list(ngsutils.bam.export.numpy.load(os.path.join(outdir, 'pos.npy'))), [0, 1, 5])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testMixedColumn(self):
+        'Numeric tags that are missing for some reads are stored as strings'
+        col = ngsutils.bam.export._Column()
+        for val in [1, 2, '', 2]:
+            col.add(val)
+        self.assertEqual(col.kind, 'str')
+        self.assertEqual(col.strings, ['1', '2', ''])
+        self.assertEqual(list(col.codes), [0, 1, 2, 1])
+
+        col = ngsutils.bam.export._Column()
+        for val in [1, 2.5]:
+            col.add(val)
+        self.assertEqual(col.kind, 'float')
+        self.assertEqual(list(col.values), [1.0, 2.5])
+
 
     def _run_test(self, testbam, valid, *args, **kwargs):
         out = StringIO.StringIO('')
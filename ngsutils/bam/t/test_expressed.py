@@ -4,9 +4,13 @@ Tests for bamutils expressed
 '''
 
 import os
+import shutil
+import tempfile
 import StringIO
 import unittest
 
+import pysam
+
 import ngsutils.bam
 import ngsutils.bam.expressed
 
@@ -34,6 +38,45 @@ class ExpressedTest(unittest.TestCase):
     def testExpressedLongMerge(self):
         self._run_test(['chr1|100|259|+', 'chr1|500|570|+', 'chr1|800|911|+'], merge_distance=11)
 
+    def testExpressedParallel(self):
+        out = StringIO.StringIO('')
+        ngsutils.bam.expressed.bam_find_regions(infname, min_read_count=1, out=out)
+        out2 = StringIO.StringIO('')
+        ngsutils.bam.expressed.bam_find_regions(infname, min_read_count=1, out=out2, procs=2)
+        self.assertEqual(out.getvalue(), out2.getvalue())
+
+    def testExpressedParallelRefs(self):
+        'Regions are written in the same order with more than one reference'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'refs.bam')
+            out = pysam.Samfile(fname, 'wb', header={'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]})
+            for i, (tid, pos, is_reverse) in enumerate([(0, 100, False), (0, 110, True), (1, 100, False), (1, 300, False)]):
+                for j in xrange(2):
+                    read = pysam.AlignedRead()
+                    read.qname = 'read%s_%s' % (i, j)
+                    read.tid = tid
+                    read.pos = pos + j
+                    read.seq = 'ACGTACGTAC'
+                    read.cigar = [(0, 10)]
+                    read.is_reverse = is_reverse
+                    out.write(read)
+            out.close()
+            pysam.index(fname)
+
+            out = StringIO.StringIO('')
+            ngsutils.bam.expressed.bam_find_regions(fname, out=out)
+            out2 = StringIO.StringIO('')
+            ngsutils.bam.expressed.bam_find_regions(fname, out=out2, procs=2)
+            self.assertEqual(out.getvalue(), out2.getvalue())
+            self.assertEqual([tuple(line.split('\t')[:6]) for line in out.getvalue().strip().split('\n')],
+                             [('chr1', '100', '111', 'region_1', '2', '+'),
+                              ('chr1', '110', '121', 'region_2', '2', '-'),
+                              ('chr2', '100', '111', 'region_3', '2', '+'),
+                              ('chr2', '300', '311', 'region_4', '2', '+')])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def _run_test(self, valid, *args, **kwargs):
         out = StringIO.StringIO('')
         ngsutils.bam.expressed.bam_find_regions(infname, out=out, *args, **kwargs)
@@ -5,9 +5,12 @@ Tests for bamutils extract
 
 import unittest
 import os
+import StringIO
 
+import pysam
 import ngsutils.bam
 import ngsutils.bam.extract
+import ngsutils.bed
 
 from ngsutils.bam.t import MockBam, _matches
 
@@ -58,6 +61,38 @@ class ExtractTest(unittest.TestCase):
         passed = [x.qname for x in ngsutils.bam.extract.bam_extract_reads(testbam1, 'chr1', 200, 250, None)]
         self.assertTrue(_matches(['foo2', 'foo4', 'foo5'], passed))
 
+    def testWindows(self):
+        bed = ngsutils.bed.BedFile(fileobj=StringIO.StringIO('chr1\t200\t250\nchr1\t240\t300\nchr1\t300\t310\nchr2\t10\t20\nchr1\t100\t150\n'))
+        self.assertEqual(ngsutils.bam.extract.extract_windows(bed), [('chr1', 100, 150), ('chr1', 200, 310), ('chr2', 10, 20)])
+        self.assertEqual(ngsutils.bam.extract.extract_windows(bed, 50), [('chr1', 100, 310), ('chr2', 10, 20)])
+
+    def testExtractParallel(self):
+        '''
+        Overlapping regions and spliced reads spanning windows are only
+        written once, in coordinate order.
+        '''
+        infile = os.path.join(os.path.dirname(__file__), 'test.bam')
+        outfile = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+        with open(self.fname2, 'w') as f:
+            f.write('chr1\t100\t110\n')
+            f.write('chr1\t105\t180\n')
+            f.write('chr1\t700\t710\n')
+            f.write('chr1\t400\t410\n')
+
+        inbam = pysam.Samfile(infile, 'rb')
+        outbam = MockBam(['chr1', 'chr2'])
+        ngsutils.bam.extract.bam_extract(inbam, outbam, self.fname2, quiet=True)
+        inbam.close()
+        self.assertEqual([x.qname for x in outbam], ['A', 'B', 'E', 'D'])
+
+        try:
+            ngsutils.bam.extract.bam_extract_parallel(infile, outfile, self.fname2, procs=2, batch_size=1, quiet=True)
+            bam = pysam.Samfile(outfile, 'rb')
+            self.assertEqual([x.qname for x in bam], ['A', 'B', 'E', 'D'])
+            bam.close()
+        finally:
+            os.unlink(outfile)
+
     def testExtractTouching(self):
         passed = [x.qname for x in ngsutils.bam.extract.bam_extract_reads(testbam1, 'chr1', 2520, 2540, None)]
         self.assertTrue(_matches(['foo6'], passed))
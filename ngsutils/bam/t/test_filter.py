@@ -217,6 +217,7 @@ class FilterTest(unittest.TestCase):
         self.assertTrue(mismatch.filter(bam, read2))  # 1 mismatch
         self.assertFalse(mismatch.filter(bam, read3))  # 2 mismatches
         self.assertFalse(mismatch.filter(bam, read4))  # unmapped
+        self.assertEqual(mismatch.ref.window, 0)  # not sorted, so no read-ahead
         mismatch.close()
 
     def testMismatch(self):
@@ -346,6 +347,58 @@ class FilterTest(unittest.TestCase):
         self.assertFalse(eq2.filter(None, read3))
         eq2.close()
 
+    def testCompiledCriteria(self):
+        reads = [MockRead('foo1', 'AAAAAAAAAA', tid=0, pos=1, mapq=20, tags=[('ZZ', 1)]),
+                 MockRead('foo2', 'AAAAAAAAAA', tid=0, pos=1, mapq=20, tags=[('ZZ', 3)]),
+                 MockRead('foo3', 'A', tid=0, pos=1, mapq=20, tags=[('ZZ', 3)]),
+                 MockRead('foo4', 'A', mapq=20, tags=[('ZZ', 3)]),
+                 MockRead('foo5', 'AAAAAAAAAA', tid=0, pos=1, mapq=2, tags=[('ZZ', 1)]),
+                 MockRead('foo6', 'AAAAAAAAAAAAAAA', tid=0, pos=1, mapq=20, tags=[('ZZ', 1)]),
+                 MockRead('foo7', 'AAAAAAAAAA', tid=0, pos=1, is_secondary=True, tags=[('ZZ', 3)])]
+
+        criteria = [ngsutils.bam.filter.TagLessThan('ZZ', 2),
+                    ngsutils.bam.filter.ReadMinLength(5),
+                    ngsutils.bam.filter.Mapped(),
+                    ngsutils.bam.filter.TagGreaterThan('MAPQ', 10),
+                    ngsutils.bam.filter.ReadMaxLength(12),
+                    ngsutils.bam.filter.SecondaryFlag()]
+
+        chain = ngsutils.bam.filter.CompiledCriteria(criteria, reorder_interval=2, sample_rate=1)
+
+        for i in xrange(3):  # repeat so that the chain is re-ordered
+            for read in reads:
+                expected = None
+                for criterion in criteria:
+                    if not criterion.filter(None, read):
+                        expected = criterion
+                        break
+                self.assertEqual(chain.filter(None, read), expected)
+
+    def testCompiledCriteriaModifiesRead(self):
+        'Tag criteria after a criterion that adds tags see the new tags'
+        class AddTag(object):
+            modifies_read = True
+
+            def filter(self, bam, read):
+                if read.qname != 'foo3':
+                    read.tags = read.tags + [('ZS', 1)]
+                return True
+
+        criteria = [ngsutils.bam.filter.TagLessThan('ZZ', 2),
+                    AddTag(),
+                    ngsutils.bam.filter.TagEqual('ZS', 1),
+                    ngsutils.bam.filter.Mapped()]
+
+        chain = ngsutils.bam.filter.CompiledCriteria(criteria, reorder_interval=2, sample_rate=1)
+        self.assertEqual(len(chain.segments), 3)
+
+        for i in xrange(3):  # repeat so that the chain is re-ordered
+            reads = [MockRead('foo1', 'AAAAAAAAAA', tid=0, pos=1, tags=[('ZZ', 1)]),
+                     MockRead('foo2', 'AAAAAAAAAA', tid=0, pos=1, tags=[('ZZ', 3)]),
+                     MockRead('foo3', 'AAAAAAAAAA', tid=0, pos=1, tags=[('ZZ', 1)]),
+                     MockRead('foo4', 'AAAAAAAAAA', tags=[('ZZ', 1)])]
+            self.assertEqual([chain.filter(None, read) for read in reads], [None, criteria[0], criteria[2], criteria[3]])
+
     def testMismatchDBSNP(self):
         ''' MISSING TEST / EXPERIMENTAL
         TODO: write test
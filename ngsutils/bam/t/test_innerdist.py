@@ -5,9 +5,13 @@ Tests for bamutils extract
 
 import unittest
 import os
+import shutil
+import tempfile
 
+import pysam
 import ngsutils.bam
-from ngsutils.bam.innerdist import bam_innerdist
+import ngsutils.support.stats
+from ngsutils.bam.innerdist import bam_innerdist, bam_innerdist_parallel, DistanceHistogram
 
 from ngsutils.bam.t import MockBam, _matches
 
@@ -58,6 +62,51 @@ class InnerDistTest(unittest.TestCase):
         self.assertEqual(mean, 75.0)
         self.assertEqual(round(stdev, 5), 28.86751)
 
+    def testSample(self):
+        total, proper, mean, stdev, o_count = bam_innerdist(testbam1, testbam2, sample=2)
+        self.assertEqual((total, proper, mean), (2, 2, 50.0))
+
+    def testHistogram(self):
+        hist = DistanceHistogram(-10, 10)
+        vals = [-20, -5, 0, 0, 7, 15, 1000]
+        for val in vals:
+            hist.add(val)
+
+        self.assertEqual((hist.underflow, hist.overflow), (1, 2))
+        self.assertEqual(hist.counts(), {-5: 1, 0: 2, 7: 1})
+        self.assertEqual(hist.mean_stdev(), ngsutils.support.stats.mean_stdev(vals))
+
+        (mlow, mhigh), (slow, shigh) = hist.confidence()
+        mean, stdev = hist.mean_stdev()
+        self.assertTrue(mlow < mean < mhigh)
+        self.assertTrue(slow < stdev < shigh)
+
+    def testParallel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnames = []
+            for i, testbam in enumerate([testbam1, testbam2]):
+                fname = os.path.join(tmpdir, '%s.bam' % i)
+                out = pysam.Samfile(fname, 'wb', header={'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+                for read in testbam.fetch():
+                    new = pysam.AlignedRead()
+                    new.qname = read.qname
+                    new.seq = 'A' * 50
+                    new.tid = read.tid
+                    if read.tid == -1:
+                        new.is_unmapped = True
+                    else:
+                        new.pos = read.pos
+                        new.cigar = [(0, 50)]
+                    out.write(new)
+                out.close()
+                fnames.append(fname)
+
+            self.assertEqual(bam_innerdist_parallel(fnames[0], fnames[1]), bam_innerdist(testbam1, testbam2))
+            self.assertEqual(bam_innerdist_parallel(fnames[0], fnames[1], sample=2)[:3], (2, 2, 50.0))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
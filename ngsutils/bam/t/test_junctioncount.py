@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils junctioncount
+'''
+
+import unittest
+import StringIO
+
+from ngsutils.bam.junctioncount import bam_junction_count, read_junctions
+from ngsutils.bam.t import MockBam, MockRead
+
+
+class JunctionCountTest(unittest.TestCase):
+    def testReadJunctions(self):
+        read = MockRead('foo1', tid=0, pos=100, cigar='5S10M100N20M2D5M200N15M')
+        self.assertEqual(list(read_junctions(read)), [(110, 210, 10), (237, 437, 15)])
+
+    def testJunctionCount(self):
+        bam = MockBam(['chr1', 'chr2'])
+        bam.add_read('foo1', tid=0, pos=100, cigar='10M100N20M', tags=[('XS', '+')])
+        bam.add_read('foo1', tid=0, pos=105, cigar='5M100N25M', tags=[('XS', '+')])  # mate, same junction
+        bam.add_read('foo2', tid=0, pos=102, cigar='8M100N10M50N10M', tags=[('XS', '+')])
+        bam.add_read('foo3', tid=0, pos=106, cigar='4M100N30M', tags=[('XS', '-')])
+        bam.add_read('foo4', tid=0, pos=500, cigar='30M')
+        bam.add_read('foo5', tid=1, pos=100, cigar='10M10N20M')
+
+        out = StringIO.StringIO('')
+        bam_junction_count(bam, out=out, quiet=True)
+        self.assertEqual(out.getvalue(), '''\
+chr1:110-210\t3
+chr1:220-270\t1
+chr2:110-120\t1
+''')
+
+        out = StringIO.StringIO('')
+        bam_junction_count(bam, out=out, quiet=True, stranded=True, anchors=True)
+        self.assertEqual(out.getvalue(), '''\
+chr1:110-210\t+\t2\t10
+chr1:110-210\t-\t1\t4
+chr1:220-270\t+\t1\t10
+chr2:110-120\t.\t1\t10
+''')
+
+
+if __name__ == '__main__':
+    unittest.main()
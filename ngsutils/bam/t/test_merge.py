@@ -38,9 +38,34 @@ class MergeTest(unittest.TestCase):
             elif read.qname == 'Z':  # still unmapped
                 self.assertTrue(read.is_unmapped)
 
+    def testHeapMerge(self):
+        'Name-sorted inputs with reads missing from any file'
+        gens = [iter([('A', 1), ('C', 1)]), iter([('B', 2), ('C', 2), ('D', 2)]), iter([('A', 3)])]
+        merged = [[(i, group[0]) for i, group in matches] for matches in ngsutils.bam.merge._heap_merge(gens)]
+        self.assertEqual(merged, [[(0, 'A'), (2, 'A')], [(1, 'B')], [(0, 'C'), (1, 'C')], [(1, 'D')]])
+
+        gens = [iter([('B', 1), ('A', 1)]), iter([('C', 2)])]
+        self.assertRaises(ValueError, list, ngsutils.bam.merge._heap_merge(gens))
+
+    def testHeapMergeNatural(self):
+        "Inputs sorted with 'samtools sort -n'"
+        gens = [iter([('read9', 1), ('read10', 1)]), iter([('read2', 2), ('read10', 2), ('read10a', 2)])]
+        merged = [[(i, group[0]) for i, group in matches] for matches in ngsutils.bam.merge._heap_merge(gens, ngsutils.bam.merge.natural_name_key)]
+        self.assertEqual(merged, [[(1, 'read2')], [(0, 'read9')], [(0, 'read10'), (1, 'read10')], [(1, 'read10a')]])
+
+        gens = [iter([('read9', 1), ('read10', 1)])]
+        self.assertRaises(ValueError, list, ngsutils.bam.merge._heap_merge(gens))
+
+    def testOrderedMerge(self):
+        'Secondary files are in the same order as the first, with missing reads'
+        gens = [iter([('B', 1), ('A', 1), ('C', 1)]), iter([('A', 2), ('C', 2)])]
+        merged = [[(i, group[0]) for i, group in matches] for matches in ngsutils.bam.merge._ordered_merge(gens)]
+        self.assertEqual(merged, [[(0, 'B')], [(0, 'A'), (1, 'A')], [(0, 'C'), (1, 'C')]])
+
     def tearDown(self):
         outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
-        os.unlink(outfname)
+        if os.path.exists(outfname):
+            os.unlink(outfname)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils namesort
+'''
+
+import os
+import unittest
+
+import ngsutils.bam
+import ngsutils.bam.namesort
+
+
+class NameSortTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        self.outfname = os.path.join(os.path.dirname(__file__), 'tmp.bam')
+
+    def tearDown(self):
+        if os.path.exists(self.outfname):
+            os.unlink(self.outfname)
+
+    def _expected(self):
+        bam = ngsutils.bam.bam_open(self.fname)
+        reads = [(read.qname, i, str(read)) for i, read in enumerate(bam)]
+        bam.close()
+        return [x[2] for x in sorted(reads)]
+
+    def testInMemory(self):
+        reads = [str(read) for read in ngsutils.bam.namesort.bam_namesort_iter(self.fname, quiet=True)]
+        self.assertEqual(reads, self._expected())
+
+    def testSpill(self):
+        'A zero memory budget writes each read to its own chunk'
+        reads = [str(read) for read in ngsutils.bam.namesort.bam_namesort_iter(self.fname, mem=0, quiet=True)]
+        self.assertEqual(reads, self._expected())
+
+        reads = [str(read) for read in ngsutils.bam.namesort.bam_namesort_iter(self.fname, mem=0, procs=2, quiet=True)]
+        self.assertEqual(reads, self._expected())
+
+        # only temporary files from this test would match
+        tmpfiles = [x for x in os.listdir(os.path.dirname(self.fname)) if x.startswith('.tmp')]
+        self.assertEqual(tmpfiles, [])
+
+    def testNameSort(self):
+        ngsutils.bam.namesort.bam_namesort(self.fname, self.outfname, quiet=True)
+        bam = ngsutils.bam.bam_open(self.outfname)
+        self.assertEqual(bam.header['HD']['SO'], 'queryname')
+        self.assertEqual([read.qname for read in bam], ['A', 'B', 'C', 'D', 'E', 'F', 'Z'])
+        bam.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils pair
+'''
+
+import random
+import unittest
+
+from ngsutils.bam.pair import find_pairs, is_valid_pair
+from ngsutils.bam.t import MockRead
+
+
+def _find_pairs_all(reads1, reads2, min_size, max_size, tags):
+    'Compares every combination (for checking find_pairs)'
+    possible = []
+    valid = set()
+    reasons = {}
+
+    for r1 in reads1:
+        for r2 in reads2:
+            reasons.setdefault((1, r1.tid, r1.pos), set())
+            reasons.setdefault((2, r2.tid, r2.pos), set())
+
+            is_valid, reason = is_valid_pair(r1, r2)
+            if is_valid:
+                ins_size = max(r2.aend - r1.pos, r1.aend - r2.pos)
+                if ins_size < min_size or ins_size > max_size:
+                    reasons[(1, r1.tid, r1.pos)].add('size')
+                    reasons[(2, r2.tid, r2.pos)].add('size')
+                    continue
+
+                tag_val = []
+                for tag in tags:
+                    val = float(r1.opt(tag[:2])) + float(r2.opt(tag[:2]))
+                    if tag[-1] == '+':
+                        val = -val
+                    tag_val.append(val)
+                possible.append((tag_val, ins_size, r1, r2))
+                valid.add((1, r1.tid, r1.pos))
+                valid.add((2, r2.tid, r2.pos))
+            else:
+                reasons[(1, r1.tid, r1.pos)].add(reason)
+                reasons[(2, r2.tid, r2.pos)].add(reason)
+
+    fail1 = [(r1, reasons[(1, r1.tid, r1.pos)]) for r1 in reads1 if not (1, r1.tid, r1.pos) in valid]
+    fail2 = [(r2, reasons[(2, r2.tid, r2.pos)]) for r2 in reads2 if not (2, r2.tid, r2.pos) in valid]
+    return possible, fail1, fail2
+
+
+def _random_reads(rand, name, count):
+    reads = []
+    for i in xrange(count):
+        if rand.random() < 0.1:
+            reads.append(MockRead(name, tags=[('AS', 0), ('NM', 0)]))
+        else:
+            reads.append(MockRead(name, tid=rand.randint(0, 1), pos=rand.randint(0, 2000), cigar='50M', is_reverse=rand.random() < 0.5, tags=[('AS', rand.randint(0, 50)), ('NM', rand.randint(0, 3))]))
+    return reads
+
+
+class PairTest(unittest.TestCase):
+    def testFindPairs(self):
+        rand = random.Random(1)
+        for i in xrange(50):
+            reads1 = _random_reads(rand, 'foo', rand.randint(1, 20))
+            reads2 = _random_reads(rand, 'foo', rand.randint(1, 20))
+
+            expected = _find_pairs_all(reads1, reads2, 50, 500, ['AS+', 'NM-'])
+            possible, fail1, fail2 = find_pairs(reads1, reads2, 50, 500, ['AS+', 'NM-'])
+
+            self.assertEqual(possible, expected[0])
+            self.assertEqual(fail1, expected[1])
+            self.assertEqual(fail2, expected[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
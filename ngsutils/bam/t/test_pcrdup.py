@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils pcrdup
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import pysam
+import ngsutils.bam.pcrdup
+
+
+def _pair(bam, name, tid, pos1, pos2, mapq=20, umi=None):
+    size = pos2 + 10 - pos1
+    reads = []
+    for i, (pos, mpos, isize) in enumerate([(pos1, pos2, size), (pos2, pos1, -size)]):
+        read = pysam.AlignedRead()
+        read.qname = name
+        read.seq = 'ACGTACGTAC'
+        read.qual = 'IIIIIIIIII'
+        read.tid = tid
+        read.pos = pos
+        read.mapq = mapq
+        read.cigar = [(0, 10)]
+        read.rnext = tid
+        read.pnext = mpos
+        read.isize = isize
+        read.is_paired = True
+        read.is_proper_pair = True
+        read.is_read1 = i == 0
+        read.is_read2 = i == 1
+        read.is_reverse = i == 1
+        read.mate_is_reverse = i == 0
+        if umi:
+            read.tags = [('RX', umi)]
+        reads.append(read)
+    return reads
+
+
+class PCRDupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'test.bam')
+
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 10000}, {'SN': 'chr2', 'LN': 10000}]}
+        reads = []
+        reads.extend(_pair(None, 'A', 0, 100, 200))
+        reads.extend(_pair(None, 'B', 0, 100, 200, mapq=30))  # dup of A (better)
+        reads.extend(_pair(None, 'C', 0, 100, 300))
+        reads.extend(_pair(None, 'D', 0, 100, 200))  # dup of B
+        reads.extend(_pair(None, 'E', 0, 150, 5000))
+        reads.extend(_pair(None, 'F', 0, 150, 5000))  # dup of E (distant mate)
+        reads.extend(_pair(None, 'G', 1, 100, 200))
+        reads.extend(_pair(None, 'H', 1, 500, 600, umi='AAAA'))
+        reads.extend(_pair(None, 'I', 1, 500, 600, umi='AAAT'))
+        reads.extend(_pair(None, 'J', 1, 500, 600, umi='CCCC', mapq=30))
+        reads.extend(_pair(None, 'K', 1, 500, 600, umi='CCCC'))
+
+        out = pysam.Samfile(self.fname, 'wb', header=header)
+        for read in sorted(reads, key=lambda r: (r.tid, r.pos)):
+            out.write(read)
+        out.close()
+        pysam.index(self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dups(self, fname):
+        bam = pysam.Samfile(fname, 'rb')
+        dups = sorted(['%s/%s' % (read.qname, 1 if read.is_read1 else 2) for read in bam if read.is_duplicate])
+        bam.close()
+        return dups
+
+    def testMark(self):
+        expected = ['A/1', 'A/2', 'D/1', 'D/2', 'F/1', 'F/2']
+
+        for procs, max_pending in [(1, 1000000), (1, 1), (2, 1000000), (2, 1)]:
+            outname = os.path.join(self.tmpdir, 'out.bam')
+            counts = StringIO.StringIO()
+            histogram = {}
+
+            if procs == 1:
+                inbam = pysam.Samfile(self.fname, 'rb')
+                outbam = pysam.Samfile(outname, 'wb', template=inbam)
+                stats = ngsutils.bam.pcrdup.pcrdup_mark(inbam, outbam, countfile=counts, histogram=histogram, max_pending=max_pending, tmpdir=self.tmpdir, quiet=True)
+                inbam.close()
+                outbam.close()
+            else:
+                stats = ngsutils.bam.pcrdup.pcrdup_mark_parallel(self.fname, outname, counts, histogram, procs=procs, max_pending=max_pending, tmpdir=self.tmpdir)
+
+            self.assertEqual(stats, (11, 5, 6))
+            self.assertEqual(self._dups(outname), expected + ['H/1', 'H/2', 'I/1', 'I/2', 'K/1', 'K/2'])
+            self.assertEqual(histogram, {1: 2, 2: 1, 3: 1, 4: 1})
+            self.assertEqual(counts.getvalue(), 'chr1\t100\t110\t3\nchr1\t100\t210\t1\nchr1\t150\t4860\t2\nchr2\t100\t110\t1\nchr2\t500\t110\t4\n')
+            self.assertEqual(sorted(os.listdir(self.tmpdir)), ['out.bam', 'test.bam', 'test.bam.bai'])
+            os.unlink(outname)
+
+    def testUMI(self):
+        outname = os.path.join(self.tmpdir, 'out.bam')
+        expected = ['A/1', 'A/2', 'D/1', 'D/2', 'F/1', 'F/2']
+
+        for umi_dist, dups in [(0, ['K/1', 'K/2']), (1, ['I/1', 'I/2', 'K/1', 'K/2'])]:
+            for procs in [1, 2]:
+                histogram = {}
+                stats = ngsutils.bam.pcrdup.pcrdup_mark_parallel(self.fname, outname, histogram=histogram, procs=procs, tmpdir=self.tmpdir, umi_tag='RX', umi_dist=umi_dist)
+                self.assertEqual(self._dups(outname), expected + dups)
+                self.assertEqual(stats[2], 3 + len(dups) / 2)
+                os.unlink(outname)
+
+    def testUMIGroups(self):
+        'Neighbor lookup and pairwise comparison give the same groups'
+        random.seed(1)
+        umis = [''.join([random.choice('ACGT') for i in xrange(4)]) for j in xrange(60)]
+
+        for dist in [1, 2]:
+            groups = ngsutils.bam.pcrdup.umi_groups([(umi, umi) for umi in umis], dist)
+            found = sorted([sorted(set(group)) for group in groups])
+
+            parent = dict([(umi, umi) for umi in umis])
+
+            def _find(umi):
+                while parent[umi] != umi:
+                    umi = parent[umi]
+                return umi
+
+            for one in umis:
+                for two in umis:
+                    if sum([a != b for a, b in zip(one, two)]) <= dist and _find(one) != _find(two):
+                        parent[_find(two)] = _find(one)
+
+            components = {}
+            for umi in set(umis):
+                components.setdefault(_find(umi), []).append(umi)
+
+            self.assertEqual(found, sorted([sorted(x) for x in components.values()]))
+
+        self.assertEqual(sorted(ngsutils.bam.pcrdup.umi_groups([('AA', 1), ('AT', 2), ('AA', 3)], 0)), [[1, 3], [2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Tests for bamutils peakheight
+'''
+
+import os
+import StringIO
+import unittest
+
+import ngsutils.bam
+import ngsutils.bam.peakheight
+
+infname = os.path.join(os.path.dirname(__file__), 'test4.bam')
+
+_peaks = '''\
+track name=peaks
+chr1\t100\t160\tpeak1
+chr1\t140\t260\tpeak2
+chr1\t300\t400\tpeak3
+chr1\t490\t510\tpeak4
+chr1\t1000\t1100\tpeak5
+chr1\t860\t870\tpeak6
+'''
+
+
+class PeakHeightTest(unittest.TestCase):
+    def _expected(self):
+        'Per-base coverage from the reads'
+        coverage = {}
+        names = {}
+        bam = ngsutils.bam.bam_open(infname)
+        for read in bam:
+            if read.is_unmapped or read.flag & 1796:
+                continue
+            for start, end in ngsutils.bam.peakheight._read_cov_blocks(read):
+                for pos in xrange(start, end):
+                    coverage[pos] = coverage.get(pos, 0) + 1
+                    names.setdefault(pos, set()).add(read.qname)
+        bam.close()
+
+        lines = []
+        for line in _peaks.split('\n'):
+            cols = line.split('\t')
+            if len(cols) < 3:
+                if line:
+                    lines.append(line)
+                continue
+            start = int(cols[1])
+            end = int(cols[2])
+            covs = [coverage.get(pos, 0) for pos in xrange(start, end)]
+            reads = set()
+            for pos in xrange(start, end):
+                reads |= names.get(pos, set())
+            cols.extend([max(covs), len(reads), sum(covs), float(sum(covs)) / (end - start)])
+            lines.append('\t'.join([str(x) for x in cols]))
+        return '%s\n' % '\n'.join(lines)
+
+    def testBatch(self):
+        expected = self._expected()
+        for merge_distance in [0, 1000]:
+            for procs in [1, 2]:
+                out = StringIO.StringIO()
+                ngsutils.bam.peakheight.bam_peakheight_batch(infname, StringIO.StringIO(_peaks), merge_distance=merge_distance, procs=procs, out=out)
+                self.assertEqual(out.getvalue(), expected)
+
+    def testWindows(self):
+        peaks = [('chr1', 100, 200, 0), ('chr2', 100, 200, 1), ('chr1', 250, 300, 2), ('chr1', 5000, 5100, 3)]
+        windows = list(ngsutils.bam.peakheight.peak_windows(peaks, 100))
+        self.assertEqual(windows, [('chr1', [(100, 200, 0), (250, 300, 2)]), ('chr1', [(5000, 5100, 3)]), ('chr2', [(100, 200, 1)])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,18 @@ Tests for bamutils stats
 '''
 
 import os
+import random
+import shutil
+import tempfile
 import unittest
+import StringIO
+
+import pysam
 
 import ngsutils.bam
 import ngsutils.bam.stats
+from ngsutils.gtf import GTF
+from ngsutils.support.regions import RegionTagger
 
 
 class StatsTest(unittest.TestCase):
@@ -28,9 +36,172 @@ class StatsTest(unittest.TestCase):
         self.assertTrue('chr1' in stats.refs)   # 6 on chr1
         self.assertTrue('chr3' not in stats.refs)
 
+    def _stats(self, *args, **kwargs):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        stats = ngsutils.bam.stats.BamStats(bam, *args, **kwargs)
+        bam.close()
+        return stats
+
+    def _values(self, stats):
+        return (stats.total, stats.mapped, stats.unmapped, stats.flag_counts.counts, stats.refs, stats.tlen_counts, [(tag, list(stats.tagbins[tag]), stats.tagbins[tag].max, stats.tagbins[tag].missing) for tag in sorted(stats.tagbins)])
+
+    def testParallel(self):
+        serial = self._stats(tags=['AS', 'MAPQ', 'NM'])
+        parallel = self._stats(tags=['AS', 'MAPQ', 'NM'], procs=2)
+        self.assertEqual(self._values(serial), self._values(parallel))
+        self.assertEqual(parallel.tagbins['AS'].mean, 8.0 / 6)
+
+    def testMerge(self):
+        reads = list(self.bam.fetch(until_eof=True))
+        parts = []
+        for i in xrange(3):
+            acc = ngsutils.bam.stats.StatsAccumulator(self.bam.references, tags=['AS'])
+            for read in reads[i::3]:
+                acc.add(read)
+            parts.append(acc)
+
+        parts[0].merge(parts[1]).merge(parts[2])
+        self.assertEqual(self._values(parts[0]), self._values(self._stats(tags=['AS'])))
+
+        self.assertRaises(ValueError, parts[0].merge, ngsutils.bam.stats.StatsAccumulator(self.bam.references, tags=['NM']))
+
+    def testSaveLoad(self):
+        tmp = tempfile.NamedTemporaryFile(suffix='.stats', delete=False)
+        tmp.close()
+        try:
+            self._stats(tags=['AS']).stats.save(tmp.name)
+            saved = ngsutils.bam.stats.StatsAccumulator.load(tmp.name)
+            self.assertEqual(saved.total, 7)
+
+            stats = self._stats(tags=['AS'], stats=saved)
+            self.assertEqual(stats.total, 14)
+            self.assertEqual(stats.refs['chr1'], 12)
+            self.assertEqual(list(stats.tagbins['AS']), [(1, 10), (3, 2)])
+        finally:
+            os.unlink(tmp.name)
+
+    def _multiple_reads(self, secondary=True, tag='IH'):
+        '''
+        Reads with three mappings each, the primary alignment is on chr2 for
+        odd reads. If secondary is False, no alignment is flagged as secondary.
+        '''
+        reads = []
+        for i in xrange(100):
+            for j, tid in enumerate([0, 0, 1]):
+                read = pysam.AlignedRead()
+                read.qname = 'read%s' % i
+                read.tid = tid
+                read.pos = i + j
+                read.seq = 'ACGT'
+                read.cigar = [(0, 4)]
+                read.is_secondary = secondary and j != (2 if i % 2 else 0)
+                read.tags = [(tag, 3)]
+                reads.append(read)
+        return reads
+
+    def testMultipleMappings(self):
+        reads = self._multiple_reads()
+
+        for max_names in [1000, 10]:
+            stats = ngsutils.bam.stats.StatsAccumulator(['chr1', 'chr2'], max_names=max_names, name_error=0.01)
+            for read in reads:
+                stats.add(read)
+
+            self.assertEqual(stats.total, 100)
+            self.assertEqual(stats.refs, {'chr1': 50, 'chr2': 50})
+            self.assertEqual(stats.flag_counts.counts[0x100], 0)
+
+            if stats.names.exact:
+                self.assertEqual(len(stats.names), 100)
+            else:
+                self.assertTrue(95 <= len(stats.names) <= 100)
+                self.assertTrue(0 < stats.names.error_bound < 0.01)
+
+    def testMultipleMappingsNoSecondary(self):
+        'Without secondary flags, a read is counted at its first alignment'
+        reads = self._multiple_reads(secondary=False, tag='NH')
+
+        for max_names in [1000, 10]:
+            stats = ngsutils.bam.stats.StatsAccumulator(['chr1', 'chr2'], max_names=max_names, name_error=0.01)
+            for read in reads:
+                stats.add(read)
+
+            self.assertEqual(stats.names.exact, max_names == 1000)
+            if stats.names.exact:
+                self.assertEqual((stats.total, stats.mapped, len(stats.names)), (100, 100, 100))
+                self.assertEqual(stats.refs, {'chr1': 100, 'chr2': 0})
+            else:
+                # a Bloom filter false positive means that a read isn't counted
+                self.assertTrue(95 <= stats.total == stats.mapped == len(stats.names) <= 100)
+
+    def testMultipleMappingsParallel(self):
+        'Reads mapped to more than one reference are counted once with -p'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'multi.bam')
+            out = pysam.Samfile(fname, 'wb', header={'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]})
+            for read in sorted(self._multiple_reads(), key=lambda r: (r.tid, r.pos)):
+                out.write(read)
+            out.close()
+            pysam.index(fname)
+
+            # no secondary flags, not indexed
+            fname2 = os.path.join(tmpdir, 'multi2.bam')
+            out = pysam.Samfile(fname2, 'wb', header={'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]})
+            for read in sorted(self._multiple_reads(secondary=False, tag='NH'), key=lambda r: (r.tid, r.pos)):
+                out.write(read)
+            out.close()
+
+            for name in [fname, fname2]:
+                results = []
+                for procs in [1, 2, 3]:
+                    bam = ngsutils.bam.bam_open(name)
+                    stats = ngsutils.bam.stats.BamStats(bam, procs=procs)
+                    bam.close()
+                    results.append(self._values(stats) + (len(stats.names),))
+
+                self.assertEqual(results[0], results[1])
+                self.assertEqual(results[0], results[2])
+                self.assertEqual(results[0][:3], (100, 100, 0))
+                self.assertEqual(results[0][-1], 100)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def testStatsGTF(self):
-        # Add a test with a mock GTF file
-        pass
+        'Reads are tagged in batches, with the same counts as tagging each read'
+        fname = os.path.join(os.path.dirname(__file__), '..', '..', 'gtf', 't', 'test1.gtf')
+        gtf = GTF(fileobj=StringIO.StringIO(open(fname).read()), quiet=True)
+
+        random.seed(1)
+        reads = []
+        for i in xrange(200):
+            read = pysam.AlignedRead()
+            read.qname = 'read%s' % i
+            read.seq = 'A' * 10
+            read.tid = random.choice([0, 1])
+            read.pos = random.randint(0, 5000)
+            read.is_reverse = random.random() < 0.5
+            read.cigar = [(0, 10)]
+            reads.append(read)
+
+        tagger = RegionTagger(gtf, only_first_fragment=True)
+        for read in reads:
+            tagger.add_read(read, ['chr1', 'chr2'][read.tid])
+
+        acc = ngsutils.bam.stats.StatsAccumulator(['chr1', 'chr2'], regiontagger=RegionTagger(gtf, only_first_fragment=True), region_batch=7)
+        for read in reads:
+            acc.add(read)
+        self.assertEqual(acc.region_counts, tagger.counts)
+        self.assertTrue(tagger.counts['coding'] > 0)
+
+        # merged partial stats are flushed first
+        parts = []
+        for i in xrange(2):
+            part = ngsutils.bam.stats.StatsAccumulator(['chr1', 'chr2'], regiontagger=RegionTagger(gtf, only_first_fragment=True), region_batch=1000)
+            for read in reads[i::2]:
+                part.add(read)
+            parts.append(part)
+        self.assertEqual(parts[0].merge(parts[1]).region_counts, tagger.counts)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,6 @@
 import os
+import array
+import bisect
 import ngsutils.support.ngs_utils
 import pysam
 
@@ -280,3 +282,91 @@ class BedRegion(object):
         outcols.append(self.chrom)
 
         return '\t'. join([str(x) for x in outcols[::-1]])
+
+
+class BedNearest(object):
+    '''
+    Finds the nearest region(s) in a BED file for a query position.
+
+    Regions are indexed for each chromosome (and each chromosome/strand) as
+    sorted arrays of start and end positions. Each query is then answered
+    with a binary search, instead of fetching larger and larger windows.
+    '''
+    def __init__(self, bed):
+        regions = {}
+        for region in bed:
+            for strand in set([None, region.strand]):
+                if not (region.chrom, strand) in regions:
+                    regions[(region.chrom, strand)] = []
+                regions[(region.chrom, strand)].append(region)
+
+        self._index = {}
+        for k in regions:
+            self._index[k] = _BedNearestRegions(regions[k])
+
+    def nearest(self, chrom, start, end, strand=None, maxdist=None, match=None):
+        '''
+        Returns a list of the nearest regions to [start, end] as tuples:
+        (distance, orientation, region). Orientation is '' (overlapping),
+        'up' (region is before the query), or 'down' (region is after the
+        query). All regions with the same (smallest) distance are returned.
+
+        If strand is given, only regions on that strand are used. If match
+        (a function) is given, only regions where match(region) is True are
+        used. Regions further than maxdist away are ignored.
+        '''
+        if not (chrom, strand) in self._index:
+            return []
+        return self._index[(chrom, strand)].nearest(start, end, maxdist, match)
+
+
+class _BedNearestRegions(object):
+    def __init__(self, regions):
+        self.by_start = sorted(regions, key=lambda r: (r.start, r.end))
+        self.starts = array.array('l', [r.start for r in self.by_start])
+
+        # running max of the end positions (in start order), to find overlaps
+        self.max_ends = array.array('l')
+        max_end = None
+        for r in self.by_start:
+            if max_end is None or r.end > max_end:
+                max_end = r.end
+            self.max_ends.append(max_end)
+
+        self.by_end = sorted(regions, key=lambda r: (r.end, r.start))
+        self.ends = array.array('l', [r.end for r in self.by_end])
+
+    def nearest(self, start, end, maxdist=None, match=None):
+        found = []
+        for i in xrange(bisect.bisect_left(self.max_ends, start), bisect.bisect_right(self.starts, end)):
+            region = self.by_start[i]
+            if region.end >= start and (match is None or match(region)):
+                found.append((0, '', region))
+
+        if found:
+            return found
+
+        # regions ending before the query
+        best = maxdist
+        i = bisect.bisect_left(self.ends, start) - 1
+        while i >= 0:
+            dist = start - self.ends[i]
+            if best is not None and dist > best:
+                break
+            if match is None or match(self.by_end[i]):
+                found.append((dist, 'up', self.by_end[i]))
+                best = dist
+            i -= 1
+
+        # regions starting after the query
+        i = bisect.bisect_right(self.starts, end)
+        while i < len(self.starts):
+            dist = self.starts[i] - end
+            if best is not None and dist > best:
+                break
+            if match is None or match(self.by_start[i]):
+                found.append((dist, 'down', self.by_start[i]))
+                best = dist
+            i += 1
+
+        return [x for x in found if x[0] == best]
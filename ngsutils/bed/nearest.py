@@ -8,40 +8,19 @@ For each BED region, find the nearest annotated region from a reference file.
 
 import sys
 import os
-import ngsutils.bam
-from ngsutils.bed import BedFile
+from ngsutils.bed import BedFile, BedNearest
 
 
 def find_nearest(inbed, refbed, maxdist=100000, restrict_name=False, nostrand=False, out=sys.stdout):
+    index = BedNearest(refbed)
+
     for qregion in inbed:
+        match = None
+        if restrict_name:
+            match = lambda region: qregion.name in region.name
 
-        dists = []  # will be an list tuples: (abs_val of the distance, 'up/down') (respective to + strand)
-
-        start = max(0, qregion.start - maxdist)
-        end = qregion.end + maxdist
-
-        for region in refbed.fetch(qregion.chrom, start, end, qregion.strand if not nostrand else None):
-            if restrict_name:
-                if restrict_name and qregion.name not in region.name:
-                    continue
-
-            if region.start <= qregion.start <= region.end:
-                # start is w/in region
-                dists.append((0, '', region))
-                continue
-            elif region.start <= qregion.end <= region.end:
-                # end is w/in region
-                dists.append((0, '', region))
-                continue
-            elif qregion.start <= region.start <= region.end <= qregion.end:
-                # read spans the entire region
-                dists.append((0,'', region))
-                continue
-            elif region.end < qregion.start:
-                dists.append((qregion.start - region.end, 'up', region))
-            else:
-                dists.append((region.start - qregion.end, 'down', region))
-            
+        # will be an list tuples: (abs_val of the distance, 'up/down', region) (respective to + strand)
+        dists = index.nearest(qregion.chrom, qregion.start, qregion.end, qregion.strand if not nostrand else None, maxdist, match)
 
         if dists:
             dists.sort()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Tests for bedutils nearest (and BedNearest)
+'''
+
+import random
+import unittest
+import StringIO
+
+import ngsutils.bed.nearest
+from ngsutils.bed import BedFile, BedNearest, BedRegion
+
+
+refbed = BedFile(fileobj=StringIO.StringIO('''\
+chr1|100|150|geneA_tss|0|+
+chr1|300|310|geneB_tss|0|-
+chr1|400|500|geneC_tss|0|+
+chr1|400|500|geneD_tss|0|+
+chr2|100|200|geneE_tss|0|+
+'''.replace('|', '\t')))
+
+
+class NearestTest(unittest.TestCase):
+    def testNearest(self):
+        qbed = BedFile(fileobj=StringIO.StringIO('''\
+chr1|120|130|q1|0|+
+chr1|200|210|q2|0|+
+chr1|600|610|geneA|0|+
+chr1|250|260|q4|0|-
+chr3|250|260|q5|0|-
+'''.replace('|', '\t')))
+
+        out = StringIO.StringIO()
+        ngsutils.bed.nearest.find_nearest(qbed, refbed, out=out)
+        self.assertEqual(out.getvalue(), '''\
+chr1|120|130|geneA_tss|0
+chr1|200|210|geneA_tss|50
+chr1|250|260|geneB_tss|40
+chr1|600|610|geneC_tss|100
+chr1|600|610|geneD_tss|100
+chr3|250|260|*|
+'''.replace('|', '\t'))
+
+        out = StringIO.StringIO()
+        ngsutils.bed.nearest.find_nearest(qbed, refbed, maxdist=60, restrict_name=True, out=out)
+        self.assertEqual(out.getvalue().split('\n')[3], 'chr1\t600\t610\t*\t')
+
+        out = StringIO.StringIO()
+        ngsutils.bed.nearest.find_nearest(qbed, refbed, restrict_name=True, out=out)
+        self.assertEqual(out.getvalue().split('\n')[3], 'chr1\t600\t610\tgeneA_tss\t450')
+
+    def testBruteForce(self):
+        'Compare to checking every region'
+        random.seed(1)
+        regions = []
+        for i in xrange(200):
+            start = random.randint(0, 10000)
+            regions.append(BedRegion('chr1', start, start + random.randint(0, 300), 'r%s' % i, 0, random.choice('+-')))
+
+        index = BedNearest(regions)
+
+        for i in xrange(500):
+            start = random.randint(0, 10500)
+            end = start + random.randint(0, 100)
+            strand = random.choice(['+', '-', None])
+            maxdist = random.choice([None, 10, 100])
+
+            dists = []
+            for region in regions:
+                if strand and region.strand != strand:
+                    continue
+                if region.start <= end and region.end >= start:
+                    dists.append((0, '', region))
+                elif region.end < start:
+                    dists.append((start - region.end, 'up', region))
+                else:
+                    dists.append((region.start - end, 'down', region))
+
+            if maxdist is not None:
+                dists = [x for x in dists if x[0] <= maxdist]
+            if dists:
+                best = min([x[0] for x in dists])
+                dists = [x for x in dists if x[0] == best]
+
+            self.assertEqual(sorted(index.nearest('chr1', start, end, strand, maxdist)), sorted(dists))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -49,6 +49,35 @@ gggggggggg
         self.assertEqual(valid, sio.getvalue())
         sio.close()
 
+    def testBedFASTABatches(self):
+        'Batches of regions are written in the same order as the BedFile'
+        bed = BedFile(fileobj=StringIO.StringIO('''\
+test2|5|15|bar1|10|-
+test1|30|40|foo3|10|+
+test1|0|10|foo1|10|-
+test2|0|40|bar2|10|+
+test1|15|25|foo2|10|+
+'''.replace('|', '\t')))
+
+        valid = '''\
+>foo1|test1:0-10[-]
+tttttttttt
+>foo2|test1:15-25[+]
+cccccggggg
+>foo3|test1:30-40[+]
+tttttttttt
+>bar2|test2:0-40[+]
+atcgatcgatcgatcgatcgatcgatcgatcgatcgatcg
+>bar1|test2:5-15[-]
+gatcgatcga
+'''
+
+        for batchsize in [1, 2, 100]:
+            sio = StringIO.StringIO("")
+            ngsutils.bed.tofasta.bed_tofasta(bed, fasta, min_size=10, stranded=True, include_name=True, out=sio, batchsize=batchsize)
+            self.assertEqual(valid, sio.getvalue())
+            sio.close()
+
 
 if __name__ == '__main__':
     unittest.main()
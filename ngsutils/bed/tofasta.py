@@ -12,35 +12,47 @@ import sys
 import os
 from ngsutils.bed import BedFile
 from ngsutils.support import revcomp
+from ngsutils.support.refcache import fetch_regions
 import pysam
 
 
-def bed_tofasta(bed, ref_fasta, min_size=50, stranded=True, include_name=False, out=sys.stdout):
+def bed_tofasta(bed, ref_fasta, min_size=50, stranded=True, include_name=False, out=sys.stdout, batchsize=100000):
+    '''
+    Writes the sequence for each BED region. Regions are extracted in sorted
+    batches of {batchsize} (see ngsutils.support.refcache.fetch_regions), but
+    are written in the same order as the BED file.
+    '''
     if not os.path.exists('%s.fai' % ref_fasta):
         pysam.faidx(ref_fasta)
 
-    fasta = pysam.Fastafile(ref_fasta)
-
     refs = set()
     with open('%s.fai' % ref_fasta) as f:
         for line in f:
             refs.add(line.split('\t')[0].strip())
 
+    def _regions():
+        for region in bed:
+            if region.end - region.start >= min_size and region.chrom in refs:
+                yield (region.chrom, region.start, region.end, region)
+
+    buf = []
     name = ''
-    for region in bed:
+    for (chrom, start, end, region), seq in fetch_regions(ref_fasta, _regions(), batchsize=batchsize):
         if include_name:
             name = '%s|' % (region.name.strip())
 
-        if region.end - region.start >= min_size and region.chrom in refs:
-            seq = fasta.fetch(region.chrom, region.start, region.end)
-            if stranded and region.strand:
-                if region.strand == '-':
-                    seq = revcomp(seq)
-                out.write('>%s%s:%d-%d[%s]\n%s\n' % (name, region.chrom, region.start, region.end, region.strand, seq))
-            else:
-                out.write('>%s%s:%d-%d\n%s\n' % (name, region.chrom, region.start, region.end, seq))
+        if stranded and region.strand:
+            if region.strand == '-':
+                seq = revcomp(seq)
+            buf.append('>%s%s:%d-%d[%s]\n%s\n' % (name, chrom, start, end, region.strand, seq))
+        else:
+            buf.append('>%s%s:%d-%d\n%s\n' % (name, chrom, start, end, seq))
+
+        if len(buf) >= 10000:
+            out.write(''.join(buf))
+            buf = []
 
-    fasta.close()
+    out.write(''.join(buf))
 
 
 def usage():
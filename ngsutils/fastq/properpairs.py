@@ -7,21 +7,396 @@ removed from either file. This program will then find all of the properly
 paired reads. Valid pairs will be written to new output files that may be
 optionally gzip compressed.
 
-Caution: this can use up to 2X the disk space of each FASTQ file!
+There are three ways to find the pairs:
+
+hash    (default) The second file is indexed in memory (a hash of the read
+        name => the offset of the read in the file). The first file is then
+        streamed and pairs are written in the same order as the first file.
+        If the second file has more reads than the memory budget, the name
+        hashes and offsets of both files (not the reads) are split into
+        partitions in temporary files, each partition is joined separately,
+        and the results are merged back into the order of the first file.
+        Compressed or streamed input for the second file is first copied to
+        an uncompressed temporary file.
+
+window  For files that are (mostly) in the same order. Both files are read
+        together and reads are matched within a look-ahead window. No index
+        is needed, but mates that are further apart than the window are
+        missed.
+
+sort    Both files are sorted by name and then merge-joined. Output is
+        sorted by name. Caution: this can use up to 2X the disk space of
+        each FASTQ file!
 '''
 
 import os
 import sys
 import gzip
+import heapq
+import shutil
+import collections
 
 import tempfile
 
-from ngsutils.fastq import FASTQ
+from eta import ETA
+from ngsutils.fastq import FASTQ, fastq_read_file
 
 import ngsutils.fastq.sort
 
 
-def find_fastq_pairs(fq1, fq2, out1, out2, tmpdir=None, quiet=False):
+def find_fastq_pairs(fq1, fq2, out1, out2, tmpdir=None, quiet=False, method='hash', max_reads=2000000, window=10000):
+    '''
+    Writes the reads that are present in both FASTQ files to out1/out2.
+    Returns (pairs, discarded_1, discarded_2).
+
+    method is 'hash', 'window', or 'sort' (see above). max_reads is the
+    number of reads that are held in memory for the hash method, window is
+    the size of the look-ahead window for the window method.
+    '''
+    if method == 'hash':
+        pairs = hash_join_pairs(fq1, fq2, max_reads, tmpdir, quiet)
+    elif method == 'window':
+        pairs = window_pairs(fq1, fq2, window, quiet)
+    elif method == 'sort':
+        return sort_join_pairs(fq1, fq2, out1, out2, tmpdir, quiet)
+    else:
+        raise ValueError('Unknown method: %s' % method)
+
+    count = 0
+    for read1, read2 in pairs:
+        read1.write(out1)
+        read2.write(out2)
+        count += 1
+
+    return count, pairs.discarded_1, pairs.discarded_2
+
+
+# name hash used for the index (collisions are resolved by comparing names)
+_name_hash = hash
+
+
+def _read_at(fileobj):
+    'Reads the next read from fileobj, returns (read, number of bytes) or (None, 0) at EOF'
+    lines = []
+    for i in xrange(4):
+        line = fileobj.readline()
+        if not line:
+            return None, 0
+        lines.append(line)
+    return fastq_read_file(iter(lines)), sum([len(x) for x in lines])
+
+
+def _fetch_offsets(fq, quiet=False):
+    'Yields (offset, read) for each read in a FASTQ file'
+    if fq.fname and fq.fname != '-' and not quiet:
+        eta = ETA(os.stat(fq.fname).st_size, fileobj=fq.fileobj)
+    else:
+        eta = None
+
+    offset = fq.tell()
+    while True:
+        read, size = _read_at(fq.fileobj)
+        if not read:
+            break
+        if eta:
+            eta.print_status(extra=read.name)
+        yield offset, read
+        offset += size
+
+    if eta:
+        eta.done()
+
+
+def _add_offset(index, key, offset):
+    'Adds an offset to the index (name hash => offset, or a tuple of offsets for colliding hashes)'
+    val = index.get(key)
+    if val is None:
+        index[key] = offset
+    elif type(val) == tuple:
+        index[key] = val + (offset,)
+    else:
+        index[key] = (val, offset)
+
+
+def _offsets(val):
+    if type(val) == tuple:
+        return val
+    return (val,)
+
+
+def _find_mate(fq, offsets, name):
+    'Returns the read named {name} stored at one of the offsets in fq (or None)'
+    for offset in offsets:
+        fq.seek(offset)
+        read, size = _read_at(fq.fileobj)
+        if read and read.name == name:
+            return read
+    return None
+
+
+def _tmpdir(fq, tmpdir):
+    if tmpdir:
+        return tmpdir
+    if fq.fname and fq.fname != '-':
+        return os.path.dirname(os.path.abspath(fq.fname))
+    return None
+
+
+class hash_join_pairs(object):
+    '''
+    Yields (read1, read2) pairs in the order of the first file.
+
+    The second file is indexed by name hash => file offset. For each read in
+    the first file, the second file is read at the matching offset(s) and
+    the names are compared, so a hash collision can't pair the wrong reads.
+    If the second file has more than max_reads reads, (hash, offset) entries
+    for both files are partitioned by name hash into temporary files. Each
+    partition is joined separately, the results are merged by the position
+    of the read in the first file, and the reads are then read back from
+    both files.
+
+    The second file must allow random access. Compressed or streamed (stdin)
+    input is first copied to an uncompressed temporary file. The first file
+    only needs to be seekable when the index is partitioned.
+
+    Once all pairs have been yielded, discarded_1 and discarded_2 hold the
+    number of unpaired reads in each file.
+    '''
+    def __init__(self, fq1, fq2, max_reads=2000000, tmpdir=None, quiet=False, partitions=None):
+        self.fq1 = fq1
+        self.fq2 = fq2
+        self.max_reads = max_reads
+        self.tmpdir = _tmpdir(fq1, tmpdir)
+        self.quiet = quiet
+        self.partitions = partitions
+        self.discarded_1 = 0
+        self.discarded_2 = 0
+        self._tmpfiles = []
+        self._spooled = []
+
+    def __iter__(self):
+        try:
+            for pair in self._join():
+                yield pair
+        finally:
+            for fq in self._spooled:
+                fq.close()
+            for tmpfile in self._tmpfiles:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+            self._tmpfiles = []
+            self._spooled = []
+
+    def _tempfile(self):
+        tmp = tempfile.NamedTemporaryFile(prefix='.tmp', dir=self.tmpdir, delete=False)
+        self._tmpfiles.append(tmp.name)
+        return tmp
+
+    def _seekable(self, fq, random_access=True):
+        '''
+        Returns fq if it can be read by offset, otherwise it is copied
+        (uncompressed) to a temporary file. Gzip files can seek, but only
+        forward seeks are fast.
+        '''
+        if isinstance(fq.fileobj, gzip.GzipFile):
+            if not random_access:
+                return fq
+        else:
+            try:
+                fq.fileobj.seek(fq.fileobj.tell())
+                return fq
+            except (AttributeError, IOError):
+                pass
+
+        tmp = self._tempfile()
+        shutil.copyfileobj(fq.fileobj, tmp)
+        tmp.close()
+
+        spooled = FASTQ(fileobj=open(tmp.name))
+        self._spooled.append(spooled)
+        return spooled
+
+    def _join(self):
+        fq2 = self._seekable(self.fq2)
+
+        index = {}
+        count2 = 0
+        reader2 = _fetch_offsets(fq2, quiet=self.quiet)
+
+        for offset, read in reader2:
+            count2 += 1
+            _add_offset(index, _name_hash(read.name), offset)
+            if len(index) > self.max_reads:
+                for pair in self._partitioned(fq2, index, reader2, count2, offset):
+                    yield pair
+                return
+
+        pairs = 0
+        count1 = 0
+        for read1 in self.fq1.fetch(quiet=self.quiet):
+            count1 += 1
+            offsets = index.get(_name_hash(read1.name))
+            if offsets is not None:
+                read2 = _find_mate(fq2, _offsets(offsets), read1.name)
+                if read2:
+                    pairs += 1
+                    yield read1, read2
+
+        self.discarded_1 = count1 - pairs
+        self.discarded_2 = count2 - pairs
+
+    def _partition_count(self, count2, offset2):
+        if self.partitions:
+            return self.partitions
+
+        # estimate the number of reads in file 2 from the file size
+        total = count2 * 2
+        fname = self.fq2.fname
+        if fname and fname != '-' and os.path.exists(fname):
+            size = os.stat(fname).st_size
+            if fname[-3:] == '.gz' or fname[-4:] == '.bgz':
+                size = size * 4  # typical compression ratio
+            total = max(total, size / max(1, offset2 / count2))
+
+        # aim for partitions of about half the memory budget
+        return max(2, (total * 2 / self.max_reads) + 1)
+
+    def _partitioned(self, fq2, index, reader2, count2, offset2):
+        fq1 = self._seekable(self.fq1, random_access=False)
+        nparts = self._partition_count(count2, offset2)
+
+        parts1 = [self._tempfile() for i in xrange(nparts)]
+        parts2 = [self._tempfile() for i in xrange(nparts)]
+
+        # file 2: hash, offset
+        for key, offsets in index.iteritems():
+            for offset in _offsets(offsets):
+                parts2[key % nparts].write('%d\t%d\n' % (key, offset))
+
+        index.clear()
+
+        for offset, read in reader2:
+            count2 += 1
+            key = _name_hash(read.name)
+            parts2[key % nparts].write('%d\t%d\n' % (key, offset))
+
+        # file 1: ordinal, hash, offset
+        count1 = 0
+        for offset, read in _fetch_offsets(fq1, quiet=self.quiet):
+            key = _name_hash(read.name)
+            parts1[key % nparts].write('%012d\t%d\t%d\n' % (count1, key, offset))
+            count1 += 1
+
+        # join each partition: ordinal, offset 1, offsets 2
+        results = []
+        for part1, part2 in zip(parts1, parts2):
+            part1.close()
+            part2.close()
+
+            index = {}
+            with open(part2.name) as f:
+                for line in f:
+                    key, offset = line.split('\t')
+                    _add_offset(index, int(key), int(offset))
+            os.unlink(part2.name)
+
+            # results are already in the order of file 1
+            tmp = self._tempfile()
+            with open(part1.name) as f:
+                for line in f:
+                    num, key, offset = line.rstrip('\n').split('\t')
+                    offsets = index.get(int(key))
+                    if offsets is not None:
+                        tmp.write('%s\t%s\t%s\n' % (num, offset, ','.join([str(x) for x in _offsets(offsets)])))
+            tmp.close()
+            os.unlink(part1.name)
+            results.append(tmp.name)
+
+        index = None
+
+        pairs = 0
+        files = [open(x) for x in results]
+        try:
+            for line in heapq.merge(*files):
+                num, offset, offsets = line.rstrip('\n').split('\t')
+                fq1.seek(int(offset))
+                read1, size = _read_at(fq1.fileobj)
+                read2 = _find_mate(fq2, [int(x) for x in offsets.split(',')], read1.name)
+                if read2:
+                    pairs += 1
+                    yield read1, read2
+        finally:
+            for f in files:
+                f.close()
+
+        self.discarded_1 = count1 - pairs
+        self.discarded_2 = count2 - pairs
+
+
+class window_pairs(object):
+    '''
+    Yields (read1, read2) pairs in the order of the first file, matching
+    reads within a look-ahead window. Reads without a mate within {window}
+    reads are discarded.
+
+    Once all pairs have been yielded, discarded_1 and discarded_2 hold the
+    number of unpaired reads in each file.
+    '''
+    def __init__(self, fq1, fq2, window=10000, quiet=False):
+        self.fq1 = fq1
+        self.fq2 = fq2
+        self.window = window
+        self.quiet = quiet
+        self.discarded_1 = 0
+        self.discarded_2 = 0
+
+    def __iter__(self):
+        reader1 = self.fq1.fetch(quiet=self.quiet)
+        reader2 = self.fq2.fetch(quiet=True)
+
+        queue = collections.deque()  # [read1, read2] in file 1 order
+        waiting = {}  # name => queue entry without a mate
+        pending2 = collections.OrderedDict()  # name => read2 without a mate
+
+        done1 = False
+        done2 = False
+
+        while not done1 or not done2:
+            if not done1:
+                try:
+                    read1 = reader1.next()
+                    entry = [read1, pending2.pop(read1.name, None)]
+                    if entry[1] is None:
+                        waiting[read1.name] = entry
+                    queue.append(entry)
+                except StopIteration:
+                    done1 = True
+
+            if not done2:
+                try:
+                    read2 = reader2.next()
+                    if read2.name in waiting:
+                        waiting.pop(read2.name)[1] = read2
+                    else:
+                        pending2[read2.name] = read2
+                        if len(pending2) > self.window:
+                            pending2.popitem(last=False)
+                            self.discarded_2 += 1
+                except StopIteration:
+                    done2 = True
+
+            while queue and (queue[0][1] is not None or len(queue) > self.window or done2):
+                read1, read2 = queue.popleft()
+                if read2 is None:
+                    waiting.pop(read1.name, None)
+                    self.discarded_1 += 1
+                else:
+                    yield read1, read2
+
+        self.discarded_2 += len(pending2)
+
+
+def sort_join_pairs(fq1, fq2, out1, out2, tmpdir=None, quiet=False):
     tmp1 = tempfile.NamedTemporaryFile(delete=False, prefix='.tmp', suffix='.gz', dir=tmpdir if tmpdir else os.path.dirname(fq1.fname))
     tmp1_fname = tmp1.name
     tmp1_out = gzip.GzipFile(fileobj=tmp1)
@@ -57,14 +432,13 @@ def find_fastq_pairs(fq1, fq2, out1, out2, tmpdir=None, quiet=False):
         if read1.name == read2.name:
             read1.write(out1)
             read2.write(out2)
+            pairs += 1
 
             try:
                 read1 = reader1.next()
                 read2 = reader2.next()
             except StopIteration:
                 break
-
-            pairs += 1
         elif read1.name < read2.name:
             discarded_1 += 1
             try:
@@ -86,15 +460,22 @@ def find_fastq_pairs(fq1, fq2, out1, out2, tmpdir=None, quiet=False):
 
     return pairs, discarded_1, discarded_2
 
+
 def usage(msg=""):
     if msg:
         print '%s\n' % msg
+    print __doc__
     print """Usage: fastqutils properpairs {opts} filename1.fastq{.gz} filename2.fastq{.gz} output1 output2
 
 Options:
-  -f       Force overwriting output file (if it exists)
-  -z       Output files should be gzip compressed
-  -t dir   Use {dir} for temporary files
+  -f             Force overwriting output file (if it exists)
+  -z             Output files should be gzip compressed
+  -t dir         Use {dir} for temporary files
+
+  -method val    Method used to find pairs: hash, window, or sort
+                 (default: hash)
+  -mem num       Number of reads to hold in memory (hash, default: 2000000)
+  -window num    Look-ahead window size (window, default: 10000)
 """
     sys.exit(1)
 
@@ -105,6 +486,9 @@ if __name__ == '__main__':
     outname2 = None
     tmpdir = None
     force = False
+    method = 'hash'
+    max_reads = 2000000
+    window = 10000
 
     gz = False
 
@@ -122,7 +506,18 @@ if __name__ == '__main__':
                 usage('%s is not a valid temp-directory!' % arg)
 
             last = None
-        elif arg in ['-t']:
+        elif last == '-method':
+            if arg not in ['hash', 'window', 'sort']:
+                usage('Unknown method: %s' % arg)
+            method = arg
+            last = None
+        elif last == '-mem':
+            max_reads = int(arg)
+            last = None
+        elif last == '-window':
+            window = int(arg)
+            last = None
+        elif arg in ['-t', '-method', '-mem', '-window']:
             last = arg
         elif not fqname1:
             if not os.path.exists(arg):
@@ -155,7 +550,7 @@ if __name__ == '__main__':
         out1 = open(outname1, 'w')
         out2 = open(outname2, 'w')
 
-    paired, discard_1, discard_2 = find_fastq_pairs(fq1, fq2, out1, out2, tmpdir)
+    paired, discard_1, discard_2 = find_fastq_pairs(fq1, fq2, out1, out2, tmpdir, method=method, max_reads=max_reads, window=window)
 
     print "Proper pairs: %s" % paired
     print "Discarded 1 : %s" % discard_1
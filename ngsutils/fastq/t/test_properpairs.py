@@ -3,6 +3,11 @@
 Tests for fastqutils filter
 '''
 
+import os
+import gzip
+import random
+import shutil
+import tempfile
 import unittest
 import StringIO
 
@@ -228,6 +233,118 @@ ACGTACGT
         self.assertEqual(out1.getvalue(), out2.getvalue())
         self.assertEqual(out1.getvalue(), fq2.getvalue())
 
+    def _fastq(self, names):
+        return ''.join(['@%s c%s\nACGT\n+\n;;;;\n' % (name, name) for name in names])
+
+    def _run_methods(self, names1, names2, **kwargs):
+        results = {}
+        for method in ['hash', 'window']:
+            out1 = StringIO.StringIO('')
+            out2 = StringIO.StringIO('')
+            fastq1 = FASTQ(fileobj=StringIO.StringIO(self._fastq(names1)))
+            fastq2 = FASTQ(fileobj=StringIO.StringIO(self._fastq(names2)))
+            counts = ngsutils.fastq.properpairs.find_fastq_pairs(fastq1, fastq2, out1, out2, quiet=True, method=method, **kwargs)
+            self.assertEqual(out1.getvalue(), out2.getvalue())
+            results[method] = (out1.getvalue(), counts)
+        return results
+
+    def testMethods(self):
+        random.seed(1)
+        names = ['read%s' % i for i in xrange(200)]
+        names1 = [x for x in names if random.random() < 0.8]
+        names2 = [x for x in names if random.random() < 0.8]
+        both = set(names1) & set(names2)
+        expected = self._fastq([x for x in names1 if x in both])
+        counts = (len(both), len(names1) - len(both), len(names2) - len(both))
+
+        results = self._run_methods(names1, names2)
+        self.assertEqual(results['hash'], (expected, counts))
+        self.assertEqual(results['window'], (expected, counts))
+
+        # out of order: only the hash join finds every pair
+        random.shuffle(names2)
+        results = self._run_methods(names1, names2, window=5)
+        self.assertEqual(results['hash'], (expected, counts))
+        self.assertTrue(results['window'][1][0] < len(both))
+        self.assertEqual(results['window'][1][0] + results['window'][1][1], len(names1))
+        self.assertEqual(results['window'][1][0] + results['window'][1][2], len(names2))
+
+    def testPartitioned(self):
+        random.seed(2)
+        names = ['read%s' % i for i in xrange(200)]
+        names1 = [x for x in names if random.random() < 0.8]
+        names2 = [x for x in names if random.random() < 0.8]
+        random.shuffle(names2)
+        both = set(names1) & set(names2)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for partitions in [None, 3]:
+                pairs = ngsutils.fastq.properpairs.hash_join_pairs(FASTQ(fileobj=StringIO.StringIO(self._fastq(names1))), FASTQ(fileobj=StringIO.StringIO(self._fastq(names2))), max_reads=10, tmpdir=tmpdir, quiet=True, partitions=partitions)
+                found = [(read1.name, read1.comment, read2.name, read2.comment) for read1, read2 in pairs]
+                self.assertEqual(found, [(x, 'c%s' % x, x, 'c%s' % x) for x in names1 if x in both])
+                self.assertEqual((pairs.discarded_1, pairs.discarded_2), (len(names1) - len(both), len(names2) - len(both)))
+                self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testHashCollision(self):
+        names1 = ['read%s' % i for i in xrange(20)]
+        names2 = ['read%s' % i for i in xrange(20) if i % 3]
+        expected = [(x, x) for x in names1 if x in names2]
+
+        # every name has one of two hashes, so pairs are only found by comparing names
+        orig = ngsutils.fastq.properpairs._name_hash
+        ngsutils.fastq.properpairs._name_hash = lambda name: len(name) % 2
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for max_reads in [2000000, 1]:
+                pairs = ngsutils.fastq.properpairs.hash_join_pairs(FASTQ(fileobj=StringIO.StringIO(self._fastq(names1))), FASTQ(fileobj=StringIO.StringIO(self._fastq(names2))), max_reads=max_reads, tmpdir=tmpdir, quiet=True, partitions=2)
+                self.assertEqual([(read1.name, read2.name) for read1, read2 in pairs], expected)
+                self.assertEqual((pairs.discarded_1, pairs.discarded_2), (len(names1) - len(expected), 0))
+                self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            ngsutils.fastq.properpairs._name_hash = orig
+            shutil.rmtree(tmpdir)
+
+    def testUnseekable(self):
+        names1 = ['read%s' % i for i in xrange(50)]
+        names2 = ['read%s' % i for i in xrange(50) if i % 2]
+        random.seed(3)
+        random.shuffle(names2)
+        expected = [(x, x) for x in names1 if x in names2]
+
+        class Stream(object):
+            'File-like object that can only be read forward'
+            def __init__(self, data):
+                self._f = StringIO.StringIO(data)
+                self.read = self._f.read
+                self.readline = self._f.readline
+                self.next = self._f.next
+                self.close = self._f.close
+
+            def tell(self):
+                raise IOError('Illegal seek')
+
+            def seek(self, pos, whence=0):
+                raise IOError('Illegal seek')
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            gzname = os.path.join(tmpdir, 'test2.fastq.gz')
+            with gzip.open(gzname, 'w') as f:
+                f.write(self._fastq(names2))
+
+            for max_reads in [2000000, 5]:
+                for fq2 in [FASTQ(fileobj=Stream(self._fastq(names2))), FASTQ(gzname)]:
+                    pairs = ngsutils.fastq.properpairs.hash_join_pairs(FASTQ(fileobj=Stream(self._fastq(names1))), fq2, max_reads=max_reads, tmpdir=tmpdir, quiet=True)
+                    self.assertEqual([(read1.name, read2.name) for read1, read2 in pairs], expected)
+                    self.assertEqual((pairs.discarded_1, pairs.discarded_2), (len(names1) - len(expected), 0))
+                    self.assertEqual(os.listdir(tmpdir), ['test2.fastq.gz'])
+                    fq2.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -18,6 +18,7 @@ Notes:
 
 import sys
 import os
+import array
 from ngsutils.support.ngs_utils import gzip_aware_open
 from ngsutils.support import symbols, quoted_split
 from eta import ETA
@@ -31,7 +32,7 @@ except:
 
 
 class GTF(object):
-    _version = 1.3
+    _version = 1.5
     __binsize = 10000
     
     def __init__(self, filename=None, cache_enabled=True, quiet=False, fileobj=None):
@@ -54,7 +55,7 @@ class GTF(object):
         self._gene_ids = {}
         warned = False
 
-        if cache_enabled and os.path.exists(cachefile):
+        if cache_enabled and os.path.exists(cachefile) and os.stat(cachefile).st_mtime >= os.stat(filename).st_mtime:
             self._load_cache(cachefile)
 
         if not self._genes:
@@ -72,12 +73,8 @@ class GTF(object):
                     source = symbols[source]
                     start = int(start) - 1  # Note: 1-based
                     end = int(end)
-                    attributes = {}
-
-                    for key, val in [x.split(' ', 1) for x in [x.strip() for x in quoted_split(attrs, ';')] if x and ' ' in x]:
-                        if val[0] == '"' and val[-1] == '"':
-                            val = val[1:-1]
-                        attributes[key] = val
+                    attrs_sep = ' '
+                    attributes = dict(_parse_attributes(attrs, attrs_sep))
 
                     gid = None
 
@@ -102,14 +99,9 @@ class GTF(object):
                             sys.stderr.write('%s\n\n' % (str(attributes)))
                             warned = True
 
-                        first_key = None
-                        attributes = {}
-                        for key, val in [x.split('=', 1) for x in [x.strip() for x in quoted_split(attrs, ';')] if x and '=' in x]:
-                            if not first_key:
-                                first_key = key
-                            if val[0] == '"' and val[-1] == '"':
-                                val = val[1:-1]
-                            attributes[key] = val
+                        attrs_sep = '='
+                        pairs = _parse_attributes(attrs, attrs_sep)
+                        attributes = dict(pairs)
 
                         if not attributes:
                             gid = 'id_%s' % linenum
@@ -117,6 +109,7 @@ class GTF(object):
                                 sys.stderr.write('\nGTF file missing annotations! Using line numbers as IDs\n')
                                 warned = True
                         else:
+                            first_key = pairs[0][0]
                             gid = attributes[first_key]
                             if not warned and not quiet:
                                 sys.stderr.write('\nGTF file missing annotations (gene_id, transcript_id)! Assuming GFF? Taking first attribute as ID (%s=%s)\n' % (first_key, gid))
@@ -133,7 +126,7 @@ class GTF(object):
                     sys.exit(1)
 
                 if not gid in self._genes or chrom != self._genes[gid].chrom:
-                    self._genes[gid] = _GTFGene(gid, chrom, source, **attributes)
+                    self._genes[gid] = _GTFGene(gid, chrom, source, attributes.get('gene_id'), attributes.get('gene_name'), attrs, attrs_sep)
                     if 'gene_name' in attributes:
                         gene_name = attributes['gene_name']
                         if not gene_name in self._gene_names:
@@ -191,8 +184,8 @@ class GTF(object):
 
     def _write_cache(self, cachefile):
         sys.stderr.write('(saving GTF cache)...')
-        with open(cachefile, 'w') as cache:
-            pickle.dump((GTF._version, self._genes, self._gene_bins, self._gene_names, self._gene_ids), cache)
+        with open(cachefile, 'wb') as cache:
+            pickle.dump((GTF._version, self._genes, self._gene_bins, self._gene_names, self._gene_ids), cache, pickle.HIGHEST_PROTOCOL)
         sys.stderr.write('\n')
 
     def fsize(self):
@@ -247,8 +240,8 @@ class GTF(object):
 
     def get_by_name(self, gene_name):
         if gene_name in self._gene_names:
-            for g in self._genes[self._gene_names[gene_name]]:
-                yield g
+            for gid in self._gene_names[gene_name]:
+                yield self._genes[gid]
 
     @property
     def genes(self):
@@ -264,6 +257,19 @@ class GTF(object):
                 self._pos += 1
 
 
+def _parse_attributes(attrs, sep=' '):
+    '''
+    Decodes a GTF (key "value";) or GFF (key=value;) attribute column.
+    Returns a list of (key, value) tuples.
+    '''
+    pairs = []
+    for key, val in [x.split(sep, 1) for x in [x.strip() for x in quoted_split(attrs, ';')] if x and sep in x]:
+        if val[0] == '"' and val[-1] == '"':
+            val = val[1:-1]
+        pairs.append((key, val))
+    return pairs
+
+
 class _GTFGene(object):
     """
     Stores info for a single gene_id
@@ -278,11 +284,20 @@ class _GTFGene(object):
 
     """
 
-    def __init__(self, gid, chrom, source, gene_id=None, gene_name=None, **attributes):
+    __slots__ = ('gid', 'gene_id', 'gene_name', '_attributes', '_attributes_sep', '_attributes_dict',
+                 'chrom', 'source', '_transcripts', '_regions', 'start', 'end', 'strand')
+
+    def __init__(self, gid, chrom, source, gene_id=None, gene_name=None, attrs='', attrs_sep=' '):
         self.gid = gid
         self.gene_id = gene_id if gene_id else gid
         self.gene_name = gene_name if gene_name else gene_id
-        self.attributes = attributes
+
+        # attributes are kept as the raw attribute column of the first line.
+        # They are only decoded (with interned keys) the first time they are
+        # requested, and the dict then replaces the raw column.
+        self._attributes = attrs
+        self._attributes_sep = attrs_sep
+        self._attributes_dict = None
 
         self.chrom = chrom
         self.source = source
@@ -294,6 +309,13 @@ class _GTFGene(object):
         self.end = None
         self.strand = None
 
+    @property
+    def attributes(self):
+        if self._attributes_dict is None:
+            self._attributes_dict = dict([(intern(k), v) for k, v in _parse_attributes(self._attributes, self._attributes_sep) if k not in ('gene_id', 'gene_name')])
+            self._attributes = None
+        return self._attributes_dict
+
     def __repr__(self):
         return '%s(%s) %s:%s-%s[%s]' % (self.gene_name, self.gid, self.chrom, self.start, self.end, self.strand)
 
@@ -324,9 +346,9 @@ class _GTFGene(object):
             t.end = end
 
         if feature == 'exon':
-            t._exons.append((start, end))
+            t._exons.extend((start, end))
         elif feature == 'CDS':
-            t._cds.append((start, end))
+            t._cds.extend((start, end))
         elif feature == 'start_codon':
             t._start_codon = (start, end)
         elif feature == 'stop_codon':
@@ -362,12 +384,27 @@ class _GTFGene(object):
             yield (i, start, end, const, names)
 
 
+def _pairs(arr):
+    'Converts a flat array of [start, end, start, end...] values into a list of (start, end) tuples'
+    return zip(arr[::2], arr[1::2])
+
+
 class _GTFTranscript(object):
+    '''
+    Stores info for a single transcript
+
+    Exon and CDS coordinates are stored as flat arrays of start/end values
+    instead of lists of tuples to keep the memory (and pickle) footprint small.
+    '''
+
+    __slots__ = ('transcript_id', 'strand', '_exons', '_cds', '_start_codon',
+                 '_stop_codon', 'start', 'end')
+
     def __init__(self, transcript_id, strand):
         self.transcript_id = transcript_id
         self.strand = strand
-        self._exons = []
-        self._cds = []
+        self._exons = array.array('l')
+        self._cds = array.array('l')
         self._start_codon = None
         self._stop_codon = None
 
@@ -380,14 +417,14 @@ class _GTFTranscript(object):
     @property
     def exons(self):
         if self._exons:
-            return self._exons
+            return _pairs(self._exons)
         else:
             return [(self.start, self.end)]
 
     @property
     def cds(self):
         if self._cds:
-            return self._cds
+            return _pairs(self._cds)
         else:
             return []
 
@@ -402,16 +439,16 @@ class _GTFTranscript(object):
         utr = []
         if self._cds and self._exons:
             if self.strand == '+':
-                cds_start = self._cds[0][0]
-                for s, e in self._exons:
+                cds_start = self._cds[0]
+                for s, e in self.exons:
                     if e < cds_start:
                         utr.append((s, e))
                     else:
                         utr.append((s, cds_start))
                         break
             else:
-                cds_start = self._cds[-1][1]
-                for s, e in self._exons[::-1]:
+                cds_start = self._cds[-1]
+                for s, e in self.exons[::-1]:
                     if s > cds_start:
                         utr.append((s, e))
                     else:
@@ -425,8 +462,8 @@ class _GTFTranscript(object):
         utr = []
         if self._cds and self._exons:
             if self.strand == '+':
-                cds_end = self._cds[-1][1]
-                for s, e in self._exons[::-1]:
+                cds_end = self._cds[-1]
+                for s, e in self.exons[::-1]:
                     if s > cds_end:
                         utr.append((s, e))
                     else:
@@ -434,8 +471,8 @@ class _GTFTranscript(object):
                         break
                 utr.sort()
             else:
-                cds_end = self._cds[0][0]
-                for s, e in self._exons:
+                cds_end = self._cds[0]
+                for s, e in self.exons:
                     if e < cds_end:
                         utr.append((s, e))
                     else:
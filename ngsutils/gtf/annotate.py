@@ -13,7 +13,7 @@ Column counts start at 1.
 
 import sys
 import os
-from ngsutils.gtf import GTF
+from ngsutils.gtf.server import load_gtf
 import ngsutils.support
 
 
@@ -162,5 +162,5 @@ if __name__ == '__main__':
     if not (gene_name or gene_location or gene_id or transcript_id):
         usage('Missing outputs - nothing to annotate')
 
-    gtf = GTF(gtffile)
+    gtf = load_gtf(gtffile)
     gtf_annotate(gtf, infile, ref_col, pos_col, gene_name, gene_location, gene_id, transcript_id, header)
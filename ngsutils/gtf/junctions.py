@@ -18,14 +18,25 @@ sufficient overlap with the junction is established when reads are mapped.
 
 import os
 import sys
+import hashlib
 import pysam
 from ngsutils.gtf import GTF
 from eta import ETA
 
 
-def gtf_junctions(gtf, refname, fragment_size, min_size, max_exons=5, known=False, out=sys.stdout, quiet=False, scramble=False, retain_introns=False):
-    ref = pysam.Fastafile(refname)
+def gtf_junctions(gtf, refname, fragment_size, min_size, max_exons=5, known=False, out=sys.stdout, quiet=False, scramble=False, retain_introns=False, procs=1, dedup_seqs=False):
+    '''
+    Writes a junction library for the genes in a GTF model. Genes are grouped
+    by chromosome. With one process, junctions are written gene by gene. With
+    a pool of {procs} processes, each chromosome is split into blocks of
+    genes, and blocks are handed out in order (in chunks), so each process
+    only reads the sequence for a chromosome once. Results are written in
+    chromosome/block order as they arrive, so the output doesn't depend on
+    {procs}.
 
+    If dedup_seqs is True, only the first junction with a given sequence is
+    written.
+    '''
     references = []
     with open('%s.fai' % refname) as f:
         for line in f:
@@ -37,50 +48,132 @@ def gtf_junctions(gtf, refname, fragment_size, min_size, max_exons=5, known=Fals
     else:
         eta = None
 
-    exporter = JunctionExporter(ref, fragment_size, min_size, max_exons, out, scramble)
-
+    chroms = []
+    chrom_genes = {}
     for gene in gtf.genes:
         if not gene.chrom in references:
             continue
 
+        if not gene.chrom in chrom_genes:
+            chroms.append(gene.chrom)
+            chrom_genes[gene.chrom] = []
+
+        chrom_genes[gene.chrom].append((gene.strand, [tuple(txpt.exons) for txpt in gene.transcripts]))
+
         if eta:
             eta.print_status(extra='%s:%s %s' % (gene.chrom, gene.start, gene.gene_name))
 
+    initargs = (refname, fragment_size, min_size, max_exons, known, scramble, retain_introns)
+    writer = JunctionExporter(None, fragment_size, min_size, max_exons, out, scramble, dedup_seqs)
+
+    if procs <= 1:
+        _junction_worker_init(*initargs)
+        for chrom in chroms:
+            for gene in chrom_genes[chrom]:
+                writer.write(_junction_worker((chrom, [gene])))
+        _junction_worker_init(None)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(procs, _junction_worker_init, initargs)
+        try:
+            for chrom, junctions in pool.imap(_junction_block_worker, _gene_blocks(chroms, chrom_genes), _block_chunksize):
+                # a name can be built by more than one block (overlapping genes)
+                writer.write(junctions, chrom)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    if eta:
+        eta.done()
+
+
+_worker_exporter = None
+_worker_opts = None
+
+_block_size = 20
+_block_chunksize = 4
+
+
+def _gene_blocks(chroms, chrom_genes):
+    for chrom in chroms:
+        genes = chrom_genes[chrom]
+        for i in xrange(0, len(genes), _block_size):
+            yield chrom, genes[i:i + _block_size]
+
+
+def _junction_worker_init(refname, fragment_size=None, min_size=None, max_exons=None, known=False, scramble=False, retain_introns=False):
+    global _worker_exporter
+    global _worker_opts
+
+    if _worker_exporter:
+        _worker_exporter.ref.close()
+        _worker_exporter = None
+
+    if refname:
+        _worker_exporter = JunctionExporter(pysam.Fastafile(refname), fragment_size, min_size, max_exons, None, scramble)
+        _worker_opts = (known, scramble, retain_introns)
+
+
+def _junction_worker(job):
+    '''
+    Returns the [(name, seq), ...] junctions for a list of genes on one
+    chromosome. Each gene is given as (strand, [transcript exons, ...]).
+    '''
+    chrom, genes = job
+    known, scramble, retain_introns = _worker_opts
+    exporter = _worker_exporter
+
+    junctions = []
+    for strand, transcripts in genes:
         if known:
-            for txpt in gene.transcripts:
+            for txpt_exons in transcripts:
                 last = None
-                for exon in txpt.exons:
+                for exon in txpt_exons:
                     if last:
-                        exporter.export(gene.chrom, [last, exon])
+                        junctions.extend(exporter.junctions(chrom, [last, exon]))
                     last = exon
         else:
             exons = set()
-            for txpt in gene.transcripts:
-                for exon in txpt.exons:
+            for txpt_exons in transcripts:
+                for exon in txpt_exons:
                     exons.add(exon)
 
             exons = list(exons)
             exons.sort()
 
             if retain_introns:
-                exporter.export_retained_introns(gene.chrom, exons, gene.strand)
+                junctions.extend(exporter.retained_introns(chrom, exons, strand))
 
             if scramble:
                 # We can just pretend the transcript is repeated
                 # and then let the set take care of removing the duplicates
                 exons = exons * 2
 
-            exporter.export(gene.chrom, exons)
+            junctions.extend(exporter.junctions(chrom, exons))
 
+    return junctions
 
 
-    if eta:
-        eta.done()
-    ref.close()
+def _junction_block_worker(job):
+    return job[0], _junction_worker(job)
 
 
 class JunctionExporter(object):
-    def __init__(self, ref, fragment_size, min_size, max_exons, out, scramble=False):
+    '''
+    Builds junctions from exons. The sequence for a chromosome is fetched
+    once and junctions are sliced from it. Junctions are only returned once
+    per chromosome (by name). If dedup_seqs is True, write() also skips
+    junctions with a sequence that has already been written (tracked by MD5
+    digest).
+
+    When junctions for a chromosome are built by several exporters, the
+    writing exporter can skip names that were already written by passing
+    the chromosome to write().
+    '''
+    def __init__(self, ref, fragment_size, min_size, max_exons, out, scramble=False, dedup_seqs=False):
         self.ref = ref
         self.fragment_size = fragment_size
         self.min_size = min_size
@@ -89,13 +182,54 @@ class JunctionExporter(object):
         self._junctions = set()
         self._cur_chrom = None
         self.scramble = scramble
-
-    def export_retained_introns(self, chrom, exons, strand):
-        # Retain introns from both the alt-3 and alt-5 side.
+        self._seq_chrom = None
+        self._seq = ''
+        self._seqs = set() if dedup_seqs else None
+
+    def _fetch(self, chrom, start, end):
+        if chrom != self._seq_chrom:
+            self._seq = ''  # release the previous chromosome first
+            self._seq = self.ref.fetch(chrom)
+            self._seq_chrom = chrom
+        return self._seq[max(start, 0):max(end, 0)]
+
+    def _set_chrom(self, chrom):
         if chrom != self._cur_chrom:
             self._junctions = set()
             self._cur_chrom = chrom
 
+    def _is_new(self, name):
+        if name in self._junctions:
+            return False
+        self._junctions.add(name)
+        return True
+
+    def write(self, junctions, chrom=None):
+        if chrom:
+            self._set_chrom(chrom)
+
+        buf = []
+        for name, seq in junctions:
+            if chrom and not self._is_new(name):
+                continue
+            if self._seqs is not None:
+                digest = hashlib.md5(seq).digest()
+                if digest in self._seqs:
+                    continue
+                self._seqs.add(digest)
+            buf.append('>%s\n%s\n' % (name, seq))
+        self.out.write(''.join(buf))
+
+    def export_retained_introns(self, chrom, exons, strand):
+        self.write(self.retained_introns(chrom, exons, strand))
+
+    def export(self, chrom, exons):
+        self.write(self.junctions(chrom, exons))
+
+    def retained_introns(self, chrom, exons, strand):
+        # Retain introns from both the alt-3 and alt-5 side.
+        self._set_chrom(chrom)
+
         for i, (start, end) in enumerate(exons):
             # alt-3' extension (rel to + strand)
             if i < len(exons):
@@ -103,10 +237,8 @@ class JunctionExporter(object):
                 frag_end = end + self.fragment_size
 
                 name = '%s:%s-%s,%s-%s' % (chrom, frag_start, end, end, frag_end)
-                if not name in self._junctions:
-                    self._junctions.add(name)
-                    seq = self.ref.fetch(chrom, frag_start, frag_end)
-                    self.out.write('>%s\n%s\n' % (name, seq))
+                if self._is_new(name):
+                    yield name, self._fetch(chrom, frag_start, frag_end)
 
             # alt-5 extension
             if i > 0:
@@ -114,15 +246,11 @@ class JunctionExporter(object):
                 frag_end = min(end, start + self.fragment_size)
 
                 name = '%s:%s-%s,%s-%s' % (chrom, frag_start, start, start, frag_end)
-                if not name in self._junctions:
-                    self._junctions.add(name)
-                    seq = self.ref.fetch(chrom, frag_start, frag_end)
-                    self.out.write('>%s\n%s\n' % (name, seq))
+                if self._is_new(name):
+                    yield name, self._fetch(chrom, frag_start, frag_end)
 
-    def export(self, chrom, exons):
-        if chrom != self._cur_chrom:
-            self._junctions = set()
-            self._cur_chrom = chrom
+    def junctions(self, chrom, exons):
+        self._set_chrom(chrom)
 
         for i, (start, end) in enumerate(exons):
             if i == len(exons) - 1:
@@ -134,15 +262,11 @@ class JunctionExporter(object):
             if end - start > self.fragment_size:
                 frag_start = end - self.fragment_size
 
-            # print '[%s] %s:%s-%s' % (i,gene.chrom,frag_start,end)
-            seq3 = self.ref.fetch(chrom, frag_start, end)
+            seq3 = self._fetch(chrom, frag_start, end)
             for j in xrange(len(exons) - i - 1):
-                # print '   [%s]' % (j+i+1),
-                # print '%s-%s' % exons[j+i+1]
                 for name, seq in self._extend_junction(seq3, '%s:%s-%s' % (chrom, frag_start, end), chrom, exons[j + i + 1:], end):
-                    if not name in self._junctions:
-                        self._junctions.add(name)
-                        self.out.write('>%s\n%s\n' % (name, seq))
+                    if self._is_new(name):
+                        yield name, seq
 
     def _extend_junction(self, seq, name, chrom, exons, anchor_frag_end, counter=1):
         if counter >= self.max_exons:
@@ -158,7 +282,7 @@ class JunctionExporter(object):
         if end - start > self.fragment_size:
             frag_end = start + self.fragment_size
 
-        seq5 = self.ref.fetch(chrom, start, frag_end)
+        seq5 = self._fetch(chrom, start, frag_end)
         newname = '%s,%s-%s' % (name, start, frag_end)
         newseq = seq + seq5
         if len(newseq) >= self.min_size:
@@ -189,6 +313,10 @@ Options
                     [default 50]
   -known            Only export known junctions
 
+  -dedup            Only write the first junction for each unique sequence
+  -p num            Build junctions for each chromosome in parallel using
+                    {num} processes
+
   -scramble         Include potential circular junctions
   -retain-introns   Include retained introns (retains introns from both the 
                     5' and 3' splice side)
@@ -209,6 +337,8 @@ if __name__ == '__main__':
     known = False
     scramble = False
     retain_introns = False
+    dedup_seqs = False
+    procs = 1
     last = None
 
     for arg in sys.argv[1:]:
@@ -218,12 +348,17 @@ if __name__ == '__main__':
         elif last == '-min':
             min_size = int(arg)
             last = None
-        elif arg in ['-frag', '-min']:
+        elif last == '-p':
+            procs = int(arg)
+            last = None
+        elif arg in ['-frag', '-min', '-p']:
             last = arg
         elif arg == '-scramble':
             scramble = True
         elif arg == '-retain-introns':
             retain_introns = True
+        elif arg == '-dedup':
+            dedup_seqs = True
         elif arg == '-known':
             known = True
         elif arg == '-h':
@@ -241,4 +376,4 @@ if __name__ == '__main__':
     if known and scramble:
         usage("You can not use both -known and -scramble at the same time!")
 
-    gtf_junctions(GTF(gtf), fasta, frag_size, min_size, known=known, scramble=scramble, retain_introns=retain_introns)
+    gtf_junctions(GTF(gtf), fasta, frag_size, min_size, known=known, scramble=scramble, retain_introns=retain_introns, procs=procs, dedup_seqs=dedup_seqs)
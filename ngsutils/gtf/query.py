@@ -5,18 +5,21 @@
 Query a GTF file by coordinates
 
 This will return the gene (or genes) present in a given genome region.
+More than one region may be given. If a GTF server is running
+(gtfutils server), all regions are sent to it in one batch.
 '''
 
 import sys
 import os
-from ngsutils.gtf import GTF
+import re
+from ngsutils.gtf.server import load_gtf, RemoteGTF
 
 
 def usage(msg=None):
     if msg:
         print '%s\n' % msg
     print __doc__
-    print '''Usage: gtfutils query {options} filename.gtf{.gz} chrom:start-end
+    print '''Usage: gtfutils query {options} filename.gtf{.gz} chrom:start-end {chrom:start-end ...}
 
 Options:
     -transcripts    show transcripts
@@ -30,9 +33,38 @@ def gtf_query(gtf, chrom, start, end, strand=None):
     for gene in gtf.find(chrom, start, end, strand):
         yield gene
 
+
+def gtf_query_batch(gtf, regions):
+    '''
+    regions is a list of (chrom, start, end, strand) tuples. Returns a list of
+    gene lists (one per region).
+    '''
+    if isinstance(gtf, RemoteGTF):
+        return gtf.find_batch(regions)
+    return [list(gtf_query(gtf, *region)) for region in regions]
+
+
+_region_re = re.compile(r'^([^:]+):(\d+)-(\d+)$')
+
+
+def parse_region(arg):
+    '''
+    Parses a chrom:start-end region. Returns a (chrom, start, end, None) tuple,
+    or None if arg isn't a region.
+
+    >>> parse_region('chr1:1000-2000')
+    ('chr1', 1000, 2000, None)
+    >>> parse_region('genes.gtf') is None
+    True
+    '''
+    m = _region_re.match(arg)
+    if not m:
+        return None
+    return (m.group(1), int(m.group(2)), int(m.group(3)), None)
+
 if __name__ == '__main__':
     filename = None
-    region = None
+    regions = []
     show_transcripts = False
     show_exons = False
     show_regions = False
@@ -48,20 +80,21 @@ if __name__ == '__main__':
             show_exons = True
         elif not filename and os.path.exists(arg):
             filename = arg
-        elif not region:
-            region = arg
+        elif parse_region(arg):
+            regions.append(parse_region(arg))
+        elif not filename:
+            usage('Missing input file: %s' % arg)
+        else:
+            usage('Invalid region: %s (chrom:start-end)' % arg)
 
     if not filename:
         usage('Missing input file')
-    if not region:
+    if not regions:
         usage('Missing query region! (chrom:start-end)')
 
-    chrom, startend = region.split(':')
-    start, end = [int(x) for x in startend.split('-', 1)]
-
-    gtf = GTF(filename)
+    gtf = load_gtf(filename)
 
-    for gene in gtf_query(gtf, chrom, start, end):
+    for gene in [gene for genes in gtf_query_batch(gtf, regions) for gene in genes]:
         print gene
         if show_regions:
             for i, s, e, const, names in gene.regions:
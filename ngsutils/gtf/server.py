@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+## category General
+## desc Run a persistent GTF query server
+'''
+Run a persistent GTF query server
+
+This keeps one or more GTF models loaded in memory and answers find,
+get_by_id, and get_by_name requests over a local Unix socket. Other gtfutils
+commands (query, annotate) will automatically use a running server instead of
+re-loading the GTF file (or its cache) for every invocation.
+
+Requests can be sent in batches, so many lookups only require one round-trip.
+
+The socket path can be set with the environment variable
+$NGSUTILS_GTF_SOCKET. If the socket doesn't exist, the GTF file is loaded
+locally, like normal.
+'''
+
+import sys
+import os
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+from ngsutils.gtf import GTF
+
+
+def usage(msg=None):
+    if msg:
+        print '%s\n' % msg
+    print __doc__
+    print '''Usage: gtfutils server {options} {filename.gtf ...}
+
+Any GTF files given will be pre-loaded. Other files will be loaded the first
+time they are requested by a client.
+
+Options:
+    -socket path    Use this socket (default: %s)
+    -stop           Stop a running server
+''' % default_socket()
+    sys.exit(1)
+
+
+def default_socket():
+    if 'NGSUTILS_GTF_SOCKET' in os.environ:
+        return os.environ['NGSUTILS_GTF_SOCKET']
+    return os.path.join(tempfile.gettempdir(), 'ngsutils-gtf-%s.sock' % os.getuid())
+
+
+class GTFServer(object):
+    '''
+    Holds loaded GTF models and answers requests from RemoteGTF clients.
+
+    Each request is a tuple: (command, key, args), where key is the
+    (real)path of the GTF file and args is a list of queries. The response
+    is a list with one result per query.
+
+    GTF files are re-loaded if their modification time or size changes.
+    '''
+    def __init__(self, socket_path=None, gtfs=None, quiet=False):
+        self.socket_path = socket_path if socket_path else default_socket()
+        self.gtfs = gtfs if gtfs else {}
+        self.quiet = quiet
+        self._stats = {}  # key => (mtime, size) of the loaded file
+        self._lock = threading.Lock()
+        self._listener = None
+        self._running = False
+
+    def load(self, filename):
+        key = os.path.realpath(filename)
+        st = os.stat(key)
+        with self._lock:
+            if not key in self.gtfs or self._stats.get(key) != (st.st_mtime, st.st_size):
+                self.gtfs[key] = GTF(filename, quiet=self.quiet)
+                self._stats[key] = (st.st_mtime, st.st_size)
+        return key
+
+    def _get(self, key):
+        if key in self.gtfs and not key in self._stats:
+            # given to the server directly (not loaded from a file)
+            return self.gtfs[key]
+        return self.gtfs[self.load(key)]
+
+    def handle(self, cmd, key, args):
+        if cmd == 'ping':
+            return 'ok'
+
+        gtf = self._get(key)
+
+        if cmd == 'load':
+            return 'ok'
+        elif cmd == 'find':
+            return [list(gtf.find(chrom, start, end, strand)) for chrom, start, end, strand in args]
+        elif cmd == 'get_by_id':
+            return [gtf.get_by_id(gene_id) for gene_id in args]
+        elif cmd == 'get_by_name':
+            return [list(gtf.get_by_name(gene_name)) for gene_name in args]
+        elif cmd == 'genes':
+            return list(gtf.genes)
+
+        raise ValueError('Unknown command: %s' % cmd)
+
+    def _serve_client(self, conn):
+        try:
+            while True:
+                try:
+                    cmd, key, args = conn.recv()
+                except EOFError:
+                    break
+
+                if cmd == 'shutdown':
+                    conn.send(('ok', None))
+                    self.stop()
+                    break
+
+                try:
+                    conn.send(('ok', self.handle(cmd, key, args)))
+                except Exception, e:
+                    conn.send(('error', str(e)))
+        finally:
+            conn.close()
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self._listener = Listener(self.socket_path, 'AF_UNIX')
+        os.chmod(self.socket_path, 0600)
+        self._running = True
+
+        if not self.quiet:
+            sys.stderr.write('Listening on: %s\n' % self.socket_path)
+
+        try:
+            while self._running:
+                try:
+                    conn = self._listener.accept()
+                except Exception:
+                    if not self._running:
+                        break
+                    raise
+
+                t = threading.Thread(target=self._serve_client, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            # closing the listener also removes the socket file
+            self._running = False
+            self._listener.close()
+
+    def stop(self):
+        self._running = False
+        if self._listener:
+            # unblock the pending accept() call, serve() then closes the listener
+            try:
+                Client(self.socket_path, 'AF_UNIX').close()
+            except Exception:
+                pass
+
+
+class RemoteGTF(object):
+    '''
+    Client-side stand-in for a GTF object that sends requests to a running
+    GTFServer. The find/get_by_id/get_by_name methods mirror GTF, and the
+    *_batch methods send many queries in one request.
+    '''
+    def __init__(self, filename, socket_path=None):
+        self.socket_path = socket_path if socket_path else default_socket()
+        self.key = os.path.realpath(filename) if os.path.exists(filename) else filename
+        self._conn = Client(self.socket_path, 'AF_UNIX')
+
+    def _request(self, cmd, args=None):
+        self._conn.send((cmd, self.key, args))
+        status, val = self._conn.recv()
+        if status != 'ok':
+            raise RuntimeError('GTF server error: %s' % val)
+        return val
+
+    def close(self):
+        self._conn.close()
+
+    def find_batch(self, queries):
+        'queries is a list of (chrom, start, end, strand) tuples'
+        return self._request('find', queries)
+
+    def get_by_id_batch(self, gene_ids):
+        return self._request('get_by_id', gene_ids)
+
+    def get_by_name_batch(self, gene_names):
+        return self._request('get_by_name', gene_names)
+
+    def find(self, chrom, start, end=None, strand=None):
+        for gene in self.find_batch([(chrom, start, end, strand)])[0]:
+            yield gene
+
+    def get_by_id(self, gene_id):
+        return self.get_by_id_batch([gene_id])[0]
+
+    def get_by_name(self, gene_name):
+        for gene in self.get_by_name_batch([gene_name])[0]:
+            yield gene
+
+    @property
+    def genes(self):
+        for gene in self._request('genes'):
+            yield gene
+
+
+def load_gtf(filename, quiet=False, socket_path=None):
+    '''
+    Returns a RemoteGTF if a GTF server is running, otherwise the GTF file is
+    loaded locally.
+    '''
+    if not socket_path:
+        socket_path = default_socket()
+
+    if os.path.exists(socket_path):
+        try:
+            gtf = RemoteGTF(filename, socket_path)
+            gtf._request('load')
+            return gtf
+        except Exception:
+            if not quiet:
+                sys.stderr.write('GTF server not responding (%s), loading file directly\n' % socket_path)
+
+    return GTF(filename, quiet=quiet)
+
+
+if __name__ == '__main__':
+    filenames = []
+    socket_path = None
+    stop = False
+    last = None
+
+    for arg in sys.argv[1:]:
+        if arg == '-h':
+            usage()
+        elif last == '-socket':
+            socket_path = arg
+            last = None
+        elif arg == '-socket':
+            last = arg
+        elif arg == '-stop':
+            stop = True
+        elif os.path.exists(arg):
+            filenames.append(arg)
+        else:
+            usage('Unknown argument: %s' % arg)
+
+    if stop:
+        if not socket_path:
+            socket_path = default_socket()
+        if not os.path.exists(socket_path):
+            usage('No server running at: %s' % socket_path)
+        conn = Client(socket_path, 'AF_UNIX')
+        conn.send(('shutdown', None, None))
+        conn.recv()
+        conn.close()
+        sys.exit(0)
+
+    server = GTFServer(socket_path)
+    for fname in filenames:
+        server.load(fname)
+
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
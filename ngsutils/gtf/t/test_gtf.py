@@ -6,6 +6,7 @@ Tests for gtfutils / docutils
 import unittest
 import doctest
 import StringIO
+import cPickle as pickle
 
 import ngsutils.gtf
 from ngsutils.gtf import GTF
@@ -125,6 +126,45 @@ chr1|test|stop_codon|1448|1450|0|+|.|gene_id "foo2"; transcript_id "bar2"; isofo
         self.assertEqual(len(transcripts), 2)
         self.assertEqual(list(genes[0].regions), [(1, 1000, 1100, True, 'bar1,bar2'), (2, 1200, 1300, False, 'bar1'), (3, 1400, 1500, True, 'bar1,bar2')])
 
+    def testGTFPickle(self):
+        src = StringIO.StringIO('''\
+chr1|test|exon|1001|1100|0|+|.|gene_id "foo"; transcript_id "bar"; gene_biotype "protein_coding";
+chr1|test|exon|1201|1300|0|+|.|gene_id "foo"; transcript_id "bar"; gene_biotype "protein_coding";
+chr1|test|CDS|1051|1247|0|+|1|gene_id "foo"; transcript_id "bar"; gene_biotype "protein_coding";
+chr1|test|start_codon|1051|1053|0|+|.|gene_id "foo"; transcript_id "bar"; gene_biotype "protein_coding";
+chr1|test|stop_codon|1248|1250|0|+|.|gene_id "foo"; transcript_id "bar"; gene_biotype "protein_coding";
+'''.replace('|', '\t'))
+
+        gtf = GTF(fileobj=src, quiet=True)
+        gene = pickle.loads(pickle.dumps(list(gtf.genes)[0], pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(gene.attributes, {'transcript_id': 'bar', 'gene_biotype': 'protein_coding'})
+        t = list(gene.transcripts)[0]
+        self.assertEqual(t.exons, [(1000, 1100), (1200, 1300)])
+        self.assertEqual(t.cds, [(1050, 1247)])
+        self.assertEqual(t.utr_5, [(1000, 1050)])
+        self.assertEqual(t.utr_3, [(1247, 1300)])
+        self.assertEqual(t.start_codon, (1050, 1053))
+        self.assertEqual(t.stop_codon, (1247, 1250))
+
+    def testGTFAttributes(self):
+        src = StringIO.StringIO('''\
+chr1|test|exon|1001|1100|0|+|.|gene_id "foo"; gene_name "Foo"; transcript_id "bar"; note "a;b";
+chr1|test|exon|1201|1300|0|+|.|ID=baz;Parent=qux;
+'''.replace('|', '\t'))
+
+        gtf = GTF(fileobj=src, quiet=True)
+        genes = list(gtf.genes)
+        self.assertEqual(genes[0].gene_name, 'Foo')
+        self.assertEqual(genes[0].attributes, {'transcript_id': 'bar', 'note': 'a;b'})
+        self.assertEqual(genes[1].gid, 'baz')
+        self.assertEqual(genes[1].attributes, {'ID': 'baz', 'Parent': 'qux'})
+
+        # the dict is built once, so changes are kept
+        attributes = genes[0].attributes
+        attributes['extra'] = 'value'
+        self.assertTrue(genes[0].attributes is attributes)
+        self.assertEqual(genes[0].attributes['extra'], 'value')
+
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(ngsutils.gtf))
@@ -131,6 +131,95 @@ ATCGTCGA
 
         self.assertEqual(out.getvalue(), valid)
 
+    def testJunctionsParallel(self):
+        'Output is the same for any number of processes'
+        gtf = GTF(fileobj=StringIO.StringIO('''\
+test1|test|exon|10|20|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|30|40|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|90|100|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|50|70|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+test1|test|exon|80|82|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+test1|test|exon|90|100|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+'''.replace('|', '\t')), quiet=True)
+
+        for kwargs in [{}, {'retain_introns': True}, {'scramble': True}, {'known': True}]:
+            out = StringIO.StringIO('')
+            ngsutils.gtf.junctions.gtf_junctions(gtf, fa, fragment_size=4, min_size=8, out=out, quiet=True, **kwargs)
+            valid = out.getvalue()
+            self.assertTrue(valid)
+
+            out = StringIO.StringIO('')
+            ngsutils.gtf.junctions.gtf_junctions(gtf, fa, fragment_size=4, min_size=8, out=out, quiet=True, procs=2, **kwargs)
+            self.assertEqual(out.getvalue(), valid)
+
+    def testJunctionsParallelBlocks(self):
+        'Names built by genes in different blocks are only written once'
+        gtf = GTF(fileobj=StringIO.StringIO('''\
+test1|test|exon|10|20|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|30|40|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|50|70|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+test1|test|exon|90|100|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+test1|test|exon|10|20|0|+|.|gene_id "foo3"; transcript_id "bar3"; isoform_id "iso3"
+test1|test|exon|30|40|0|+|.|gene_id "foo3"; transcript_id "bar3"; isoform_id "iso3"
+test1|test|exon|90|100|0|+|.|gene_id "foo3"; transcript_id "bar3"; isoform_id "iso3"
+'''.replace('|', '\t')), quiet=True)
+
+        valid = '''\
+>test1:16-20,29-33
+ATGCGCGC
+>test1:16-20,89-93
+ATGCTCGA
+>test1:36-40,89-93
+GATCTCGA
+>test1:66-70,89-93
+ATCGTCGA
+'''
+        out = StringIO.StringIO('')
+        ngsutils.gtf.junctions.gtf_junctions(gtf, fa, fragment_size=4, min_size=8, out=out, quiet=True)
+        self.assertEqual(out.getvalue(), valid)
+
+        block_size = ngsutils.gtf.junctions._block_size
+        chunksize = ngsutils.gtf.junctions._block_chunksize
+        ngsutils.gtf.junctions._block_size = 1
+        ngsutils.gtf.junctions._block_chunksize = 1
+        try:
+            out = StringIO.StringIO('')
+            ngsutils.gtf.junctions.gtf_junctions(gtf, fa, fragment_size=4, min_size=8, out=out, quiet=True, procs=3)
+            self.assertEqual(out.getvalue(), valid)
+        finally:
+            ngsutils.gtf.junctions._block_size = block_size
+            ngsutils.gtf.junctions._block_chunksize = chunksize
+
+        # blocks from different processes can return the same name
+        out = StringIO.StringIO('')
+        writer = ngsutils.gtf.junctions.JunctionExporter(None, 4, 8, 5, out)
+        writer.write([('test1:16-20,29-33', 'ATGCGCGC')], 'test1')
+        writer.write([('test1:16-20,29-33', 'ATGCGCGC'), ('test1:16-20,89-93', 'ATGCTCGA')], 'test1')
+        writer.write([('test2:16-20,29-33', 'ATGCGCGC')], 'test2')
+        self.assertEqual(out.getvalue(), '>test1:16-20,29-33\nATGCGCGC\n>test1:16-20,89-93\nATGCTCGA\n>test2:16-20,29-33\nATGCGCGC\n')
+
+    def testJunctionsDedup(self):
+        gtf = GTF(fileobj=StringIO.StringIO('''\
+test1|test|exon|10|25|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|42|50|0|+|.|gene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"
+test1|test|exon|10|26|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+test1|test|exon|43|50|0|+|.|gene_id "foo2"; transcript_id "bar2"; isoform_id "iso2"
+'''.replace('|', '\t')), quiet=True)
+
+        valid = '''\
+>test1:21-25,41-45
+ttttcccc
+>test1:22-26,42-46
+ttttcccc
+'''
+        out = StringIO.StringIO('')
+        ngsutils.gtf.junctions.gtf_junctions(gtf, fa, fragment_size=4, min_size=8, out=out, quiet=True)
+        self.assertEqual(out.getvalue(), valid)
+
+        out = StringIO.StringIO('')
+        ngsutils.gtf.junctions.gtf_junctions(gtf, fa, fragment_size=4, min_size=8, out=out, quiet=True, dedup_seqs=True)
+        self.assertEqual(out.getvalue(), valid.split('\n>')[0] + '\n')
+
 
 if __name__ == '__main__':
     unittest.main()
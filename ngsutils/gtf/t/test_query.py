@@ -19,5 +19,10 @@ class GTFQueryTest(unittest.TestCase):
         genes = list(ngsutils.gtf.query.gtf_query(GTF(fname, cache_enabled=False), 'chr1', 1000, 2000))
         self.assertEquals(str(genes[0]), 'foo1(iso1) chr1:1000-2500[+]')
 
+    def testParseRegion(self):
+        self.assertEqual(ngsutils.gtf.query.parse_region('chr1:1000-2000'), ('chr1', 1000, 2000, None))
+        self.assertEqual(ngsutils.gtf.query.parse_region('missing.gtf'), None)
+        self.assertEqual(ngsutils.gtf.query.parse_region('chr1:1000'), None)
+
 if __name__ == '__main__':
     unittest.main()
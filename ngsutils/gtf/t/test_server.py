@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Tests for gtfutils / server
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ngsutils.gtf import GTF
+from ngsutils.gtf.server import GTFServer, RemoteGTF, load_gtf
+
+fname = os.path.join(os.path.dirname(__file__), 'test1.gtf')
+
+
+class GTFServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'gtf.sock')
+        self.server = GTFServer(self.socket_path, {'test': GTF(fname, cache_enabled=False, quiet=True)}, quiet=True)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        for i in xrange(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join(1)
+        shutil.rmtree(self.tmpdir)
+
+    def testFind(self):
+        gtf = RemoteGTF('test', self.socket_path)
+        genes = list(gtf.find('chr1', 1000, 2000))
+        self.assertEquals(str(genes[0]), 'foo1(iso1) chr1:1000-2500[+]')
+
+        results = gtf.find_batch([('chr1', 1000, 2000, None), ('chr1', 1000, 2000, '-')])
+        self.assertEquals([str(g) for g in results[0]], [str(g) for g in genes])
+        self.assertEquals(results[1], [])
+        gtf.close()
+
+    def testLoadGTF(self):
+        gtf = load_gtf('test', quiet=True, socket_path=self.socket_path)
+        self.assertTrue(isinstance(gtf, RemoteGTF))
+        self.assertEquals(gtf.get_by_id('missing'), None)
+        gtf.close()
+
+        gtf = load_gtf(fname, quiet=True, socket_path=os.path.join(self.tmpdir, 'missing.sock'))
+        self.assertTrue(isinstance(gtf, GTF))
+
+    def testReload(self):
+        'GTF files are re-loaded when they change'
+        gtfname = os.path.join(self.tmpdir, 'test.gtf')
+        shutil.copy(fname, gtfname)
+
+        gtf = RemoteGTF(gtfname, self.socket_path)
+        self.assertEquals([str(g) for g in gtf.find('chr1', 0, 5000)], ['foo1(iso1) chr1:1000-2500[+]'])
+
+        with open(gtfname, 'w') as f:
+            f.write('chr1\ttest\texon\t3001\t3500\t0\t-\t.\tgene_id "foo1"; transcript_id "bar1"; isoform_id "iso1"\n')
+
+        # make sure the file looks newer (for the GTF .cache as well)
+        mtime = os.stat(gtfname).st_mtime + 10
+        os.utime(gtfname, (mtime, mtime))
+
+        self.assertEquals([str(g) for g in gtf.find('chr1', 0, 5000)], ['foo1(iso1) chr1:3000-3500[-]'])
+        gtf.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
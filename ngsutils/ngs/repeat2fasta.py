@@ -10,16 +10,11 @@ simple repeats, etc...)
 import sys
 import os
 import gzip
-import pysam
+from ngsutils.support.refcache import fetch_regions
 
 
-def repeat2fasta(repeat_fname, ref_fname, repeat_family=None):
-    if repeat_fname[-3:] == '.gz':
-        repeat_f = gzip.open(repeat_fname)
-    else:
-        repeat_f = open(repeat_fname)
-    
-    ref = pysam.Fastafile(ref_fname)
+def _repeats(repeat_f, repeat_family=None):
+    '''Yields (chrom, start, end, family, member) for each repeat'''
     repeat_f.next()
     repeat_f.next()
     repeat_f.next()
@@ -34,22 +29,38 @@ def repeat2fasta(repeat_fname, ref_fname, repeat_family=None):
         #strand = '+' if cols[8] == '+' else '-'
         family = cols[10]
         member = cols[9]
-        
+
         if repeat_family and family != repeat_family:
             continue
 
-        sys.stdout.write('>%s|%s|%s:%s-%s\n' % (family, member, chrom, start, end))
-        sys.stdout.write('%s\n' % wrap(ref.fetch(chrom, start, end)))
+        yield (chrom, start, end, family, member)
+
+
+def repeat2fasta(repeat_fname, ref_fname, repeat_family=None, out=sys.stdout, batchsize=100000):
+    '''
+    Repeats are extracted from the reference in sorted batches of {batchsize}
+    (see ngsutils.support.refcache.fetch_regions), but are written in the same
+    order as the RepeatMasker file.
+    '''
+    if repeat_fname[-3:] == '.gz':
+        repeat_f = gzip.open(repeat_fname)
+    else:
+        repeat_f = open(repeat_fname)
 
+    buf = []
+    for (chrom, start, end, family, member), seq in fetch_regions(ref_fname, _repeats(repeat_f, repeat_family), batchsize=batchsize):
+        buf.append('>%s|%s|%s:%s-%s\n%s\n' % (family, member, chrom, start, end, wrap(seq)))
+        if len(buf) >= 10000:
+            out.write(''.join(buf))
+            buf = []
+
+    out.write(''.join(buf))
     repeat_f.close()
-    ref.close()
+
 
 def wrap(s, length=50):
-    ar = []
-    while s:
-        ar.append(s[:length])
-        s = s[length:]
-    return '\n'.join(ar)
+    return '\n'.join([s[i:i + length] for i in xrange(0, len(s), length)])
+
 
 def usage(msg=None):
     if msg:
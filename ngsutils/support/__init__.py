@@ -1,8 +1,10 @@
 import collections
 import gzip
+import mmap
 import os
 import sys
 import re
+import string
 from eta import ETA
 
 
@@ -30,6 +32,13 @@ class FASTARead(collections.namedtuple('FASTARecord', 'name comment seq')):
 
 
 class FASTA(object):
+    '''
+    FASTA file reader. fetch() yields each record in the file. For
+    uncompressed files, fetch(chrom, start, end) returns the sequence for a
+    region (0-based, like pysam) using a faidx (.fai) index, which is read or
+    built as needed. The file is memory-mapped and regions are sliced
+    directly from it.
+    '''
     def __init__(self, fname=None, fileobj=None, qual=False):
         self.fname = fname
         self.qual = qual
@@ -46,9 +55,22 @@ class FASTA(object):
         if not self.fileobj:
             raise ValueError("Missing valid filename or fileobj")
 
+        self._index = None
+        self._references = None
+        self._mmfile = None
+        self._mm = None
+
+    @property
+    def filename(self):
+        return self.fname
+
     def close(self):
         if self.fileobj != sys.stdout:
             self.fileobj.close()
+        if self._mm:
+            self._mm.close()
+            self._mmfile.close()
+            self._mm = None
 
     def tell(self):
         # always relative to uncompressed...
@@ -57,7 +79,17 @@ class FASTA(object):
     def seek(self, pos, whence=0):
         self.fileobj.seek(pos, whence)
 
-    def fetch(self, quiet=False):
+    def fetch(self, chrom=None, start=None, end=None, quiet=False):
+        '''
+        With no arguments, yields each record (FASTARead) in the file.
+        Otherwise, returns the sequence for chrom:start-end (0-based). start
+        and end default to the whole reference.
+        '''
+        if chrom is None:
+            return self._fetch_records(quiet)
+        return self.fetch_region(chrom, start, end)
+
+    def _fetch_records(self, quiet=False):
         name = ''
         comment = ''
         seq = ''
@@ -102,6 +134,183 @@ class FASTA(object):
         if eta:
             eta.done()
 
+    def _load_index(self):
+        '''
+        Reads the faidx index ({fname}.fai), building it first if it is
+        missing or older than the FASTA file. If the index can't be written,
+        it is only kept in memory.
+        '''
+        if self._index is not None:
+            return
+
+        if not self.fname or self.fname == '-' or self.fname[-3:] == '.gz' or self.fname[-4:] == '.bgz':
+            raise ValueError('Random access requires an uncompressed FASTA file')
+
+        fname = os.path.expanduser(self.fname)
+        idxname = '%s.fai' % fname
+
+        if os.path.exists(idxname) and os.stat(idxname).st_mtime >= os.stat(fname).st_mtime:
+            entries = []
+            with open(idxname) as f:
+                for line in f:
+                    cols = line.rstrip('\n').split('\t')
+                    entries.append((cols[0], int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4])))
+        else:
+            entries = fasta_build_index(fname)
+            try:
+                with open(idxname, 'w') as out:
+                    for entry in entries:
+                        out.write('%s\n' % '\t'.join([str(x) for x in entry]))
+            except IOError:
+                pass
+
+        self._references = [entry[0] for entry in entries]
+        self._index = dict([(entry[0], entry[1:]) for entry in entries])
+
+        self._mmfile = open(fname, 'rb')
+        if os.fstat(self._mmfile.fileno()).st_size > 0:
+            self._mm = mmap.mmap(self._mmfile.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = ''
+
+    @property
+    def references(self):
+        self._load_index()
+        return self._references
+
+    @property
+    def lengths(self):
+        self._load_index()
+        return [self._index[ref][0] for ref in self._references]
+
+    def get_reference_length(self, chrom):
+        self._load_index()
+        return self._index[chrom][0]
+
+    def fetch_region(self, chrom, start=None, end=None):
+        '''
+        Returns the sequence for chrom:start-end (0-based). Positions past
+        the end of the reference are ignored. Raises KeyError for unknown
+        references.
+        '''
+        self._load_index()
+        length, offset, linebases, linewidth = self._index[chrom]
+
+        start = 0 if start is None else max(start, 0)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+
+        byte_start = offset + (start / linebases) * linewidth + (start % linebases)
+        byte_end = offset + ((end - 1) / linebases) * linewidth + ((end - 1) % linebases) + 1
+        seq = self._mm[byte_start:byte_end]
+
+        if (start / linebases) != ((end - 1) / linebases):
+            # the region spans more than one line
+            seq = seq.replace('\n', '')
+            if linewidth - linebases > 1:
+                seq = seq.replace('\r', '')
+        return seq
+
+    def fetch_many(self, regions, max_span=1000000):
+        '''
+        Returns the sequences for a list of (chrom, start, end) regions, in the
+        same order. Regions are sorted and nearby regions on the same reference
+        are read together (in spans of up to max_span bases), so that each
+        part of the file is only read once.
+        '''
+        return fasta_fetch_many(self.fetch_region, regions, max_span)
+
+
+def fasta_fetch_many(fetch, regions, max_span=1000000):
+    '''
+    Returns the sequences for a list of (chrom, start, end) regions, in the
+    same order, using fetch(chrom, start, end) (FASTA.fetch_region or
+    pysam.Fastafile.fetch). Regions are sorted and nearby regions on the same
+    reference are fetched together, in spans of up to max_span bases.
+    '''
+    results = [None] * len(regions)
+    order = sorted(xrange(len(regions)), key=regions.__getitem__)
+
+    group = []
+    span_chrom = None
+    span_start = 0
+    span_end = 0
+
+    for i in order:
+        chrom, start, end = regions[i]
+        start = max(start, 0)
+        if group and (chrom != span_chrom or end - span_start > max_span or start > span_end + 1000):
+            _fetch_group(fetch, regions, group, results, span_chrom, span_start, span_end)
+            group = []
+
+        if not group:
+            span_chrom = chrom
+            span_start = start
+            span_end = end
+        elif end > span_end:
+            span_end = end
+
+        group.append(i)
+
+    if group:
+        _fetch_group(fetch, regions, group, results, span_chrom, span_start, span_end)
+
+    return results
+
+
+def _fetch_group(fetch, regions, group, results, chrom, span_start, span_end):
+    if len(group) == 1:
+        results[group[0]] = fetch(*regions[group[0]])
+        return
+
+    seq = fetch(chrom, span_start, span_end)
+    for i in group:
+        results[i] = seq[max(regions[i][1], 0) - span_start:regions[i][2] - span_start]
+
+
+def fasta_build_index(fname):
+    '''
+    Scans an uncompressed FASTA file and returns the faidx index entries:
+    (name, length, offset, line bases, line width)
+    '''
+    entries = []
+    name = None
+    length = 0
+    offset = 0
+    linebases = 0
+    linewidth = 0
+    last_short = False
+    pos = 0
+
+    with open(fname, 'rb') as f:
+        for line in f:
+            if line[0] == '>':
+                if name:
+                    entries.append((name, length, offset, linebases, linewidth))
+                name = re.split(r'[ \t\r\n]', line[1:], maxsplit=1)[0]
+                length = 0
+                offset = pos + len(line)
+                linebases = 0
+                linewidth = 0
+                last_short = False
+            elif name:
+                bases = len(line.rstrip('\r\n'))
+                if bases:
+                    if not linebases:
+                        linebases = bases
+                        linewidth = len(line)
+                    elif last_short or bases > linebases or (bases == linebases and len(line) != linewidth):
+                        raise ValueError('Different line lengths in FASTA record: %s' % name)
+                    last_short = bases < linebases
+                    length += bases
+            pos += len(line)
+
+    if name:
+        entries.append((name, length, offset, linebases, linewidth))
+
+    return entries
+
 
 def gzip_reader(fname, quiet=False, callback=None, done_callback=None, fileobj=None):
     if fileobj:
@@ -165,18 +374,24 @@ _compliments = {
 }
 
 
+_revcomp_table = string.maketrans(''.join(_compliments.keys()), ''.join(_compliments.values()))
+_revcomp_bases = ''.join(_compliments.keys())
+
+
 def revcomp(seq):
     '''
     >>> revcomp('ATCGatcg')
     'cgatCGAT'
+    >>> revcomp('ATCGR')
+    Traceback (most recent call last):
+    ...
+    KeyError: 'R'
     '''
-    ret = []
-
-    for s in seq:
-        ret.append(_compliments[s])
-
-    ret.reverse()
-    return ''.join(ret)
+    seq = str(seq)
+    invalid = seq.translate(None, _revcomp_bases)
+    if invalid:
+        raise KeyError(invalid[0])
+    return seq.translate(_revcomp_table)[::-1]
 
 
 class Counts(object):
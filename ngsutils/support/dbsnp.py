@@ -76,17 +76,70 @@ def autotype(ar, length=26):
 
 
 class DBSNP(object):
-    def __init__(self, fname):
+    '''
+    Lookups for a tabix-indexed dbSNP dump.
+
+    Reads are usually processed in coordinate order, so instead of a separate
+    tabix query for each position, all SNPs in a {window} sized block are
+    loaded (and parsed) at once. Blocks that are behind the current block are
+    dropped from memory. Set window=0 to query each position directly.
+
+    Zero-length records (insertions) are indexed by tabix as covering the
+    base before chromStart, so both kinds of queries start one base early.
+    '''
+    def __init__(self, fname, window=1000000):
         self.dbsnp = pysam.Tabixfile(fname)
         self.asTup = pysam.asTuple()
+        self.window = window
+
+        self._chrom = None
+        self._blocks = {}
+
+    def _load_block(self, chrom, block):
+        if chrom != self._chrom:
+            self._chrom = chrom
+            self._blocks = {}
+        else:
+            for k in self._blocks.keys():
+                # keep the previous block - reads can start before the
+                # last mismatch position checked
+                if k < block - 1:
+                    del self._blocks[k]
+
+        start = block * self.window
+        end = start + self.window
+
+        snps = {}
+        for tup in self.dbsnp.fetch(chrom, max(start - 1, 0), end, parser=self.asTup):
+            snp = SNPRecord._make(autotype(tup))
+            if start <= snp.chromStart < end:
+                if not snp.chromStart in snps:
+                    snps[snp.chromStart] = [snp]
+                else:
+                    snps[snp.chromStart].append(snp)
+
+        self._blocks[block] = snps
+        return snps
 
     def fetch(self, chrom, pos):
         'Note: pos is 0-based'
 
+        if self.window:
+            block = pos / self.window
+            if chrom == self._chrom and block in self._blocks:
+                snps = self._blocks[block]
+            else:
+                snps = self._load_block(chrom, block)
+
+            if pos in snps:
+                for snp in snps[pos]:
+                    yield snp
+            return
+
         # Note: tabix the command uses 1-based positions, but
         #       pysam.Tabixfile uses 0-based positions
 
-        for tup in self.dbsnp.fetch(chrom, pos, pos + 1, parser=self.asTup):
+        for tup in self.dbsnp.fetch(chrom, max(pos - 1, 0), pos + 1, parser=self.asTup):
             snp = SNPRecord._make(autotype(tup))
             if snp.chromStart == pos:
                 yield snp
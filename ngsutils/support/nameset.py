@@ -0,0 +1,457 @@
+'''
+Compact read-name sets
+
+Whitelists/blacklists of read names can be very large (hundreds of millions
+of names). Instead of loading these into a Python set, a name list can be
+converted once into an index file that is memory-mapped when used. Because
+the file is mapped read-only, multiple processes share the same pages.
+
+The index file contains:
+    - a Bloom filter of the names (fast rejection of names not in the set)
+    - a sorted array of 64-bit name hashes
+    - (optional) the names themselves, in hash order, to verify matches exactly
+
+Without the exact names, there is a very small chance (~n/2^64) that a name
+not in the set will be reported as present.
+
+File layout (little-endian):
+    magic       'NGSNAME1'
+    count       uint64
+    bloom_bits  uint64
+    bloom_k     uint32
+    exact       uint32
+    hashes      uint64 * count
+    bloom       bloom_bits / 8 bytes
+    offsets     uint64 * (count + 1)    (exact only)
+    names       '\\n' terminated names   (exact only)
+'''
+
+import binascii
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+_MAGIC = 'NGSNAME1'
+_HEADER = struct.Struct('<8sQQII')
+
+
+def name_hash(name):
+    'Returns a 64-bit hash for a name'
+    return struct.unpack('<Q', hashlib.md5(name).digest()[:8])[0]
+
+
+def read_name_list(fname):
+    'Yields the read names (first column) from a text file'
+    with open(fname) as f:
+        for line in f:
+            cols = line.strip().split()
+            if cols:
+                yield cols[0]
+
+
+def is_name_index(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def load_name_set(fname):
+    '''
+    Loads a set of read names from either a name index file (see
+    build_name_index) or a text file (one name per line). The returned object
+    supports "name in names".
+    '''
+    if is_name_index(fname):
+        return NameIndex(fname)
+    return set(read_name_list(fname))
+
+
+def build_name_index(names, outname, exact=False, bits_per_name=10, quiet=False, chunk_size=2000000, tmpdir=None):
+    '''
+    Writes a name index file for the given names (iterable).
+
+    bits_per_name sets the size of the Bloom filter. 10 bits per name gives
+    a false positive rate of about 1%. Use 0 to skip the Bloom filter.
+
+    Names are hashed and sorted in chunks of {chunk_size} names, which are
+    written to temporary files (in tmpdir, or the same directory as outname)
+    and then merged. Only the Bloom filter is held in memory in full.
+    '''
+    if not tmpdir:
+        tmpdir = os.path.dirname(os.path.abspath(outname))
+
+    tmpfiles = []
+
+    def _tmpfile():
+        tmp = tempfile.NamedTemporaryFile(prefix='.tmp', dir=tmpdir, delete=False)
+        tmpfiles.append(tmp.name)
+        return tmp
+
+    try:
+        runs = []
+        chunk = []
+        for name in names:
+            chunk.append((name_hash(name), name) if exact else name_hash(name))
+            if len(chunk) >= chunk_size:
+                runs.append(_write_run(_tmpfile(), chunk, exact))
+                chunk = []
+        if chunk or not runs:
+            runs.append(_write_run(_tmpfile(), chunk, exact))
+        chunk = None
+
+        # merge the sorted runs into the final hash list (and name list)
+        hashes_f = _tmpfile()
+        names_f = _tmpfile() if exact else None
+        count = 0
+        last = None
+
+        readers = [open(run, 'rb') for run in runs]
+        try:
+            if exact:
+                merged = heapq.merge(*[_read_name_run(f) for f in readers])
+            else:
+                merged = heapq.merge(*[_read_hash_run(f) for f in readers])
+
+            buf = []
+            for val in merged:
+                if val == last:
+                    continue
+                last = val
+                count += 1
+                if exact:
+                    buf.append(val[0])
+                    names_f.write('%s\n' % val[1])
+                else:
+                    buf.append(val)
+                if len(buf) >= 65536:
+                    _write_uint64(hashes_f, buf)
+                    buf = []
+            _write_uint64(hashes_f, buf)
+        finally:
+            for f in readers:
+                f.close()
+                os.unlink(f.name)
+
+        hashes_f.close()
+        if names_f:
+            names_f.close()
+
+        bloom_bits = ((count * bits_per_name + 7) / 8) * 8
+        bloom_k = max(1, int(round(0.693 * bits_per_name))) if bloom_bits else 0
+        bloom = bytearray(bloom_bits / 8)
+
+        if bloom_bits:
+            for h in _read_hashes(hashes_f.name):
+                h2 = _rehash(h)
+                for i in xrange(bloom_k):
+                    bit = (h + i * h2) % bloom_bits
+                    bloom[bit >> 3] |= 1 << (bit & 7)
+
+        with open(outname, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, count, bloom_bits, bloom_k, 1 if exact else 0))
+            with open(hashes_f.name, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            out.write(bloom)
+
+            if exact:
+                offsets = [0]
+                pos = 0
+                with open(names_f.name) as f:
+                    for line in f:
+                        pos += len(line)
+                        offsets.append(pos)
+                        if len(offsets) >= 65536:
+                            _write_uint64(out, offsets)
+                            offsets = []
+                _write_uint64(out, offsets)
+
+                with open(names_f.name, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+    finally:
+        for tmpfile in tmpfiles:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    if not quiet:
+        sys.stderr.write('Wrote %s names to %s\n' % (count, outname))
+
+
+def _write_run(tmp, chunk, exact):
+    '''
+    Writes a sorted chunk to a temporary file: packed uint64 hashes, or
+    "hash\\tname" lines (hex hashes, so they sort as text) if exact.
+    '''
+    chunk.sort()
+    if exact:
+        for h, name in chunk:
+            tmp.write('%016x\t%s\n' % (h, name))
+    else:
+        _write_uint64(tmp, chunk)
+    tmp.close()
+    return tmp.name
+
+
+def _read_name_run(f):
+    for line in f:
+        h, name = line.rstrip('\n').split('\t', 1)
+        yield int(h, 16), name
+
+
+def _read_hash_run(f, chunk=65536):
+    while True:
+        data = f.read(8 * chunk)
+        if not data:
+            break
+        for h in struct.unpack('<%sQ' % (len(data) / 8), data):
+            yield h
+
+
+def _read_hashes(fname):
+    with open(fname, 'rb') as f:
+        for h in _read_hash_run(f):
+            yield h
+
+
+def _write_uint64(out, values, chunk=65536):
+    for i in xrange(0, len(values), chunk):
+        vals = values[i:i + chunk]
+        out.write(struct.pack('<%sQ' % len(vals), *vals))
+
+
+def _rehash(h):
+    'Second hash for the Bloom filter, derived from the stored hash'
+    return (h * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) & 0xFFFFFFFFFFFFFFFF | 1
+
+
+class NameIndex(object):
+    '''
+    A memory-mapped name index (see build_name_index)
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self._file = open(fname, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.bloom_bits, self.bloom_k, exact = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError('Not a valid name index: %s' % fname)
+
+        self.exact = exact == 1
+        self._hash_offset = _HEADER.size
+        self._bloom_offset = self._hash_offset + 8 * self.count
+        self._names_offset = self._bloom_offset + self.bloom_bits / 8
+        self._text_offset = self._names_offset + 8 * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def _hash(self, i):
+        return struct.unpack_from('<Q', self._mm, self._hash_offset + 8 * i)[0]
+
+    def _name(self, i):
+        start, end = struct.unpack_from('<QQ', self._mm, self._names_offset + 8 * i)
+        return self._mm[self._text_offset + start:self._text_offset + end - 1]
+
+    def _bloom_check(self, h1):
+        h2 = _rehash(h1)
+        mm = self._mm
+        offset = self._bloom_offset
+        for i in xrange(self.bloom_k):
+            bit = (h1 + i * h2) % self.bloom_bits
+            if not ord(mm[offset + (bit >> 3)]) & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __contains__(self, name):
+        h1 = name_hash(name)
+
+        if self.bloom_bits:
+            if not self._bloom_check(h1):
+                return False
+
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self._hash(mid) < h1:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if not self.exact:
+            return lo < self.count and self._hash(lo) == h1
+
+        while lo < self.count and self._hash(lo) == h1:
+            if self._name(lo) == name:
+                return True
+            lo += 1
+        return False
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+class _BloomFilter(object):
+    'A Bloom filter of name hashes with a given capacity and error rate'
+    def __init__(self, capacity, error):
+        self.capacity = capacity
+        self.error = error
+        self.count = 0
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error) / (math.log(2) ** 2))))
+        self.k = max(1, int(round(math.log(2) * self.bits / capacity)))
+        self.bloom = bytearray((self.bits + 7) / 8)
+
+    def add(self, h1):
+        h2 = _rehash(h1)
+        bloom = self.bloom
+        for i in xrange(self.k):
+            bit = (h1 + i * h2) % self.bits
+            bloom[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def __contains__(self, h1):
+        h2 = _rehash(h1)
+        bloom = self.bloom
+        for i in xrange(self.k):
+            bit = (h1 + i * h2) % self.bits
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def set_bits(self):
+        'Number of bits that are set'
+        count = 0
+        for i in xrange(0, len(self.bloom), 65536):
+            count += bin(int(binascii.hexlify(self.bloom[i:i + 65536]), 16)).count('1')
+        return count
+
+    def union(self, other):
+        '''
+        Adds the names from another filter with the same size. count is then
+        estimated from the number of bits that are set, so that names in both
+        filters are only counted once.
+        '''
+        if other.bits != self.bits or other.k != self.k:
+            raise ValueError('Bloom filters must be the same size')
+
+        for i in xrange(0, len(self.bloom), 65536):
+            one = self.bloom[i:i + 65536]
+            val = int(binascii.hexlify(one), 16) | int(binascii.hexlify(other.bloom[i:i + 65536]), 16)
+            self.bloom[i:i + 65536] = binascii.unhexlify('%0*x' % (len(one) * 2, val))
+
+        fill = float(self.set_bits()) / self.bits
+        if fill < 1:
+            self.count = int(round(-float(self.bits) / self.k * math.log(1 - fill)))
+        else:
+            self.count = max(self.count, other.count)
+
+    def copy(self):
+        f = _BloomFilter(self.capacity, self.error)
+        f.count = self.count
+        f.bloom = bytearray(self.bloom)
+        return f
+
+    @property
+    def false_positive_rate(self):
+        'Estimated false positive rate (from the bits that are set)'
+        return (float(self.set_bits()) / self.bits) ** self.k
+
+
+class BoundedNameSet(object):
+    '''
+    A set of names with bounded memory use, for counting names only once
+    (for example, reads with multiple mappings).
+
+    The first {max_names} names are stored exactly (as 64-bit hashes). After
+    that, new names are added to a series of Bloom filters, each twice the
+    size of the last with half the error rate, so that the false positive
+    rate for a lookup stays below {error}. A false positive means that a new
+    name is reported as already seen.
+
+    Sets can be merged with update(). If Bloom filters are merged, len() is
+    an estimate (estimated is True) and error_bound may be higher than
+    {error}.
+    '''
+    def __init__(self, max_names=10000000, error=0.001):
+        self.max_names = max_names
+        self.error = error
+        self.hashes = set()
+        self.filters = []
+        self.count = 0
+        self.estimated = False
+
+    def __len__(self):
+        'Number of names added (approximate if not exact)'
+        return self.count
+
+    @property
+    def exact(self):
+        return not self.filters
+
+    @property
+    def error_bound(self):
+        'Estimated upper bound for the false positive rate of a lookup'
+        return sum([f.false_positive_rate for f in self.filters])
+
+    def _contains_hash(self, h):
+        if h in self.hashes:
+            return True
+        for f in self.filters:
+            if h in f:
+                return True
+        return False
+
+    def __contains__(self, name):
+        return self._contains_hash(name_hash(name))
+
+    def _add_hash(self, h):
+        if not self.filters and len(self.hashes) < self.max_names:
+            self.hashes.add(h)
+        else:
+            if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+                self.filters.append(_BloomFilter(max(self.max_names, 1024) << len(self.filters), self.error / (2 << len(self.filters))))
+            self.filters[-1].add(h)
+        self.count += 1
+
+    def add(self, name):
+        'Adds a name. Returns True if the name is new, False if it was already seen.'
+        h = name_hash(name)
+        if self._contains_hash(h):
+            return False
+        self._add_hash(h)
+        return True
+
+    def update(self, other):
+        '''
+        Adds the names from another set. Exact names are added one by one.
+        Each of the other set's Bloom filters is combined with the filter at
+        the same position in this set (if they are the same size, which is
+        the case for sets with the same max_names and error), otherwise it is
+        added as a new filter.
+
+        After merging Bloom filters, len() is an estimate: names in both
+        filters are only counted once (estimated from the bits that are set),
+        but names that one set stored exactly and the other in a Bloom filter
+        are counted twice. The merged filters have more bits set, so
+        error_bound may be higher than {error}.
+        '''
+        for h in other.hashes:
+            if not self._contains_hash(h):
+                self._add_hash(h)
+
+        for i, f in enumerate(other.filters):
+            if i < len(self.filters) and self.filters[i].bits == f.bits and self.filters[i].k == f.k:
+                self.filters[i].union(f)
+            else:
+                self.filters.append(f.copy())
+
+        if other.filters or other.estimated:
+            self.estimated = True
+            self.count = len(self.hashes) + sum([f.count for f in self.filters])
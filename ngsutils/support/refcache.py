@@ -0,0 +1,136 @@
+'''
+Cached access to a reference FASTA file
+
+Commands that walk a coordinate-sorted BAM file (or pileup) and look up the
+reference sequence for each read or position make many small, increasing
+requests. Each request to pysam.Fastafile goes back through faidx. RefCache
+instead reads a large window of the reference ahead of the current position
+and serves requests from that window until they move past it.
+
+Optionally, an uncompressed FASTA file can be memory-mapped (see
+ngsutils.support.FASTA), so that windows are read directly from the mapped
+file.
+
+For commands that extract many (unsorted) intervals, fetch_regions sorts the
+intervals in batches, reads each part of the reference once, and returns the
+sequences in the original order.
+'''
+
+import pysam
+from ngsutils.support import FASTA, fasta_fetch_many
+
+
+class RefCache(object):
+    '''
+    Reference sequence accessor with a sliding window cache. ref can be a
+    filename or an open pysam.Fastafile.
+
+    Requests that fall inside the current window are sliced from it. A
+    request past the window (or on another reference) loads a new window of
+    {window} bases starting at the request. Requests before the current
+    window (out of order) are fetched directly, without replacing the window.
+    With a window of 0, each request is fetched on its own (for unsorted
+    requests).
+
+    If use_mmap is True, ref must be an uncompressed FASTA file, which is
+    memory-mapped instead of opened with pysam.
+
+    Like pysam, fetch returns a truncated sequence past the end of a
+    reference. Unlike pysam, fetch returns '' for unknown references.
+    '''
+    def __init__(self, ref, window=1000000, use_mmap=False):
+        if isinstance(ref, basestring):
+            if use_mmap:
+                self._ref = FASTA(ref)
+            else:
+                self._ref = pysam.Fastafile(ref)
+            self._close = True
+        else:
+            self._ref = ref
+            self._close = False
+
+        self.filename = self._ref.filename
+        self.window = window
+
+        self._chrom = None
+        self._start = 0
+        self._end = 0
+        self._seq = ''
+
+    def _fetch(self, chrom, start, end):
+        try:
+            return self._ref.fetch(chrom, start, end)
+        except KeyError:
+            return ''
+
+    def fetch(self, chrom, start, end):
+        start = max(start, 0)
+        if chrom == self._chrom and self._start <= start and end <= self._end:
+            return self._seq[start - self._start:end - self._start]
+
+        if chrom != self._chrom or start >= self._start:
+            self._chrom = chrom
+            self._start = start
+            self._end = max(end, start + self.window)
+            self._seq = self._fetch(chrom, self._start, self._end)
+            return self._seq[:end - start]
+
+        return self._fetch(chrom, start, end)
+
+    def close(self):
+        if self._close:
+            self._ref.close()
+
+
+def open_ref(fname):
+    '''
+    Opens a reference FASTA file for random access. Uncompressed files are
+    memory-mapped (ngsutils.support.FASTA), others are opened with pysam.
+    '''
+    if fname[-3:] == '.gz' or fname[-4:] == '.bgz':
+        return pysam.Fastafile(fname)
+    return FASTA(fname)
+
+
+def fetch_regions(ref, regions, batchsize=100000, max_span=1000000):
+    '''
+    Yields (region, seq) for each region in regions, in the same order.
+    Each region is a tuple (or namedtuple) that starts with chrom, start, end.
+    ref can be a filename or an open FASTA / pysam.Fastafile.
+
+    Regions are read in batches of {batchsize}. Each batch is sorted and
+    nearby regions are read from the reference together, in spans of up to
+    {max_span} bases. Sequences for unknown references are ''.
+    '''
+    if isinstance(ref, basestring):
+        ref = open_ref(ref)
+        close = True
+    else:
+        close = False
+
+    try:
+        refs = set(ref.references)
+        batch = []
+        for region in regions:
+            batch.append(region)
+            if len(batch) >= batchsize:
+                for tup in _fetch_batch(ref, refs, batch, max_span):
+                    yield tup
+                batch = []
+
+        for tup in _fetch_batch(ref, refs, batch, max_span):
+            yield tup
+    finally:
+        if close:
+            ref.close()
+
+
+def _fetch_batch(ref, refs, batch, max_span):
+    found = [(region[0], region[1], region[2]) for region in batch if region[0] in refs]
+    seqs = iter(fasta_fetch_many(ref.fetch, found, max_span))
+
+    for region in batch:
+        if region[0] in refs:
+            yield region, seqs.next()
+        else:
+            yield region, ''
@@ -1,43 +1,109 @@
+import array
+import bisect
+
+
+class _RangeIndex(object):
+    '''
+    The ranges for one chromosome, sorted by start position, with a running
+    maximum of the end positions (max_ends[i] = max(ends[:i + 1])). A search
+    for a position can stop as soon as no earlier range can reach it.
+    '''
+    def __init__(self, ranges):
+        order = sorted(xrange(len(ranges)), key=lambda i: ranges[i][0])
+        self.starts = array.array('l', [ranges[i][0] for i in order])
+        self.ends = array.array('l', [ranges[i][1] for i in order])
+        self.strands = [ranges[i][2] for i in order]
+        self.order = array.array('l', order)
+        self.max_ends = array.array('l')
+
+        max_end = None
+        for end in self.ends:
+            if max_end is None or end > max_end:
+                max_end = end
+            self.max_ends.append(max_end)
+
+    def find(self, pos, lo=0):
+        '''
+        Returns the index of the most recently added range that contains pos
+        (start <= pos <= end), or -1. lo is a lower bound for the bisect
+        (for sorted positions).
+        '''
+        i = bisect.bisect_right(self.starts, pos, lo) - 1
+        best = -1
+        while i >= 0 and self.max_ends[i] >= pos:
+            if self.ends[i] >= pos and (best == -1 or self.order[i] > self.order[best]):
+                best = i
+            i -= 1
+        return best
+
+
 class RangeMatch(object):
     '''
     Simple genomic ranges.  You can define chrom:start-end ranges, then ask if a
-    particular genomic coordinate maps to any of those ranges.  This is less-
-    efficient than an R-Tree, but easier to code.
+    particular genomic coordinate maps to any of those ranges.
+
+    Ranges are stored per chromosome in sorted arrays, which are (re)built
+    the first time a chromosome is searched after adding ranges. If more than
+    one range contains a position, the most recently added range is used.
     '''
     def __init__(self, name):
         self.ranges = {}
         self.name = name
+        self._index = {}
 
     def add_range(self, chrom, strand, start, end):
         if not chrom in self.ranges:
-            self.ranges[chrom] = {}
+            self.ranges[chrom] = []
+        self.ranges[chrom].append((start, end, strand))
+        self._index.pop(chrom, None)
 
-        bin = start / 100000
-        if not bin in self.ranges[chrom]:
-            self.ranges[chrom][bin] = []
-        self.ranges[chrom][bin].insert(0, (start, end, strand))
-
-        if (end / 100000) != bin:
-            for bin in xrange(bin + 1, (end / 100000) + 1):
-                if not bin in self.ranges[chrom]:
-                    self.ranges[chrom][bin] = []
-                self.ranges[chrom][bin].insert(0, (start, end, strand))
+    def _chrom_index(self, chrom):
+        try:
+            return self._index[chrom]
+        except KeyError:
+            if not chrom in self.ranges:
+                return None
+            index = _RangeIndex(self.ranges[chrom])
+            self._index[chrom] = index
+            return index
 
     def get_tag(self, chrom, strand, pos, ignore_strand=False):
         '''
         returns (region, is_reverse_orientation)
         '''
-        if not chrom in self.ranges:
+        index = self._chrom_index(chrom)
+        if not index:
             return None, False
-        bin = pos / 100000
-        if not bin in self.ranges[chrom]:
+
+        i = index.find(pos)
+        if i == -1:
             return None, False
-        for start, end, r_strand in self.ranges[chrom][bin]:
-            if pos >= start and pos <= end:
-                if ignore_strand or strand == r_strand:
-                    return self.name, False
-                return self.name, True
-        return None, False
+        if ignore_strand or strand == index.strands[i]:
+            return self.name, False
+        return self.name, True
+
+    def get_tags(self, chrom, strands, positions, ignore_strand=False):
+        '''
+        Same as get_tag for a list of positions (and strands) on one
+        chromosome. Returns a list of (region, is_reverse_orientation).
+        '''
+        index = self._chrom_index(chrom)
+        if not index:
+            return [(None, False)] * len(positions)
+
+        tags = [None] * len(positions)
+        lo = 0
+        for j in sorted(xrange(len(positions)), key=positions.__getitem__):
+            pos = positions[j]
+            lo = bisect.bisect_right(index.starts, pos, lo)
+            i = index.find(pos, lo)
+            if i == -1:
+                tags[j] = (None, False)
+            elif ignore_strand or strands[j] == index.strands[i]:
+                tags[j] = (self.name, False)
+            else:
+                tags[j] = (self.name, True)
+        return tags
 
 
 class RegionTagger(object):
@@ -141,6 +207,63 @@ class RegionTagger(object):
 
         return tag
 
+    def tag_reads(self, reads, chroms):
+        '''
+        Same as add_read for a batch of reads (chroms is the reference name
+        for each read). Reads are grouped by reference and each type of
+        region is searched for all of the (remaining) reads at once.
+
+        Returns a list with the tag for each read (None for reads that
+        aren't counted).
+        '''
+        tags = [None] * len(reads)
+        pending = {}
+
+        for i, (read, chrom) in enumerate(zip(reads, chroms)):
+            if read.is_unmapped:
+                continue
+
+            if self.only_first_fragment and read.is_paired and not read.is_read1:
+                continue
+
+            if chrom == 'chrM':
+                tags[i] = 'mitochondrial'
+                continue
+
+            for op, length in read.cigar:
+                if op == 3:
+                    tags[i] = 'junction'
+                    break
+
+            if not tags[i]:
+                if not chrom in pending:
+                    pending[chrom] = []
+                pending[chrom].append(i)
+
+        for chrom in pending:
+            idx = pending[chrom]
+            for region in self.regions:
+                if not idx:
+                    break
+
+                found = region.get_tags(chrom, ['-' if reads[i].is_reverse else '+' for i in idx], [reads[i].pos for i in idx])
+                remaining = []
+                for i, (tag, is_rev) in zip(idx, found):
+                    if tag:
+                        tags[i] = '%s-rev' % tag if is_rev else tag
+                    else:
+                        remaining.append(i)
+                idx = remaining
+
+            for i in idx:
+                tags[i] = 'intergenic'
+
+        for tag in tags:
+            if tag:
+                self.counts[tag] += 1
+
+        return tags
+
     def tag_region(self, chrom, start, end, strand):
         tag = None
         is_rev = False
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.dbsnp
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pysam
+from ngsutils.support.dbsnp import DBSNP
+
+# bin, chrom, chromStart, chromEnd, name, score, strand, refNCBI, refUCSC, observed, molType, class
+_snps = '''\
+0|chr1|100|101|rs1|0|+|A|A|A/G|genomic|single
+0|chr1|150|151|rs2|0|-|C|C|C/T|genomic|single
+0|chr1|150|151|rs3|0|+|C|C|-/C|genomic|deletion
+0|chr1|1050|1051|rs4|0|+|G|G|G/T|genomic|single
+0|chr1|2000|2000|rs7|0|+|-|-|-/T|genomic|insertion
+0|chr1|2500|2500|rs5|0|+|-|-|-/AA|genomic|insertion
+0|chr2|100|101|rs6|0|+|T|T|T/A|genomic|single
+'''.replace('|', '\t')
+
+
+class DBSNPTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(self.tmpdir, 'snp.txt')
+        with open(fname, 'w') as f:
+            f.write(_snps)
+        self.fname = pysam.tabix_index(fname, seq_col=1, start_col=2, end_col=3, zerobased=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testWindowed(self):
+        direct = DBSNP(self.fname, window=0)
+        windowed = DBSNP(self.fname, window=1000)
+
+        for chrom, pos in [('chr1', 100), ('chr1', 150), ('chr1', 151), ('chr1', 1050), ('chr1', 100), ('chr2', 100), ('chr2', 1050)]:
+            self.assertEqual([s.name for s in direct.fetch(chrom, pos)], [s.name for s in windowed.fetch(chrom, pos)])
+
+        self.assertEqual([s.name for s in windowed.fetch('chr1', 150)], ['rs2', 'rs3'])
+        self.assertTrue(windowed.is_valid_variation('chr1', 0, 100, 'G'))
+        self.assertFalse(windowed.is_valid_variation('chr1', 0, 100, 'T'))
+
+        direct.close()
+        windowed.close()
+
+    def testZeroLength(self):
+        'Zero-length insertions are found by both kinds of queries'
+        direct = DBSNP(self.fname, window=0)
+        windowed = DBSNP(self.fname, window=1000)
+
+        for pos in [1999, 2000, 2001, 2499, 2500, 2501]:
+            self.assertEqual([s.name for s in direct.fetch('chr1', pos)], [s.name for s in windowed.fetch('chr1', pos)])
+            self.assertEqual(direct.is_valid_variation('chr1', 1, pos, 'AA'), windowed.is_valid_variation('chr1', 1, pos, 'AA'))
+
+        for snps in [direct, windowed]:
+            # rs7 is at the start of a block
+            self.assertEqual([s.name for s in snps.fetch('chr1', 2000)], ['rs7'])
+            self.assertEqual([s.name for s in snps.fetch('chr1', 2500)], ['rs5'])
+            self.assertEqual([s.name for s in snps.fetch('chr1', 2499)], [])
+            self.assertTrue(snps.is_valid_variation('chr1', 1, 2500, 'AA'))
+            snps.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.nameset
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngsutils.support.nameset import build_name_index, load_name_set, NameIndex, BoundedNameSet
+
+
+class NameSetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.names = ['read%s' % i for i in xrange(1000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, names):
+        for name in self.names:
+            self.assertTrue(name in names)
+        for i in xrange(1000, 2000):
+            self.assertFalse('read%s' % i in names)
+
+    def testText(self):
+        fname = os.path.join(self.tmpdir, 'names.txt')
+        with open(fname, 'w') as f:
+            for name in self.names:
+                f.write('%s\textra\n' % name)
+
+        names = load_name_set(fname)
+        self.assertTrue(isinstance(names, set))
+        self._check(names)
+
+    def testIndex(self):
+        fname = os.path.join(self.tmpdir, 'names.idx')
+        build_name_index(self.names + self.names[:10], fname, quiet=True)
+        names = load_name_set(fname)
+        self.assertTrue(isinstance(names, NameIndex))
+        self.assertEqual(len(names), 1000)
+        self._check(names)
+        names.close()
+
+    def testIndexExactNoBloom(self):
+        fname = os.path.join(self.tmpdir, 'names.idx')
+        build_name_index(self.names, fname, exact=True, bits_per_name=0, quiet=True)
+        names = load_name_set(fname)
+        self.assertTrue(names.exact)
+        self._check(names)
+        self.assertEqual(names._name(0) in self.names, True)
+        names.close()
+
+    def testIndexChunks(self):
+        'Building from sorted chunks gives the same index'
+        for exact in [False, True]:
+            expected = os.path.join(self.tmpdir, 'expected.idx')
+            build_name_index(self.names, expected, exact=exact, quiet=True)
+
+            fname = os.path.join(self.tmpdir, 'names.idx')
+            build_name_index(self.names[::-1] + self.names[:10], fname, exact=exact, quiet=True, chunk_size=7)
+
+            with open(expected, 'rb') as f1:
+                with open(fname, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+            names = load_name_set(fname)
+            self._check(names)
+            names.close()
+
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['expected.idx', 'names.idx'])
+
+    def testEmpty(self):
+        fname = os.path.join(self.tmpdir, 'names.idx')
+        build_name_index([], fname, exact=True, quiet=True)
+        names = load_name_set(fname)
+        self.assertFalse('read1' in names)
+        names.close()
+
+    def testBoundedExact(self):
+        names = BoundedNameSet(max_names=2000)
+        for name in self.names:
+            self.assertTrue(names.add(name))
+        for name in self.names:
+            self.assertFalse(names.add(name))
+
+        self._check(names)
+        self.assertTrue(names.exact)
+        self.assertEqual(len(names), 1000)
+        self.assertEqual(names.error_bound, 0)
+
+    def testBoundedBloom(self):
+        names = BoundedNameSet(max_names=100, error=0.01)
+        added = [names.add('read%s' % i) for i in xrange(5000)]
+
+        # a few names may be false positives
+        self.assertTrue(sum(added) > 4900)
+        self.assertEqual(len(names), sum(added))
+        self.assertEqual(len(names.hashes), 100)
+        self.assertFalse(names.exact)
+        self.assertTrue(0 < names.error_bound < 0.01)
+
+        # no false negatives
+        for i in xrange(5000):
+            self.assertFalse(names.add('read%s' % i))
+
+    def testBoundedUpdate(self):
+        one = BoundedNameSet(max_names=100)
+        two = BoundedNameSet(max_names=100)
+        for name in self.names[:500]:
+            one.add(name)
+        for name in self.names[250:]:
+            two.add(name)
+
+        one.update(two)
+        for name in self.names:
+            self.assertTrue(name in one)
+        self.assertTrue(sum(['read%s' % i in one for i in xrange(1000, 2000)]) < 5)
+        self.assertEqual(len(one.hashes), 100)
+        self.assertEqual(len(one.filters), 1)  # merged, not appended
+        self.assertTrue(one.estimated)
+        self.assertTrue(980 < len(one) < 1020)  # not 1400
+        self.assertTrue(0 < one.error_bound < 0.002)
+
+        one = BoundedNameSet()
+        two = BoundedNameSet()
+        for name in self.names[:500]:
+            one.add(name)
+        for name in self.names[250:]:
+            two.add(name)
+
+        one.update(two)
+        self._check(one)
+        self.assertTrue(one.exact)
+        self.assertFalse(one.estimated)
+        self.assertEqual(len(one), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.refcache
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pysam
+from ngsutils.support.refcache import RefCache, fetch_regions
+
+
+class RefCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'ref.fa')
+
+        random.seed(1)
+        self.seqs = {}
+        with open(self.fname, 'w') as f:
+            for chrom, length, width in [('chr1', 1000, 60), ('chr2', 257, 50), ('chr3', 10, 4)]:
+                seq = ''.join([random.choice('ACGTacgt') for i in xrange(length)])
+                self.seqs[chrom] = seq
+                f.write('>%s\n' % chrom)
+                for i in xrange(0, length, width):
+                    f.write('%s\n' % seq[i:i + width])
+
+        pysam.faidx(self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _requests(self, sort):
+        reqs = []
+        for i in xrange(500):
+            chrom = random.choice(['chr1', 'chr2', 'chr3'])
+            start = random.randint(0, len(self.seqs[chrom]) + 10)
+            reqs.append((chrom, start, start + random.randint(1, 100)))
+        if sort:
+            reqs.sort()
+        return reqs
+
+    def testFetch(self):
+        for use_mmap in [False, True]:
+            for window in [1, 100, 10000]:
+                ref = RefCache(self.fname, window=window, use_mmap=use_mmap)
+                for sort in [True, False]:
+                    for chrom, start, end in self._requests(sort):
+                        self.assertEqual(ref.fetch(chrom, start, end), self.seqs[chrom][start:end])
+                ref.close()
+
+    def testMissing(self):
+        ref = RefCache(self.fname)
+        self.assertEqual(ref.fetch('chrX', 0, 10), '')
+        self.assertEqual(ref.filename, self.fname)
+        ref.close()
+
+    def testFastafile(self):
+        fasta = pysam.Fastafile(self.fname)
+        ref = RefCache(fasta, window=50)
+        self.assertEqual(ref.fetch('chr1', 10, 20), self.seqs['chr1'][10:20])
+        self.assertEqual(ref.fetch('chr1', 15, 80), self.seqs['chr1'][15:80])
+        ref.close()
+        self.assertEqual(fasta.fetch('chr2', 0, 5), self.seqs['chr2'][:5])
+        fasta.close()
+
+    def testFetchRegions(self):
+        reqs = [(chrom, start, end, i) for i, (chrom, start, end) in enumerate(self._requests(False))]
+        reqs.insert(10, ('chrX', 0, 10, -1))
+        expected = [self.seqs.get(chrom, '')[start:end] for chrom, start, end, i in reqs]
+
+        for batchsize in [1, 7, 1000]:
+            for max_span in [10, 1000000]:
+                found = list(fetch_regions(self.fname, iter(reqs), batchsize=batchsize, max_span=max_span))
+                self.assertEqual([x[0] for x in found], reqs)
+                self.assertEqual([x[1] for x in found], expected)
+
+        fasta = pysam.Fastafile(self.fname)
+        self.assertEqual([x[1] for x in fetch_regions(fasta, reqs, batchsize=10)], expected)
+        fasta.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.regions
+'''
+
+import os
+import random
+import unittest
+import StringIO
+
+import pysam
+from ngsutils.gtf import GTF
+from ngsutils.support.regions import RangeMatch, RegionTagger
+
+
+class RangeMatchTest(unittest.TestCase):
+    def _brute_force(self, ranges, chrom, strand, pos):
+        # the most recently added range that contains pos
+        for r_chrom, r_strand, start, end in ranges[::-1]:
+            if r_chrom == chrom and start <= pos <= end:
+                return 'test', strand != r_strand
+        return None, False
+
+    def testRandom(self):
+        random.seed(1)
+        match = RangeMatch('test')
+        ranges = []
+        for i in xrange(300):
+            start = random.randint(-1000, 100000)
+            ranges.append((random.choice(['chr1', 'chr2']), random.choice('+-'), start, start + random.randint(0, random.choice([100, 5000]))))
+            match.add_range(*ranges[-1])
+
+            if i % 50 == 0:
+                # searching between adds rebuilds the index
+                self.assertEqual(match.get_tag('chr1', '+', ranges[0][2]), self._brute_force(ranges, 'chr1', '+', ranges[0][2]))
+
+        positions = [random.randint(-2000, 110000) for i in xrange(2000)]
+        strands = [random.choice('+-') for i in xrange(2000)]
+
+        for chrom in ['chr1', 'chr2', 'chr3']:
+            expected = [self._brute_force(ranges, chrom, strand, pos) for strand, pos in zip(strands, positions)]
+            self.assertEqual([match.get_tag(chrom, strand, pos) for strand, pos in zip(strands, positions)], expected)
+            self.assertEqual(match.get_tags(chrom, strands, positions), expected)
+
+        self.assertEqual(match.get_tag('chr1', '-', ranges[-1][2], ignore_strand=True)[1], False)
+
+    def testBoundaries(self):
+        match = RangeMatch('test')
+        match.add_range('chr1', '+', 100, 200)
+        match.add_range('chr1', '-', 150, 160)
+        self.assertEqual(match.get_tag('chr1', '+', 99), (None, False))
+        self.assertEqual(match.get_tag('chr1', '+', 100), ('test', False))
+        self.assertEqual(match.get_tag('chr1', '+', 150), ('test', True))
+        self.assertEqual(match.get_tag('chr1', '+', 161), ('test', False))
+        self.assertEqual(match.get_tag('chr1', '+', 200), ('test', False))
+        self.assertEqual(match.get_tag('chr1', '+', 201), (None, False))
+
+
+class RegionTaggerTest(unittest.TestCase):
+    def testTagReads(self):
+        fname = os.path.join(os.path.dirname(__file__), '..', '..', 'gtf', 't', 'test1.gtf')
+        gtf = GTF(fileobj=StringIO.StringIO(open(fname).read()), quiet=True)
+
+        random.seed(2)
+        reads = []
+        chroms = []
+        for i in xrange(500):
+            read = pysam.AlignedRead()
+            read.qname = 'read%s' % i
+            read.seq = 'A' * 10
+            read.tid = 0
+            read.pos = random.randint(0, 5000)
+            read.is_reverse = random.random() < 0.5
+            read.is_unmapped = random.random() < 0.05
+            read.cigar = [(0, 5), (3, 100), (0, 5)] if random.random() < 0.1 else [(0, 10)]
+            reads.append(read)
+            chroms.append(random.choice(['chr1', 'chr1', 'chr2', 'chrM']))
+
+        one = RegionTagger(gtf)
+        expected = [one.add_read(read, chrom) for read, chrom in zip(reads, chroms)]
+
+        two = RegionTagger(gtf)
+        tags = two.tag_reads(reads, chroms)
+        self.assertEqual(two.counts, one.counts)
+        self.assertEqual(len([x for x in tags if x]), sum(one.counts.values()))
+        self.assertTrue(one.counts['coding'] > 0)
+
+        for tag, read, chrom in zip(tags, reads, chroms):
+            if tag and not tag.endswith('-rev'):
+                self.assertEqual(tag, one.add_read(read, chrom))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,14 @@
 Tests for ngsutils support / docutils
 '''
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
 import doctest
 
+import pysam
 import ngsutils.support.ngs_utils
 
 
@@ -41,5 +46,67 @@ class CountsTest(unittest.TestCase):
 
         self.assertTrue(counts.mean(), 2)
 
+
+class FASTATest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'ref.fa')
+
+        random.seed(1)
+        self.seqs = []
+        with open(self.fname, 'w') as f:
+            for chrom, length, width, eol in [('chr1', 1000, 60, '\n'), ('chr2', 120, 60, '\n'), ('chr3', 7, 4, '\n'), ('chr4', 0, 60, '\n'), ('chr5', 95, 10, '\r\n')]:
+                seq = ''.join([random.choice('ACGTacgt') for i in xrange(length)])
+                self.seqs.append((chrom, seq))
+                f.write('>%s comment\n' % chrom)
+                for i in xrange(0, length, width):
+                    f.write('%s%s' % (seq[i:i + width], eol))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testIndex(self):
+        entries = ngsutils.support.fasta_build_index(self.fname)
+        self.assertEqual([x[0] for x in entries], ['chr1', 'chr2', 'chr3', 'chr4', 'chr5'])
+
+        pysam.faidx(self.fname)
+        with open('%s.fai' % self.fname) as f:
+            expected = [line.strip().split('\t') for line in f]
+        self.assertEqual([[str(x) for x in entry] for entry in entries if entry[1]], [x for x in expected if x[1] != '0'])
+
+    def testFetch(self):
+        fasta = ngsutils.support.FASTA(self.fname)
+        self.assertEqual(fasta.references, ['chr1', 'chr2', 'chr3', 'chr4', 'chr5'])
+        self.assertEqual(fasta.lengths, [1000, 120, 7, 0, 95])
+        self.assertTrue(os.path.exists('%s.fai' % self.fname))
+
+        regions = []
+        expected = []
+        for chrom, seq in self.seqs:
+            self.assertEqual(fasta.fetch(chrom), seq)
+            for i in xrange(200):
+                start = random.randint(0, len(seq) + 5)
+                end = start + random.randint(0, 130)
+                self.assertEqual(fasta.fetch(chrom, start, end), seq[start:end])
+                regions.append((chrom, start, end))
+                expected.append(seq[start:end])
+
+        random.shuffle(regions)
+        expected = [dict(self.seqs)[chrom][start:end] for chrom, start, end in regions]
+        self.assertEqual(fasta.fetch_many(regions), expected)
+        self.assertEqual(fasta.fetch_many(regions, max_span=50), expected)
+
+        self.assertRaises(KeyError, fasta.fetch, 'chrX', 0, 10)
+
+        # sequential reading still works
+        self.assertEqual([(rec.name, rec.seq) for rec in fasta.fetch(quiet=True)], [x for x in self.seqs if x[1]])
+        fasta.close()
+
+    def testCompressed(self):
+        fasta = ngsutils.support.FASTA(fileobj=open(self.fname))
+        self.assertRaises(ValueError, fasta.fetch, 'chr1', 0, 10)
+        fasta.close()
+
+
 if __name__ == '__main__':
     unittest.main()